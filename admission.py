@@ -0,0 +1,145 @@
+"""
+准入控制 - 按模型和上游密钥限制并发，超出时进入有界优先级队列排队
+"""
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Collection, Dict, List, Optional, Tuple
+
+from upstream import Upstream, UpstreamPool, UpstreamUnavailable
+
+
+class AdmissionRejected(Exception):
+    """排队队列已满或排队超时"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """准入控制器
+
+    每个请求需要同时拿到模型并发名额和一个未满载的上游（上游的 max_concurrency
+    即每个密钥的并发上限）才能发往上游。拿不到时按优先级排队，队列满时立即拒绝。
+    """
+
+    def __init__(
+        self,
+        pool: UpstreamPool,
+        model_limits: Optional[Dict[str, int]] = None,
+        default_model_limit: int = 0,
+        max_queue: int = 100,
+        queue_timeout: float = 30.0,
+        retry_after: float = 1.0,
+    ):
+        self.pool = pool
+        self.model_limits = model_limits or {}
+        # 0 表示不限制
+        self.default_model_limit = default_model_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.model_inflight: Dict[str, int] = {}
+        # (-priority, 序号, model, future, avoid)，优先级高的先出队，同优先级先进先出
+        self._waiters: List[Tuple[int, int, str, asyncio.Future, Collection[Upstream]]] = []
+        self._queued = 0
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        """排队中的请求数"""
+        return self._queued
+
+    def model_limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.default_model_limit)
+
+    def _try_acquire(self, model: str, avoid: Collection[Upstream] = ()) -> Optional[Upstream]:
+        """尝试占用模型名额和上游，不满足时返回None"""
+        limit = self.model_limit(model)
+        if limit > 0 and self.model_inflight.get(model, 0) >= limit:
+            return None
+        try:
+            upstream = self.pool.acquire(model, avoid)
+        except UpstreamUnavailable:
+            return None
+        self.model_inflight[model] = self.model_inflight.get(model, 0) + 1
+        return upstream
+
+    def _release(self, model: str, upstream: Upstream, error: Optional[BaseException]) -> None:
+        self.model_inflight[model] -= 1
+        if not self.model_inflight[model]:
+            del self.model_inflight[model]
+        self.pool.release(upstream, error)
+        self._wake()
+
+    def _wake(self) -> None:
+        """按优先级把空出的名额分配给排队的请求"""
+        if not self._waiters:
+            return
+
+        remaining = []
+        while self._waiters:
+            entry = heapq.heappop(self._waiters)
+            future = entry[3]
+            if future.done():
+                continue
+            upstream = self._try_acquire(entry[2], entry[4])
+            if upstream is None:
+                remaining.append(entry)
+                continue
+            self._queued -= 1
+            future.set_result(upstream)
+
+        for entry in remaining:
+            heapq.heappush(self._waiters, entry)
+
+    async def acquire(self, model: str, priority: int = 0, avoid: Collection[Upstream] = ()) -> Upstream:
+        """获取准入，返回分配到的上游（尽量避开avoid中的上游）"""
+        if not self.pool.serves(model):
+            raise UpstreamUnavailable(f"没有可用的上游处理模型 {model}")
+
+        if not self._waiters:
+            upstream = self._try_acquire(model, avoid)
+            if upstream is not None:
+                return upstream
+
+        if self._queued >= self.max_queue:
+            raise AdmissionRejected("请求排队已满", self.retry_after)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._seq), model, future, avoid))
+        self._queued += 1
+        # 新请求可能属于其它有空闲名额的模型
+        self._wake()
+
+        # 不用wait_for：名额分配和取消发生在同一轮事件循环时，wait_for会返回结果而吞掉取消
+        try:
+            await asyncio.wait((future,), timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if future.done():
+                # 已分配到名额但请求被取消，归还名额
+                self._release(model, future.result(), None)
+            else:
+                future.cancel()
+                self._queued -= 1
+            raise
+        if not future.done():
+            future.cancel()
+            self._queued -= 1
+            raise AdmissionRejected("请求排队超时", self.retry_after)
+        return future.result()
+
+    @asynccontextmanager
+    async def admit(self, model: str, priority: int = 0, avoid: Collection[Upstream] = ()) -> AsyncIterator[Upstream]:
+        """在准入名额内调用上游"""
+        upstream = await self.acquire(model, priority, avoid)
+        error = None
+        try:
+            yield upstream
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._release(model, upstream, error)
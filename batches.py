@@ -0,0 +1,719 @@
+"""
+批处理 - OpenAI格式的 /v1/files 和 /v1/batches，逐行转换后通过Anthropic Message Batches API提交
+
+输入文件每行一个请求（custom_id/method/url/body），按上游和大小分成若干个Anthropic批处理提交，
+轮询到全部结束后把结果逐行转换为OpenAI格式写入输出文件（失败的请求写入错误文件）。
+批处理状态保存在磁盘上，代理重启后继续轮询已提交的批处理。多worker时由创建批处理的worker负责处理，
+其它worker从磁盘读取状态，取消通过标记文件通知负责的worker。
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson为可选依赖
+    orjson = None
+
+import sdk
+from retry import retry_async
+from upstream import Upstream, UpstreamPool
+
+SUPPORTED_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+# 终止状态，不再变化
+TERMINAL_STATUSES = ("completed", "failed", "cancelled", "expired")
+# 文件和批处理ID只包含这些字符，避免拼接路径时越出目录
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Anthropic的custom_id规则
+_ANTHROPIC_CUSTOM_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Anthropic错误类型对应的HTTP状态码
+_ERROR_STATUS = {
+    "invalid_request_error": 400,
+    "authentication_error": 401,
+    "permission_error": 403,
+    "not_found_error": 404,
+    "request_too_large": 413,
+    "rate_limit_error": 429,
+    "overloaded_error": 529,
+}
+# 解析线程每次交给提交任务的请求数，以及最多领先提交任务的批数（超过后解析线程等待）
+_PARSE_BATCH = 256
+_PARSE_QUEUE = 8
+# 收集结果时攒够这么多字节再写入文件
+_WRITE_BUFFER = 1024 * 1024
+
+
+class BatchError(ValueError):
+    """批处理请求无效：文件不存在、用途或端点不支持等"""
+
+
+def _loads(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _dumps_line(data: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data) + b"\n"
+    return json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def _write_json(path: str, data: Dict[str, Any]) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _open_for_append(output_path: str, output_size: int, error_path: str, error_size: int):
+    """打开输出文件和错误文件，截掉上次写了一半的内容"""
+    files = []
+    for path, size in ((output_path, output_size), (error_path, error_size)):
+        f = open(path, "r+b")
+        f.truncate(size)
+        f.seek(size)
+        files.append(f)
+    return files
+
+
+def _write_pending(pending: Dict[Any, List[bytes]]) -> None:
+    for f, lines in pending.items():
+        f.writelines(lines)
+        lines.clear()
+
+
+def _close_all(*files) -> None:
+    for f in files:
+        f.close()
+
+
+class FileStore:
+    """上传文件存储，每个文件的内容和元数据分别保存为 <id>.data 和 <id>.json"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, file_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{file_id}.{suffix}")
+
+    def content_path(self, file_id: str) -> str:
+        return self._path(file_id, "data")
+
+    def new_id(self) -> str:
+        return f"file-{uuid.uuid4().hex[:24]}"
+
+    async def create(
+        self, filename: str, purpose: str, chunks: AsyncIterator[bytes], max_bytes: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """边接收边写入磁盘，返回OpenAI格式的文件对象，超过max_bytes时抛出BatchError"""
+        file_id = self.new_id()
+        path = self.content_path(file_id)
+        # 文件读写都在线程池中进行，不阻塞事件循环
+        f = await asyncio.to_thread(open, path, "wb")
+        try:
+            size = 0
+            async for chunk in chunks:
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise BatchError(f"文件超过 {max_bytes} 字节")
+                await asyncio.to_thread(f.write, chunk)
+            await asyncio.to_thread(f.close)
+        except BaseException:
+            f.close()
+            os.remove(path)
+            raise
+        return await asyncio.to_thread(self.register, file_id, filename, purpose)
+
+    def register(self, file_id: str, filename: str, purpose: str) -> Dict[str, Any]:
+        """为已写好内容的文件保存元数据"""
+        info = {
+            "id": file_id,
+            "object": "file",
+            "bytes": os.path.getsize(self.content_path(file_id)),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        _write_json(self._path(file_id, "json"), info)
+        return info
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        if not _SAFE_ID.match(file_id):
+            return None
+        return _read_json(self._path(file_id, "json"))
+
+    def list(self, purpose: Optional[str] = None) -> List[Dict[str, Any]]:
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                info = _read_json(os.path.join(self.directory, name))
+                if info is not None and (purpose is None or info.get("purpose") == purpose):
+                    files.append(info)
+        return sorted(files, key=lambda info: info["created_at"], reverse=True)
+
+    def delete(self, file_id: str) -> bool:
+        if self.get(file_id) is None:
+            return False
+        for suffix in ("json", "data"):
+            try:
+                os.remove(self._path(file_id, suffix))
+            except OSError:
+                pass
+        return True
+
+
+class BatchManager:
+    """管理批处理的提交、轮询和结果收集
+
+    输入文件在工作线程中解析和转换，线程有自己的事件循环：open_converter() 在该循环中进入，
+    得到把一行请求的body（OpenAI格式）转换为Anthropic请求参数的协程函数（可以在其中下载图片）；
+    convert_response把Anthropic消息转换为OpenAI格式的响应体。
+    """
+
+    def __init__(
+        self,
+        files: FileStore,
+        directory: str,
+        get_pool: Callable[[], UpstreamPool],
+        open_converter: Callable[[], AsyncContextManager[Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]]],
+        convert_response: Callable[[Any, str], Dict[str, Any]],
+        poll_interval: float = 30.0,
+        max_requests: int = 10000,
+        max_bytes: int = 128 * 1024 * 1024,
+        max_retries: int = 2,
+    ):
+        self.files = files
+        self.directory = directory
+        self.get_pool = get_pool
+        self.open_converter = open_converter
+        self.convert_response = convert_response
+        self.poll_interval = poll_interval
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        # 本进程负责处理的批处理
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._resume_lock = None
+        os.makedirs(directory, exist_ok=True)
+
+    # ---- 对外接口 ----
+
+    def create(
+        self,
+        input_file_id: str,
+        endpoint: str,
+        completion_window: str = COMPLETION_WINDOW,
+        metadata: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, Any]:
+        """创建批处理并在后台开始处理，返回OpenAI格式的批处理对象"""
+        info = self.files.get(input_file_id)
+        if info is None:
+            raise BatchError(f"文件不存在: {input_file_id}")
+        if info.get("purpose") != "batch":
+            raise BatchError("输入文件的purpose必须是batch")
+        if endpoint != SUPPORTED_ENDPOINT:
+            raise BatchError(f"只支持 {SUPPORTED_ENDPOINT} 端点")
+        if completion_window != COMPLETION_WINDOW:
+            raise BatchError(f"completion_window只支持 {COMPLETION_WINDOW}")
+
+        now = int(time.time())
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        record = {
+            "batch": {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": endpoint,
+                "errors": None,
+                "input_file_id": input_file_id,
+                "completion_window": completion_window,
+                "status": "validating",
+                "output_file_id": None,
+                "error_file_id": None,
+                "created_at": now,
+                "in_progress_at": None,
+                "expires_at": now + 24 * 3600,
+                "finalizing_at": None,
+                "completed_at": None,
+                "failed_at": None,
+                "expired_at": None,
+                "cancelling_at": None,
+                "cancelled_at": None,
+                "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                "metadata": metadata,
+            },
+            # 已提交的Anthropic批处理：{"upstream", "id", "count", "status", "counts"}
+            "chunks": [],
+            "submitted": False,
+            "cancel_requested": False,
+            "chunks_cancelled": False,
+            # 无法直接作为Anthropic custom_id的原始custom_id
+            "custom_ids": {},
+            # 提交时发现的无效请求数
+            "invalid": 0,
+            # 输出文件和错误文件（结果收集完成后才登记为文件对象）
+            "output_file_id": self.files.new_id(),
+            "error_file_id": self.files.new_id(),
+            # 已完成收集的结果在两个文件中的长度，收集中断后从这里继续
+            "output_size": 0,
+            "error_size": 0,
+        }
+        for file_id in (record["output_file_id"], record["error_file_id"]):
+            open(self.files.content_path(file_id), "wb").close()
+        self._records[batch_id] = record
+        self._save(record)
+        self._start(record)
+        return record["batch"]
+
+    def _load(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """本进程负责的批处理直接返回，其它worker的批处理从磁盘读取"""
+        record = self._records.get(batch_id)
+        if record is None and _SAFE_ID.match(batch_id):
+            record = _read_json(self._path(batch_id, "json"))
+        return record
+
+    def get(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        record = self._load(batch_id)
+        return record["batch"] if record is not None else None
+
+    def list(self, limit: int = 20, after: Optional[str] = None) -> Dict[str, Any]:
+        """按创建时间倒序分页列出批处理"""
+        records = [self._load(name[:-5]) for name in os.listdir(self.directory) if name.endswith(".json")]
+        batches = sorted((r["batch"] for r in records if r is not None), key=lambda b: b["created_at"], reverse=True)
+        if after is not None:
+            ids = [batch["id"] for batch in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        page = batches[:limit]
+        return {
+            "object": "list",
+            "data": page,
+            "first_id": page[0]["id"] if page else None,
+            "last_id": page[-1]["id"] if page else None,
+            "has_more": len(batches) > limit,
+        }
+
+    async def cancel(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """取消批处理：停止提交并取消已提交的Anthropic批处理，已完成的结果仍会写入输出文件"""
+        record = self._load(batch_id)
+        if record is None:
+            return None
+        batch = record["batch"]
+        if batch["status"] in TERMINAL_STATUSES or record["cancel_requested"]:
+            return batch
+        # 批处理可能由其它worker负责，通过标记文件通知它停止提交
+        open(self._path(batch_id, "cancel"), "w").close()
+        self._check_cancel(record)
+        if batch_id in self._records:
+            self._save(record)
+        await self._cancel_chunks(record)
+        return batch
+
+    def resume(self) -> None:
+        """启动时继续处理未结束的批处理，尚未提交完的批处理无法恢复，标记为失败
+
+        多worker时只有拿到恢复锁的一个worker负责恢复。
+        """
+        lock = open(os.path.join(self.directory, "resume.lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return
+        # 锁随进程持有，进程退出时自动释放
+        self._resume_lock = lock
+        for name in os.listdir(self.directory):
+            record = _read_json(os.path.join(self.directory, name)) if name.endswith(".json") else None
+            if record is None or record["batch"]["status"] in TERMINAL_STATUSES:
+                continue
+            self._check_cancel(record)
+            if record["submitted"]:
+                self._records[record["batch"]["id"]] = record
+                self._start(record)
+            else:
+                self._fail(record, "batch_interrupted", "代理重启时批处理尚未提交完成，请重新创建")
+                if record["chunks"]:
+                    asyncio.create_task(self._cancel_chunks(record))
+
+    async def close(self) -> None:
+        """停止后台任务，状态已保存，重启后继续"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._resume_lock is not None:
+            self._resume_lock.close()
+            self._resume_lock = None
+
+    # ---- 后台处理 ----
+
+    def _start(self, record: Dict[str, Any]) -> None:
+        batch_id = record["batch"]["id"]
+        task = asyncio.create_task(self._run(record))
+        self._tasks[batch_id] = task
+
+        def done(_):
+            # 结束后的批处理从磁盘读取
+            self._tasks.pop(batch_id, None)
+            self._records.pop(batch_id, None)
+
+        task.add_done_callback(done)
+
+    def _path(self, batch_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{batch_id}.{suffix}")
+
+    def _save(self, record: Dict[str, Any]) -> None:
+        _write_json(self._path(record["batch"]["id"], "json"), record)
+
+    def _check_cancel(self, record: Dict[str, Any]) -> bool:
+        """检查取消标记，返回是否已请求取消"""
+        batch = record["batch"]
+        if not record["cancel_requested"] and os.path.exists(self._path(batch["id"], "cancel")):
+            record["cancel_requested"] = True
+            batch["status"] = "cancelling"
+            batch["cancelling_at"] = int(time.time())
+        return record["cancel_requested"]
+
+    async def _call(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        return await retry_async(fn, self.max_retries, 1.0, 30.0)
+
+    def _client(self, upstream_name: str) -> Any:
+        for upstream in self.get_pool().upstreams:
+            if upstream.name == upstream_name:
+                return upstream.client
+        raise BatchError(f"上游 {upstream_name} 已不在配置中")
+
+    async def _run(self, record: Dict[str, Any]) -> None:
+        try:
+            if not record["submitted"]:
+                await self._submit(record)
+            await self._wait(record)
+            await self._collect(record)
+            self._finish(record)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._fail(record, "batch_failed", f"{type(e).__name__}: {e}")
+
+    def _upstream_for(self, model: str) -> Upstream:
+        """选择提交批处理的上游：支持该模型且未被摘除的第一个上游"""
+        candidates = [upstream for upstream in self.get_pool().upstreams if upstream.serves(model)]
+        if not candidates:
+            raise BatchError(f"没有上游支持模型 {model}")
+        now = time.monotonic()
+        return next((upstream for upstream in candidates if not upstream.is_ejected(now)), candidates[0])
+
+    @staticmethod
+    def _anthropic_custom_id(custom_id: str) -> str:
+        """无法直接作为Anthropic custom_id的原始custom_id换成哈希"""
+        if _ANTHROPIC_CUSTOM_ID.match(custom_id):
+            return custom_id
+        return "h-" + hashlib.sha256(custom_id.encode("utf-8")).hexdigest()[:40]
+
+    @staticmethod
+    async def _parse_line(
+        line: bytes, convert: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]
+    ) -> Tuple[Optional[str], Dict[str, Any]]:
+        """解析输入文件中的一行，返回 (custom_id, Anthropic请求参数)"""
+        custom_id = None
+        try:
+            item = _loads(line)
+        except ValueError as e:
+            raise BatchError(f"不是合法的JSON: {e}") from e
+        if not isinstance(item, dict):
+            raise BatchError("每一行都必须是JSON对象")
+        custom_id = item.get("custom_id")
+        if not isinstance(custom_id, str) or not custom_id:
+            raise BatchError("缺少custom_id")
+        try:
+            if item.get("method", "POST").upper() != "POST" or item.get("url") != SUPPORTED_ENDPOINT:
+                raise BatchError(f"只支持 POST {SUPPORTED_ENDPOINT}")
+            body = item.get("body")
+            if not isinstance(body, dict):
+                raise BatchError("body必须是JSON对象")
+            return custom_id, await convert(body)
+        except BatchError as e:
+            e.custom_id = custom_id
+            raise
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            error = BatchError(f"请求无效: {e}")
+            error.custom_id = custom_id
+            raise error from e
+
+    async def _submit(self, record: Dict[str, Any]) -> None:
+        """解析线程逐行转换输入文件，这里按上游分组，达到数量或大小上限时提交一个Anthropic批处理
+
+        每个上游缓冲的是序列化后的请求行（比字典小得多），提交时直接拼接为请求体。
+        """
+        batch = record["batch"]
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(_PARSE_QUEUE)
+        stop = threading.Event()
+        parsing = asyncio.ensure_future(asyncio.to_thread(self._parse_file, record, loop, queue, stop))
+        buffers: Dict[str, Tuple[Upstream, List[bytes], List[int]]] = {}
+        try:
+            while True:
+                items = await queue.get()
+                if items is None:
+                    break
+                if self._check_cancel(record):
+                    break
+                for upstream, custom_id, mapped, line in items:
+                    if mapped != custom_id:
+                        record["custom_ids"][mapped] = custom_id
+                    _, lines, size = buffers.setdefault(upstream.name, (upstream, [], [0]))
+                    lines.append(line)
+                    size[0] += len(line)
+                    if len(lines) >= self.max_requests or size[0] >= self.max_bytes:
+                        del buffers[upstream.name]
+                        await self._submit_chunk(record, upstream, lines)
+        finally:
+            stop.set()
+            total, invalid, error_size = await parsing
+        record["invalid"] = invalid
+        record["error_size"] = error_size
+
+        if not self._check_cancel(record):
+            for upstream, lines, _ in buffers.values():
+                await self._submit_chunk(record, upstream, lines)
+        batch["request_counts"]["total"] = total
+        batch["request_counts"]["failed"] = record["invalid"]
+        record["submitted"] = True
+        if not record["cancel_requested"]:
+            batch["status"] = "in_progress"
+            batch["in_progress_at"] = int(time.time())
+        self._save(record)
+
+    def _parse_file(
+        self, record: Dict[str, Any], loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, stop: threading.Event
+    ) -> Tuple[int, int, int]:
+        """在工作线程中运行：解析并转换输入文件，返回 (请求总数, 无效请求数, 错误文件长度)"""
+        return asyncio.run(self._parse_input(record, loop, queue, stop))
+
+    async def _parse_input(
+        self, record: Dict[str, Any], loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, stop: threading.Event
+    ) -> Tuple[int, int, int]:
+        batch = record["batch"]
+        cancel_path = self._path(batch["id"], "cancel")
+        items: List[Tuple[Upstream, str, str, bytes]] = []
+        seen = set()
+        total = invalid = 0
+        try:
+            async with self.open_converter() as convert:
+                with open(self.files.content_path(batch["input_file_id"]), "rb") as f, \
+                        open(self.files.content_path(record["error_file_id"]), "ab") as errors:
+                    for line_number, line in enumerate(f, 1):
+                        if stop.is_set() or os.path.exists(cancel_path):
+                            break
+                        if not line.strip():
+                            continue
+                        total += 1
+                        custom_id = None
+                        try:
+                            custom_id, kwargs = await self._parse_line(line, convert)
+                            if custom_id in seen:
+                                raise BatchError("custom_id重复")
+                            seen.add(custom_id)
+                            upstream = self._upstream_for(kwargs["model"])
+                        except BatchError as e:
+                            invalid += 1
+                            errors.write(_dumps_line(self._error_line(
+                                getattr(e, "custom_id", custom_id), "invalid_request", f"第{line_number}行: {e}")))
+                            continue
+
+                        mapped = self._anthropic_custom_id(custom_id)
+                        items.append((upstream, custom_id, mapped, _dumps_line({"custom_id": mapped, "params": kwargs})))
+                        if len(items) >= _PARSE_BATCH:
+                            if not self._hand_off(items, loop, queue, stop):
+                                break
+                            items = []
+                    error_size = errors.tell()
+            if items:
+                self._hand_off(items, loop, queue, stop)
+        finally:
+            # 结束标记；提交任务已经停止读取时不再发送
+            self._hand_off(None, loop, queue, stop)
+        return total, invalid, error_size
+
+    @staticmethod
+    def _hand_off(
+        items: Optional[list], loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, stop: threading.Event
+    ) -> bool:
+        """把一批请求交给提交任务，队列满时等待；提交任务已停止读取时返回False"""
+        future = asyncio.run_coroutine_threadsafe(queue.put(items), loop)
+        while True:
+            try:
+                future.result(timeout=0.1)
+                return True
+            except FutureTimeout:
+                if stop.is_set():
+                    future.cancel()
+                    return False
+
+    async def _submit_chunk(self, record: Dict[str, Any], upstream: Upstream, lines: List[bytes]) -> None:
+        # 直接拼接已序列化的请求行作为请求体，SDK不用在事件循环中复制和序列化上万个请求
+        content = b'{"requests":[' + b",".join(line.rstrip(b"\n") for line in lines) + b"]}"
+        created = await self._call(lambda: upstream.client.post(
+            "/v1/messages/batches",
+            cast_to=sdk.load().types.messages.MessageBatch,
+            content=content,
+            options={"headers": {"Content-Type": "application/json"}},
+        ))
+        record["chunks"].append({
+            "upstream": upstream.name,
+            "id": created.id,
+            "count": len(lines),
+            "status": created.processing_status,
+            "counts": None,
+        })
+        self._save(record)
+
+    async def _cancel_chunks(self, record: Dict[str, Any]) -> None:
+        for chunk in record["chunks"]:
+            if chunk["status"] in ("ended", "collected"):
+                continue
+            try:
+                client = self._client(chunk["upstream"])
+                await self._call(lambda: client.messages.batches.cancel(chunk["id"]))
+            except Exception:
+                # 取消失败时等待其正常结束
+                pass
+
+    async def _wait(self, record: Dict[str, Any]) -> None:
+        """轮询所有Anthropic批处理直到全部结束，期间更新请求计数"""
+        batch = record["batch"]
+        while True:
+            if self._check_cancel(record) and not record["chunks_cancelled"]:
+                # 提交过程中收到取消时，标记之后提交的批处理也需要取消
+                await self._cancel_chunks(record)
+                record["chunks_cancelled"] = True
+            for chunk in record["chunks"]:
+                if chunk["status"] in ("ended", "collected"):
+                    continue
+                client = self._client(chunk["upstream"])
+                info = await self._call(lambda: client.messages.batches.retrieve(chunk["id"]))
+                chunk["status"] = info.processing_status
+                chunk["counts"] = info.request_counts.model_dump()
+
+            finished = [chunk["counts"] for chunk in record["chunks"] if chunk["counts"]]
+            batch["request_counts"]["completed"] = sum(counts["succeeded"] for counts in finished)
+            batch["request_counts"]["failed"] = record["invalid"] + sum(
+                counts["errored"] + counts["canceled"] + counts["expired"] for counts in finished)
+            self._save(record)
+            if all(chunk["status"] in ("ended", "collected") for chunk in record["chunks"]):
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    async def _collect(self, record: Dict[str, Any]) -> None:
+        """逐个下载Anthropic批处理的结果，转换后追加到输出文件和错误文件"""
+        batch = record["batch"]
+        batch["status"] = "finalizing" if not record["cancel_requested"] else batch["status"]
+        batch["finalizing_at"] = batch["finalizing_at"] or int(time.time())
+        self._save(record)
+        output_path = self.files.content_path(record["output_file_id"])
+        error_path = self.files.content_path(record["error_file_id"])
+        for chunk in record["chunks"]:
+            if chunk["status"] == "collected":
+                continue
+            client = self._client(chunk["upstream"])
+            # 上次收集到一半中断时丢弃写了一半的结果；文件读写都在线程池中进行
+            output, errors = await asyncio.to_thread(
+                _open_for_append, output_path, record["output_size"], error_path, record["error_size"])
+            try:
+                pending = {output: [], errors: []}
+                buffered = 0
+                results = await self._call(lambda: client.messages.batches.results(chunk["id"]))
+                async for item in results:
+                    line, ok = self._result_line(record, item)
+                    data = _dumps_line(line)
+                    pending[output if ok else errors].append(data)
+                    buffered += len(data)
+                    if buffered >= _WRITE_BUFFER:
+                        await asyncio.to_thread(_write_pending, pending)
+                        buffered = 0
+                await asyncio.to_thread(_write_pending, pending)
+                record["output_size"], record["error_size"] = output.tell(), errors.tell()
+            finally:
+                await asyncio.to_thread(_close_all, output, errors)
+            chunk["status"] = "collected"
+            self._save(record)
+
+    def _result_line(self, record: Dict[str, Any], item: Any) -> Tuple[Dict[str, Any], bool]:
+        """把一条Anthropic批处理结果转换为OpenAI批处理输出行，返回 (行, 是否成功)"""
+        custom_id = record["custom_ids"].get(item.custom_id, item.custom_id)
+        result = item.result
+        if result.type == "succeeded":
+            message = result.message
+            return {
+                "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                "custom_id": custom_id,
+                "response": {
+                    "status_code": 200,
+                    "request_id": message.id,
+                    "body": self.convert_response(message, message.model),
+                },
+                "error": None,
+            }, True
+        if result.type == "errored":
+            error = result.error.error
+            return {
+                "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                "custom_id": custom_id,
+                "response": {
+                    "status_code": _ERROR_STATUS.get(error.type, 500),
+                    "request_id": None,
+                    "body": {"error": {"message": error.message, "type": error.type}},
+                },
+                "error": None,
+            }, False
+        code = "batch_cancelled" if result.type == "canceled" else "batch_expired"
+        return self._error_line(custom_id, code, f"请求未处理（{result.type}）"), False
+
+    @staticmethod
+    def _error_line(custom_id: Optional[str], code: str, message: str) -> Dict[str, Any]:
+        return {
+            "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+            "custom_id": custom_id,
+            "response": None,
+            "error": {"code": code, "message": message},
+        }
+
+    def _finish(self, record: Dict[str, Any]) -> None:
+        batch = record["batch"]
+        now = int(time.time())
+        if record["output_size"]:
+            self.files.register(record["output_file_id"], f"{batch['id']}_output.jsonl", "batch_output")
+            batch["output_file_id"] = record["output_file_id"]
+        if record["error_size"]:
+            self.files.register(record["error_file_id"], f"{batch['id']}_error.jsonl", "batch_output")
+            batch["error_file_id"] = record["error_file_id"]
+        if record["cancel_requested"]:
+            batch["status"] = "cancelled"
+            batch["cancelled_at"] = now
+        else:
+            batch["status"] = "completed"
+            batch["completed_at"] = now
+        self._save(record)
+
+    def _fail(self, record: Dict[str, Any], code: str, message: str) -> None:
+        batch = record["batch"]
+        batch["status"] = "failed"
+        batch["failed_at"] = int(time.time())
+        batch["errors"] = {"object": "list", "data": [{"code": code, "message": message, "param": None, "line": None}]}
+        self._save(record)
@@ -0,0 +1,241 @@
+"""
+压测脚本 - 在本地启动模拟上游和代理，按不同并发度压测并输出吞吐和延迟
+不需要网络和真实的API密钥，可以用 --baseline 对比历史结果来发现性能回退
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """读取进程累计的CPU时间（用户态+内核态），仅支持Linux"""
+    try:
+        fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # utime和stime分别是第14、15个字段，去掉pid和进程名后位于下标11、12
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def wait_ready(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"服务启动超时: {url}")
+
+
+def start_servers(args) -> Dict[str, object]:
+    """启动模拟上游和代理子进程"""
+    mock_port = free_port()
+    proxy_port = free_port()
+    mock = subprocess.Popen([
+        sys.executable, str(ROOT / "mock_upstream.py"),
+        "--port", str(mock_port),
+        "--latency", str(args.latency),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--output-tokens", str(args.output_tokens),
+        "--error-rate", str(args.error_rate),
+    ], cwd=ROOT)
+
+    env = dict(os.environ)
+    env.update({
+        "HOST": "127.0.0.1",
+        "PORT": str(proxy_port),
+        "UPSTREAMS": json.dumps([{
+            "name": "mock", "base_url": f"http://127.0.0.1:{mock_port}", "api_key": "mock-key",
+        }]),
+        # 每个请求都要真正经过上游，缓存和合并会让结果失真
+        "RESPONSE_CACHE_ENABLED": "false",
+        "COALESCE_ENABLED": "false",
+        "ADMISSION_MAX_QUEUE": str(max(args.concurrency) * 2),
+    })
+    proxy = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(proxy_port),
+         "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    return {"mock": mock, "proxy": proxy, "mock_port": mock_port, "proxy_port": proxy_port}
+
+
+def stop_servers(servers: Dict[str, object]) -> None:
+    for name in ("proxy", "mock"):
+        process = servers[name]
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def one_request(client: httpx.AsyncClient, url: str, model: str, stream: bool, seq: int) -> Dict[str, object]:
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": f"压测请求 #{seq}，请简短回答。"}],
+        "max_tokens": 1024,
+        "stream": stream,
+    }
+    started = time.perf_counter()
+    ttft = None
+    try:
+        if stream:
+            async with client.stream("POST", url, json=payload) as response:
+                status = response.status_code
+                async for line in response.aiter_lines():
+                    if ttft is None and '"content"' in line:
+                        ttft = time.perf_counter() - started
+        else:
+            response = await client.post(url, json=payload)
+            status = response.status_code
+            ttft = time.perf_counter() - started
+    except httpx.HTTPError:
+        status = 0
+    return {"status": status, "latency": time.perf_counter() - started, "ttft": ttft}
+
+
+async def run_level(url: str, args, concurrency: int, proxy_pid: int) -> Dict[str, float]:
+    """以固定并发度发送 args.requests 个请求"""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=60.0, limits=limits) as client:
+        # 预热，建立连接
+        await asyncio.gather(*(one_request(client, url, args.model, args.stream, -i) for i in range(concurrency)))
+
+        counter = iter(range(args.requests))
+        results: List[Dict[str, object]] = []
+
+        async def worker():
+            for seq in counter:
+                results.append(await one_request(client, url, args.model, args.stream, seq))
+
+        cpu_before = process_cpu_seconds(proxy_pid)
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        cpu_after = process_cpu_seconds(proxy_pid)
+
+    ok = [r for r in results if r["status"] == 200]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    cpu = None if cpu_before is None or cpu_after is None else (cpu_after - cpu_before) / max(1, len(results))
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "rps": len(ok) / elapsed if elapsed else 0.0,
+        "ttft_p50": percentile(ttfts, 0.50),
+        "ttft_p95": percentile(ttfts, 0.95),
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "cpu_ms_per_request": None if cpu is None else cpu * 1000,
+    }
+
+
+def print_results(results: List[Dict[str, float]]) -> None:
+    header = f"{'并发':>6} {'请求':>6} {'错误':>6} {'RPS':>9} {'TTFT p50':>10} {'TTFT p95':>10} " \
+             f"{'p50':>9} {'p95':>9} {'p99':>9} {'CPU/请求':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        cpu = "n/a" if r["cpu_ms_per_request"] is None else f"{r['cpu_ms_per_request']:.2f}ms"
+        print(f"{r['concurrency']:>6} {r['requests']:>6} {r['errors']:>6} {r['rps']:>9.1f} "
+              f"{r['ttft_p50'] * 1000:>8.1f}ms {r['ttft_p95'] * 1000:>8.1f}ms "
+              f"{r['latency_p50'] * 1000:>7.1f}ms {r['latency_p95'] * 1000:>7.1f}ms "
+              f"{r['latency_p99'] * 1000:>7.1f}ms {cpu:>10}")
+
+
+def compare_baseline(results: List[Dict[str, float]], baseline_path: str, threshold: float,
+                     stream: bool) -> List[str]:
+    """与基线结果对比，返回超过阈值的回退项"""
+    data = json.loads(Path(baseline_path).read_text())
+    if data.get("stream") != stream:
+        raise SystemExit("基线与本次压测的请求模式（流式/非流式）不一致")
+    baseline = {r["concurrency"]: r for r in data["results"]}
+    regressions = []
+    for r in results:
+        base = baseline.get(r["concurrency"])
+        if base is None:
+            continue
+        if base["rps"] and r["rps"] < base["rps"] * (1 - threshold):
+            regressions.append(f"并发{r['concurrency']}: RPS {base['rps']:.1f} -> {r['rps']:.1f}")
+        if base["latency_p99"] and r["latency_p99"] > base["latency_p99"] * (1 + threshold):
+            regressions.append(
+                f"并发{r['concurrency']}: p99 {base['latency_p99'] * 1000:.1f}ms -> {r['latency_p99'] * 1000:.1f}ms")
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="代理压测")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64], help="并发度列表")
+    parser.add_argument("--requests", type=int, default=200, help="每个并发度发送的请求数")
+    parser.add_argument("--stream", action="store_true", help="使用流式请求")
+    parser.add_argument("--model", default="mock-model")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟上游首包延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="模拟上游输出速度，0为不限速")
+    parser.add_argument("--output-tokens", type=int, default=64)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游错误注入概率")
+    parser.add_argument("--output", help="把结果写入JSON文件（可作为之后的基线）")
+    parser.add_argument("--baseline", help="对比的基线JSON文件")
+    parser.add_argument("--threshold", type=float, default=0.1, help="允许的回退比例")
+    args = parser.parse_args()
+
+    servers = start_servers(args)
+    try:
+        await wait_ready(f"http://127.0.0.1:{servers['mock_port']}/health")
+        await wait_ready(f"http://127.0.0.1:{servers['proxy_port']}/health")
+        url = f"http://127.0.0.1:{servers['proxy_port']}/v1/chat/completions"
+
+        results = []
+        for concurrency in args.concurrency:
+            results.append(await run_level(url, args, concurrency, servers["proxy"].pid))
+    finally:
+        stop_servers(servers)
+
+    mode = "流式" if args.stream else "非流式"
+    print(f"\n{mode}请求，上游首包延迟 {args.latency * 1000:.0f}ms，输出 {args.output_tokens} tokens\n")
+    print_results(results)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({"stream": args.stream, "results": results}, indent=2))
+
+    if args.baseline:
+        regressions = compare_baseline(results, args.baseline, args.threshold, args.stream)
+        if regressions:
+            print("\n性能回退超过阈值:")
+            for item in regressions:
+                print(f"  {item}")
+            sys.exit(1)
+        print("\n未发现性能回退")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+"""
+响应缓存 - 对确定性的非流式请求做精确匹配缓存
+"""
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def make_cache_key(kwargs: Dict[str, Any]) -> str:
+    """根据Anthropic请求参数计算规范化哈希"""
+    canonical = json.dumps(kwargs, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU缓存，同时按条目数和字节数限制容量，每个条目带TTL
+
+    设置了lower（有get/set方法的下一级缓存，如磁盘缓存）时，写入同时写到下一级缓存，
+    未命中时查询下一级缓存并把命中的条目放回内存；下一级缓存的读写在线程池中进行，不阻塞事件循环。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 300.0,
+        lower: Optional[Any] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lower = lower
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """读取缓存，过期条目视为未命中"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            self._remove(key)
+            entry = None
+
+        if entry is None:
+            value = await asyncio.to_thread(self.lower.get, key) if self.lower is not None else None
+            if value is None:
+                self.misses += 1
+                return None
+            # 等待下一级缓存期间可能已经写入了新值
+            if key not in self._entries:
+                self._insert(key, value)
+            self.hits += 1
+            return value
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    async def set(self, key: str, value: bytes) -> None:
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        self._insert(key, value)
+        if self.lower is not None:
+            await asyncio.to_thread(self.lower.set, key, value)
+
+    def _insert(self, key: str, value: bytes) -> None:
+        # 单个条目超过总容量时不缓存
+        if len(value) > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._bytes += len(value)
+
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
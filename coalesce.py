@@ -0,0 +1,115 @@
+"""
+请求合并 - 相同的并发请求只向上游发送一次
+"""
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+class SingleFlight:
+    """非流式请求合并：同一个key同时只有一个上游调用，所有等待者共享结果，所有等待者都被取消时取消调用"""
+
+    def __init__(self):
+        # key -> [调用任务, 等待者数量]
+        self._inflight: Dict[str, list] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """执行fn，若已有相同key的调用在进行中则等待其结果"""
+        flight = self._inflight.get(key)
+        if flight is None:
+            # 上游调用放在独立任务中，避免某个等待者被取消时影响其它等待者
+            task = asyncio.ensure_future(fn())
+            flight = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, flight))
+
+        task = flight[0]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                self._forget(key, flight)
+                task.cancel()
+
+    def _forget(self, key: str, flight: list) -> None:
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+
+
+class _Broadcast:
+    """单个上游流的广播状态"""
+
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.event = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self) -> None:
+        self.event.set()
+        self.event = asyncio.Event()
+
+
+class StreamCoalescer:
+    """流式请求合并：一个上游流扇出给多个订阅者，迟到的订阅者从回放缓冲区补齐已发送的块"""
+
+    def __init__(self):
+        self._inflight: Dict[str, _Broadcast] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def subscribe(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """订阅key对应的上游流，不存在时用factory创建"""
+        broadcast = self._inflight.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            self._inflight[key] = broadcast
+            broadcast.task = asyncio.create_task(self._pump(key, broadcast, factory()))
+
+        broadcast.subscribers += 1
+        index = 0
+        try:
+            while True:
+                if index < len(broadcast.chunks):
+                    yield broadcast.chunks[index]
+                    index += 1
+                    continue
+                if broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    return
+                await broadcast.event.wait()
+        finally:
+            broadcast.subscribers -= 1
+            # 所有订阅者都离开时取消上游流
+            if broadcast.subscribers == 0 and not broadcast.done:
+                self._forget(key, broadcast)
+                broadcast.task.cancel()
+
+    async def _pump(self, key: str, broadcast: _Broadcast, source: AsyncIterator[Any]) -> None:
+        """从上游读取数据块写入回放缓冲区并唤醒订阅者"""
+        try:
+            async for chunk in source:
+                broadcast.chunks.append(chunk)
+                broadcast.notify()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            broadcast.error = e
+        finally:
+            broadcast.done = True
+            self._forget(key, broadcast)
+            broadcast.notify()
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    def _forget(self, key: str, broadcast: _Broadcast) -> None:
+        if self._inflight.get(key) is broadcast:
+            del self._inflight[key]
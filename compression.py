@@ -0,0 +1,161 @@
+"""
+压缩 - 请求体gzip/zstd解压，按Accept-Encoding压缩响应，SSE流按刷新逐块压缩
+"""
+import gzip
+import zlib
+from typing import AsyncIterator, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstandard为可选依赖
+    zstandard = None
+
+
+# 请求体解压时单次产出的数据上限
+_MAX_PIECE = 1024 * 1024
+# zstd的一个块最多解压出128KB，块头加内容至少4字节，压缩比上限约为32768；
+# zstd解压对象不能限制输出长度，每次只送入这么多输入，单次输出就不超过_MAX_PIECE
+_ZSTD_STEP = _MAX_PIECE // 32768
+
+
+class EncodingError(ValueError):
+    """请求体的Content-Encoding不支持，或解压失败"""
+
+
+class UnsupportedEncoding(EncodingError):
+    """不支持的Content-Encoding"""
+
+
+class BodyTooLarge(ValueError):
+    """解压后的请求体超过上限"""
+
+
+def supported_encodings() -> tuple:
+    """按优先级排列的可用压缩算法"""
+    return ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """根据Accept-Encoding选择压缩算法，客户端不接受任何可用算法时返回None"""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    best = None
+    best_quality = 0.0
+    for encoding in supported_encodings():
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """一次性压缩完整的响应体"""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+class StreamCompressor:
+    """流式压缩器：每次写入后立即刷新，输出的数据客户端可以马上解压，不跨块缓冲"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor().compressobj()
+            self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._flush_mode = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(self._flush_mode)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+async def compress_stream(chunks: AsyncIterator[bytes], encoding: str) -> AsyncIterator[bytes]:
+    """逐块压缩流式响应，每个数据块单独刷新（压缩上下文跨块共享）"""
+    compressor = StreamCompressor(encoding)
+    try:
+        async for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+def _zlib_pieces(decompressor, chunk: bytes) -> Iterator[bytes]:
+    """限制单次输出长度，逐段产出解压后的数据"""
+    while chunk:
+        data = decompressor.decompress(chunk, _MAX_PIECE)
+        chunk = decompressor.unconsumed_tail
+        if data:
+            yield data
+
+
+def _zstd_pieces(decompressor, chunk: bytes) -> Iterator[bytes]:
+    """把一块输入分成小段送入zstd解压对象，产出的每段数据约为_MAX_PIECE字节"""
+    view = memoryview(chunk)
+    piece = bytearray()
+    for start in range(0, len(view), _ZSTD_STEP):
+        if decompressor.eof:
+            raise EncodingError("请求体压缩数据之后有多余的数据")
+        piece += decompressor.decompress(view[start:start + _ZSTD_STEP])
+        if len(piece) >= _MAX_PIECE:
+            yield bytes(piece)
+            piece = bytearray()
+    if decompressor.unused_data:
+        raise EncodingError("请求体压缩数据之后有多余的数据")
+    if piece:
+        yield bytes(piece)
+
+
+async def decompress_stream(chunks: AsyncIterator[bytes], encoding: str, max_bytes: int) -> AsyncIterator[bytes]:
+    """边接收边解压请求体，解压后超过max_bytes时抛出BodyTooLarge，压缩数据不完整时抛出EncodingError"""
+    encoding = encoding.strip().lower()
+    if encoding in ("", "identity"):
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    if encoding in ("gzip", "x-gzip"):
+        decompressor, split = zlib.decompressobj(16 + zlib.MAX_WBITS), _zlib_pieces
+    elif encoding == "deflate":
+        decompressor, split = zlib.decompressobj(), _zlib_pieces
+    elif encoding == "zstd" and zstandard is not None:
+        decompressor, split = zstandard.ZstdDecompressor().decompressobj(), _zstd_pieces
+    else:
+        raise UnsupportedEncoding(f"不支持的Content-Encoding: {encoding}")
+
+    total = 0
+    errors = (zlib.error, zstandard.ZstdError) if zstandard is not None else (zlib.error,)
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            # 每解压出一段就检查总长度，压缩炸弹在超出上限后立即停止
+            for data in split(decompressor, chunk):
+                total += len(data)
+                if total > max_bytes:
+                    raise BodyTooLarge(f"解压后的请求体超过 {max_bytes} 字节")
+                yield data
+        if not decompressor.eof:
+            raise EncodingError("请求体压缩数据不完整")
+    except errors as e:
+        raise EncodingError(f"请求体解压失败: {e}") from e
+
@@ -2,15 +2,141 @@
 配置文件
 """
 import os
-from dotenv import load_dotenv
+import json
 
-load_dotenv()
+
+def _load_env_file() -> None:
+    """当前目录或本文件所在目录存在.env时才导入python-dotenv加载"""
+    for directory in (os.getcwd(), os.path.dirname(os.path.abspath(__file__))):
+        path = os.path.join(directory, ".env")
+        if os.path.isfile(path):
+            from dotenv import load_dotenv
+            load_dotenv(path)
+            return
+
+
+_load_env_file()
 
 # API配置 - 请在.env文件中设置
 API_KEY = os.getenv("API_KEY", "")
 MODEL_NAME = os.getenv("MODEL_NAME", "claude-3-sonnet-20240229")
 BASE_URL = os.getenv("BASE_URL", "https://api.anthropic.com")
 
+# 多上游配置（JSON数组），未设置时使用上面的 BASE_URL/API_KEY 作为唯一上游
+# 例: [{"name": "ark", "base_url": "...", "api_key": "...", "weight": 2, "max_concurrency": 20, "models": ["..."]}]
+UPSTREAMS = json.loads(os.getenv("UPSTREAMS", "") or "[]") or [
+    {"name": "default", "base_url": BASE_URL, "api_key": API_KEY}
+]
+# 连续失败（429/5xx/连接错误）达到次数后摘除上游，摘除时长（秒）
+UPSTREAM_EJECT_FAILURES = int(os.getenv("UPSTREAM_EJECT_FAILURES", "3"))
+UPSTREAM_EJECT_SECONDS = float(os.getenv("UPSTREAM_EJECT_SECONDS", "30"))
+
 # 服务器配置
 HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", "8080"))
+# worker进程数，大于1时响应缓存、限速令牌桶和指标通过共享状态服务在worker之间共享
+WORKERS = int(os.getenv("WORKERS", "1"))
+# 共享状态服务的Unix socket路径，为空时多worker模式自动使用临时目录
+SHARED_STATE_SOCKET = os.getenv("SHARED_STATE_SOCKET", "")
+# 事件循环和HTTP解析器，auto时安装了 uvloop/httptools 就使用
+SERVER_LOOP = os.getenv("SERVER_LOOP", "auto")
+SERVER_HTTP = os.getenv("SERVER_HTTP", "auto")
+# 启动时输出各模块的导入耗时
+STARTUP_REPORT = os.getenv("STARTUP_REPORT", "false").lower() in ("1", "true", "yes")
+
+# 上游连接池配置
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+# 启用HTTP/2需要安装 h2
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# 响应缓存配置（仅缓存temperature=0或通过请求头显式开启的非流式请求）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+# 磁盘缓存：响应缓存的第二级，保存在该目录中，重启和发布后仍然有效（为空时不启用）
+DISK_CACHE_DIR = os.getenv("DISK_CACHE_DIR", "")
+# 容量上限（字节）、单个分段文件大小（字节）、条目有效期（秒）、后台压缩间隔（秒）
+DISK_CACHE_MAX_BYTES = int(os.getenv("DISK_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+DISK_CACHE_SEGMENT_BYTES = int(os.getenv("DISK_CACHE_SEGMENT_BYTES", str(256 * 1024 ** 2)))
+DISK_CACHE_TTL = float(os.getenv("DISK_CACHE_TTL", "86400"))
+DISK_CACHE_COMPACT_INTERVAL = float(os.getenv("DISK_CACHE_COMPACT_INTERVAL", "60"))
+
+# 语义缓存：精确缓存未命中时，复用最后一条用户消息足够相似的请求的响应（需要安装 numpy，每个worker各自缓存）
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+# 余弦相似度阈值、条目数上限、TTL（秒）、向量维度
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "512"))
+
+# 请求合并：相同的并发请求只向上游发送一次
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# 流式增量合并：缓冲文本增量，达到字符数阈值或时间窗口后合并为一个SSE事件
+STREAM_COALESCE_DEFAULT = os.getenv("STREAM_COALESCE_DEFAULT", "false").lower() in ("1", "true", "yes")
+STREAM_COALESCE_MAX_CHARS = int(os.getenv("STREAM_COALESCE_MAX_CHARS", "256"))
+STREAM_COALESCE_WINDOW_MS = float(os.getenv("STREAM_COALESCE_WINDOW_MS", "20"))
+
+# 提示词缓存：为重复出现的工具定义、system和消息前缀自动加上cache_control断点（上游需支持Anthropic提示词缓存）
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+# 前缀估算token数低于该值时不加断点，记录的前缀哈希数量上限
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+PROMPT_CACHE_MAX_PREFIXES = int(os.getenv("PROMPT_CACHE_MAX_PREFIXES", "10000"))
+
+# 图片：把image_url图片下载并转为base64图片块（关闭时url图片直接交给上游）
+# 开启后代理会访问客户端给出的URL，只下载解析到公网地址的主机，建议同时设置允许的主机列表
+IMAGE_FETCH_ENABLED = os.getenv("IMAGE_FETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+# 允许下载的主机，逗号分隔，以 . 开头的条目匹配该域名及其子域名（为空时允许所有公网主机）
+IMAGE_FETCH_ALLOWED_HOSTS = [h.strip() for h in os.getenv("IMAGE_FETCH_ALLOWED_HOSTS", "").split(",") if h.strip()]
+# 长边超过该像素数时缩小（0为不缩放，需要安装 Pillow），单张图片下载大小上限（字节），下载超时（秒）
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1568"))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+IMAGE_FETCH_TIMEOUT = float(os.getenv("IMAGE_FETCH_TIMEOUT", "10"))
+# 图片缓存的内存上限（字节），设置目录后同时缓存到磁盘
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "")
+
+# 请求体不小于该字节数（或未给出Content-Length）时边接收边解析，需要安装 ijson
+REQUEST_STREAM_PARSE_MIN_BYTES = int(os.getenv("REQUEST_STREAM_PARSE_MIN_BYTES", str(1024 * 1024)))
+
+# 压缩：gzip/zstd请求体解压后的大小上限（字节）
+REQUEST_MAX_DECOMPRESSED_BYTES = int(os.getenv("REQUEST_MAX_DECOMPRESSED_BYTES", str(64 * 1024 * 1024)))
+# 按Accept-Encoding压缩非流式响应，小于该字节数的响应不压缩（zstd需要安装 zstandard）
+RESPONSE_COMPRESSION_ENABLED = os.getenv("RESPONSE_COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+# 压缩SSE流，每个事件写出时立即刷新
+SSE_COMPRESSION_ENABLED = os.getenv("SSE_COMPRESSION_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# 准入控制：每个模型的最大并发（0为不限制），可用JSON按模型单独设置
+ADMISSION_MODEL_CONCURRENCY = int(os.getenv("ADMISSION_MODEL_CONCURRENCY", "0"))
+ADMISSION_MODEL_LIMITS = json.loads(os.getenv("ADMISSION_MODEL_LIMITS", "") or "{}")
+# 排队队列长度、排队超时（秒），队列满时返回429并带上Retry-After（秒）
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "100"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+# 速率限制：根据上游的限流响应头在发送前限速（每个上游也可以在UPSTREAMS中用rpm/tpm设置初始限额）
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# 重试：连接错误、429、529和5xx按指数退避+抖动重试（秒）
+RETRY_MAX_RETRIES = int(os.getenv("RETRY_MAX_RETRIES", "2"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+
+# 对冲请求：非流式请求超过该模型延迟的百分位（至少HEDGE_MIN_DELAY_MS毫秒）仍未返回时，向另一个上游发送副本
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "200"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+# 批处理：上传文件和批处理状态的保存目录，轮询Anthropic批处理的间隔（秒）
+BATCH_DIR = os.getenv("BATCH_DIR", ".batches")
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "30"))
+# 单个Anthropic批处理的请求数和大小上限（字节），超过时拆分为多个批处理提交
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "10000"))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", str(128 * 1024 * 1024)))
+# 上传文件的大小上限（字节）
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", str(200 * 1024 * 1024)))
@@ -1,20 +1,272 @@
 """
 OpenAI <-> Anthropic 格式转换器
 """
-from typing import Dict, List, Any, Optional
+import json
+from typing import Dict, List, Any, Optional, Tuple
 from datetime import datetime
 
 
+# ---- OpenAI -> Anthropic 转换引擎 ----
+# 按内容块类型和消息角色预先建立分派表，一次遍历完成转换。
+# 相同的输入总是得到相同结构的输出：只有一个文本块的消息使用字符串，其余使用内容块列表，
+# 保证相同的提示词生成逐字节相同的上游请求，便于上游提示词缓存命中。
+
+
+class ConversionError(ValueError):
+    """消息内容的结构不合法，无法转换"""
+
+
+def _text_part(part: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    text = part.get("text") or ""
+    if not isinstance(text, str):
+        raise ConversionError("text内容块的text必须是字符串")
+    return {"type": "text", "text": text}
+
+
+def _image_url_part(part: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    image_url = part.get("image_url")
+    url = image_url.get("url", "") if isinstance(image_url, dict) else (image_url or "")
+    if not isinstance(url, str):
+        raise ConversionError("image_url内容块的url必须是字符串")
+    if url.startswith("data:"):
+        # data:image/png;base64,xxxx
+        header, _, data = url.partition(",")
+        media_type = header[5:].split(";", 1)[0] or "image/png"
+        return {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": data}}
+    return {"type": "image", "source": {"type": "url", "url": url}}
+
+
+# OpenAI内容块类型 -> 转换函数，未知类型的内容块会被忽略
+PART_CONVERTERS = {
+    "text": _text_part,
+    "input_text": _text_part,
+    "image_url": _image_url_part,
+}
+
+
+def _convert_content(content: Any) -> Any:
+    """转换单条消息的content：单个文本块返回字符串，否则返回内容块列表"""
+    if isinstance(content, str):
+        return content
+    if content is None:
+        return ""
+    if not isinstance(content, list):
+        return str(content)
+
+    blocks = []
+    for part in content:
+        if isinstance(part, str):
+            blocks.append({"type": "text", "text": part})
+            continue
+        if not isinstance(part, dict) or not isinstance(part.get("type"), str):
+            raise ConversionError("content中的每一项都必须是带type字段的对象或字符串")
+        converter = PART_CONVERTERS.get(part["type"])
+        if converter is not None:
+            block = converter(part)
+            if block is not None:
+                blocks.append(block)
+
+    if not blocks:
+        return ""
+    if len(blocks) == 1 and blocks[0]["type"] == "text":
+        return blocks[0]["text"]
+    return blocks
+
+
+def _content_text(content: Any) -> str:
+    """取出content中的纯文本（用于system和工具结果）"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        texts = []
+        for part in content:
+            if isinstance(part, str):
+                texts.append(part)
+            elif not isinstance(part, dict):
+                raise ConversionError("content中的每一项都必须是对象或字符串")
+            elif part.get("type") in ("text", "input_text"):
+                texts.append(_text_part(part)["text"])
+        return "\n".join(texts)
+    return "" if content is None else str(content)
+
+
+def _as_blocks(content: Any) -> List[Dict[str, Any]]:
+    if isinstance(content, list):
+        return content
+    return [{"type": "text", "text": content}] if content else []
+
+
+def _tool_use_block(call: Dict[str, Any]) -> Dict[str, Any]:
+    if not isinstance(call, dict) or not isinstance(call.get("function") or {}, dict):
+        raise ConversionError("tool_calls中的每一项都必须是带function对象的对象")
+    function = call.get("function") or {}
+    arguments = function.get("arguments") or "{}"
+    try:
+        tool_input = json.loads(arguments) if isinstance(arguments, str) else arguments
+    except ValueError as e:
+        raise ConversionError("tool_calls中function的arguments必须是合法的JSON") from e
+    if not isinstance(tool_input, dict):
+        raise ConversionError("tool_calls中function的arguments必须是JSON对象")
+    return {"type": "tool_use", "id": call.get("id", ""), "name": function.get("name", ""), "input": tool_input}
+
+
+def _system_message(msg, system_parts, messages) -> None:
+    system_parts.append(_content_text(msg.get("content")))
+
+
+def _chat_message(msg, system_parts, messages) -> None:
+    messages.append({"role": msg.get("role"), "content": _convert_content(msg.get("content"))})
+
+
+def _assistant_message(msg, system_parts, messages) -> None:
+    content = _convert_content(msg.get("content"))
+    tool_calls = msg.get("tool_calls")
+    if tool_calls:
+        if not isinstance(tool_calls, list):
+            raise ConversionError("tool_calls必须是数组")
+        content = _as_blocks(content)
+        content.extend(_tool_use_block(call) for call in tool_calls)
+    messages.append({"role": "assistant", "content": content})
+
+
+def _tool_message(msg, system_parts, messages) -> None:
+    block = {"type": "tool_result", "tool_use_id": msg.get("tool_call_id", ""),
+             "content": _content_text(msg.get("content"))}
+    previous = messages[-1] if messages else None
+    # 连续的工具结果合并到同一条user消息中
+    if (previous is not None and previous["role"] == "user" and isinstance(previous["content"], list)
+            and previous["content"] and previous["content"][-1].get("type") == "tool_result"):
+        previous["content"].append(block)
+    else:
+        messages.append({"role": "user", "content": [block]})
+
+
+# OpenAI消息角色 -> 处理函数，未知角色按普通消息处理
+ROLE_HANDLERS = {
+    "system": _system_message,
+    "developer": _system_message,
+    "user": _chat_message,
+    "assistant": _assistant_message,
+    "tool": _tool_message,
+}
+
+
+def convert_message(msg: Dict[str, Any], system_parts: List[str], anthropic_messages: List[Dict[str, Any]]) -> None:
+    """转换单条OpenAI消息，追加到anthropic_messages中（system消息追加到system_parts中）"""
+    ROLE_HANDLERS.get(msg.get("role"), _chat_message)(msg, system_parts, anthropic_messages)
+
+
+def join_system(system_parts: List[str]) -> Optional[str]:
+    """用空行拼接system提示词"""
+    return "\n\n".join(system_parts) if system_parts else None
+
+
+def convert_tools(tools: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """转换OpenAI的tools（只支持function类型）为Anthropic工具定义"""
+    anthropic_tools = []
+    for index, tool in enumerate(tools):
+        if not isinstance(tool, dict) or tool.get("type", "function") != "function":
+            raise ConversionError(f"tools[{index}]的type必须是function")
+        function = tool.get("function")
+        if not isinstance(function, dict):
+            raise ConversionError(f"tools[{index}]缺少function对象")
+        anthropic_tool = {
+            "name": function.get("name", ""),
+            "input_schema": function.get("parameters") or {"type": "object", "properties": {}},
+        }
+        if function.get("description"):
+            anthropic_tool["description"] = function["description"]
+        anthropic_tools.append(anthropic_tool)
+    return anthropic_tools
+
+
+def convert_tool_choice(tool_choice: Any, parallel_tool_calls: Optional[bool] = None) -> Optional[Dict[str, Any]]:
+    """转换OpenAI的tool_choice：auto/none/required/指定函数，parallel_tool_calls为False时禁止并行调用"""
+    if isinstance(tool_choice, dict):
+        name = (tool_choice.get("function") or {}).get("name")
+        choice = {"type": "tool", "name": name} if name else {"type": "auto"}
+    elif tool_choice == "required":
+        choice = {"type": "any"}
+    elif tool_choice == "none":
+        return {"type": "none"}
+    elif tool_choice == "auto" or parallel_tool_calls is False:
+        choice = {"type": "auto"}
+    else:
+        return None
+    if parallel_tool_calls is False:
+        choice["disable_parallel_tool_use"] = True
+    return choice
+
+
+# Anthropic停止原因 -> OpenAI finish_reason
+STOP_REASONS = {
+    "end_turn": "stop",
+    "stop_sequence": "stop",
+    "max_tokens": "length",
+    "tool_use": "tool_calls",
+    "refusal": "content_filter",
+}
+
+
+def _field(block: Any, name: str) -> Any:
+    """内容块可以是SDK对象，也可以是字典"""
+    return block.get(name) if isinstance(block, dict) else getattr(block, name, None)
+
+
+def convert_response_content(content: Any) -> Dict[str, Any]:
+    """把Anthropic响应的内容块转换为OpenAI的assistant消息
+
+    文本块拼接为content，思考块拼接为reasoning_content，tool_use块转为tool_calls。
+    """
+    texts = []
+    thinking = []
+    tool_calls = []
+    for block in content or ():
+        block_type = _field(block, "type")
+        if block_type == "text":
+            texts.append(_field(block, "text") or "")
+        elif block_type == "thinking":
+            thinking.append(_field(block, "thinking") or "")
+        elif block_type == "tool_use":
+            tool_calls.append({
+                "id": _field(block, "id"),
+                "type": "function",
+                "function": {
+                    "name": _field(block, "name"),
+                    "arguments": json.dumps(_field(block, "input") or {}, ensure_ascii=False),
+                },
+            })
+    message = {"role": "assistant", "content": "".join(texts) if texts or not tool_calls else None}
+    if thinking:
+        message["reasoning_content"] = "".join(thinking)
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+    return message
+
+
+def convert_messages(messages: List[Dict[str, Any]], system: Optional[str] = None) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+    """转换OpenAI消息列表，返回 (system, Anthropic消息列表)
+
+    system消息会从列表中取出，与显式传入的system按顺序用空行拼接。
+    """
+    system_parts = [system] if system else []
+    anthropic_messages: List[Dict[str, Any]] = []
+    for msg in messages:
+        convert_message(msg, system_parts, anthropic_messages)
+    return join_system(system_parts), anthropic_messages
+
+
 class OpenAIToAnthropicConverter:
     """OpenAI请求转Anthropic格式"""
 
     @staticmethod
     def convert_request(openai_request: Dict[str, Any]) -> Dict[str, Any]:
         """转换OpenAI请求为Anthropic格式"""
+        system, messages = convert_messages(openai_request.get("messages", []), openai_request.get("system"))
         anthropic_request = {
             "model": openai_request.get("model", "claude-3-sonnet-20240229"),
             "max_tokens": openai_request.get("max_tokens", 4096),
-            "messages": OpenAIToAnthropicConverter._convert_messages(openai_request.get("messages", []))
+            "messages": messages,
         }
 
         # 可选参数
@@ -24,53 +276,17 @@ class OpenAIToAnthropicConverter:
             anthropic_request["top_p"] = openai_request["top_p"]
         if "stream" in openai_request:
             anthropic_request["stream"] = openai_request["stream"]
-        if "system" in openai_request:
-            anthropic_request["system"] = openai_request["system"]
+        if system:
+            anthropic_request["system"] = system
+        if openai_request.get("tools"):
+            anthropic_request["tools"] = convert_tools(openai_request["tools"])
+            tool_choice = convert_tool_choice(
+                openai_request.get("tool_choice"), openai_request.get("parallel_tool_calls"))
+            if tool_choice is not None:
+                anthropic_request["tool_choice"] = tool_choice
 
         return anthropic_request
 
-    @staticmethod
-    def _convert_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """转换消息格式"""
-        anthropic_messages = []
-
-        for msg in messages:
-            role = msg.get("role")
-            content = msg.get("content")
-
-            # 跳过system消息（Anthropic不放在messages中）
-            if role == "system":
-                continue
-
-            # 转换content为Anthropic格式
-            if isinstance(content, str):
-                anthropic_content = [{"type": "text", "text": content}]
-            elif isinstance(content, list):
-                anthropic_content = []
-                for item in content:
-                    if item.get("type") == "text":
-                        anthropic_content.append({
-                            "type": "text",
-                            "text": item.get("text", "")
-                        })
-                    elif item.get("type") == "image_url":
-                        # 简化处理图片
-                        anthropic_content.append({
-                            "type": "text",
-                            "text": f"[Image: {item.get('image_url', {}).get('url', '')}]"
-                        })
-                if not anthropic_content:
-                    anthropic_content = [{"type": "text", "text": ""}]
-            else:
-                anthropic_content = [{"type": "text", "text": str(content)}]
-
-            anthropic_messages.append({
-                "role": role,
-                "content": anthropic_content
-            })
-
-        return anthropic_messages
-
 
 class AnthropicToOpenAIConverter:
     """Anthropic响应转OpenAI格式"""
@@ -78,15 +294,6 @@ class AnthropicToOpenAIConverter:
     @staticmethod
     def convert_response(anthropic_response: Dict[str, Any], model: str) -> Dict[str, Any]:
         """转换Anthropic响应为OpenAI格式"""
-        # 提取文本内容
-        content = anthropic_response.get("content", [])
-        text_content = ""
-        if content and isinstance(content, list):
-            for item in content:
-                if item.get("type") == "text":
-                    text_content = item.get("text", "")
-                    break
-
         openai_response = {
             "id": anthropic_response.get("id", f"chatcmpl-{datetime.now().timestamp()}"),
             "object": "chat.completion",
@@ -94,10 +301,7 @@ class AnthropicToOpenAIConverter:
             "model": model,
             "choices": [{
                 "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": text_content
-                },
+                "message": convert_response_content(anthropic_response.get("content")),
                 "finish_reason": AnthropicToOpenAIConverter._convert_stop_reason(
                     anthropic_response.get("stop_reason", "end_turn")
                 )
@@ -117,19 +321,21 @@ class AnthropicToOpenAIConverter:
     @staticmethod
     def _convert_stop_reason(stop_reason: str) -> str:
         """转换停止原因"""
-        mapping = {
-            "end_turn": "stop",
-            "max_tokens": "length",
-            "stop_sequence": "stop"
-        }
-        return mapping.get(stop_reason, "stop")
+        return STOP_REASONS.get(stop_reason, "stop")
 
     @staticmethod
     def convert_stream_chunk(chunk: Dict[str, Any], model: str) -> Optional[Dict[str, Any]]:
-        """转换流式响应块"""
+        """转换单个流式事件（不跟踪工具调用序号，代理的流式响应使用 sse.StreamTranslator）"""
         chunk_type = chunk.get("type")
 
         if chunk_type == "content_block_delta":
+            delta = chunk.get("delta", {})
+            if delta.get("type", "text_delta") == "text_delta":
+                delta = {"content": delta.get("text", "")}
+            elif delta.get("type") == "thinking_delta":
+                delta = {"reasoning_content": delta.get("thinking", "")}
+            else:
+                return None
             return {
                 "id": f"chatcmpl-{datetime.now().timestamp()}",
                 "object": "chat.completion.chunk",
@@ -137,13 +343,11 @@ class AnthropicToOpenAIConverter:
                 "model": model,
                 "choices": [{
                     "index": 0,
-                    "delta": {
-                        "content": chunk.get("delta", {}).get("text", "")
-                    },
+                    "delta": delta,
                     "finish_reason": None
                 }]
             }
-        elif chunk_type == "message_stop":
+        elif chunk_type == "message_delta":
             return {
                 "id": f"chatcmpl-{datetime.now().timestamp()}",
                 "object": "chat.completion.chunk",
@@ -152,7 +356,9 @@ class AnthropicToOpenAIConverter:
                 "choices": [{
                     "index": 0,
                     "delta": {},
-                    "finish_reason": "stop"
+                    "finish_reason": AnthropicToOpenAIConverter._convert_stop_reason(
+                        chunk.get("delta", {}).get("stop_reason") or "end_turn"
+                    )
                 }]
             }
         elif chunk_type == "message_start":
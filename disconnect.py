@@ -0,0 +1,99 @@
+"""
+客户端断开检测 - 后台监听ASGI的http.disconnect消息，客户端断开后立即取消等待上游的任务和正在输出的流
+不依赖服务器的ASGI规范版本（2.4及以上的服务器不会主动通知，只有写入失败时才能发现断开）
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Optional
+
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+
+class ClientDisconnected(Exception):
+    """等待期间客户端已断开"""
+
+
+class DisconnectWatcher:
+    """监听单个请求的客户端断开（需要在请求体读取完之后启动）"""
+
+    def __init__(self, receive: Receive):
+        self._receive = receive
+        self.disconnected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> "DisconnectWatcher":
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+        return self
+
+    async def _watch(self) -> None:
+        while True:
+            message = await self._receive()
+            if message["type"] == "http.disconnect":
+                self.disconnected.set()
+                return
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    async def run(self, awaitable: Awaitable[Any]) -> Any:
+        """等待awaitable完成，客户端先断开时取消它并抛出ClientDisconnected"""
+        task = asyncio.ensure_future(awaitable)
+        disconnected = asyncio.ensure_future(self.disconnected.wait())
+        try:
+            await asyncio.wait((task, disconnected), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            disconnected.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            raise ClientDisconnected("客户端已断开")
+        return task.result()
+
+
+class DisconnectAwareStreamingResponse(StreamingResponse):
+    """客户端断开时立即取消输出任务（关闭响应体生成器，从而关闭上游流），并调用on_disconnect"""
+
+    def __init__(
+        self,
+        content: Any,
+        watcher: DisconnectWatcher,
+        on_disconnect: Optional[Callable[[], None]] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(content, **kwargs)
+        self.watcher = watcher
+        self.on_disconnect = on_disconnect
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.watcher.start()
+        task = asyncio.ensure_future(self.stream_response(send))
+        disconnected = asyncio.ensure_future(self.watcher.disconnected.wait())
+        try:
+            await asyncio.wait((task, disconnected), return_when=asyncio.FIRST_COMPLETED)
+            if not task.done():
+                task.cancel()
+                if self.on_disconnect is not None:
+                    self.on_disconnect()
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not self.watcher.disconnected.is_set():
+                    raise
+            except OSError:
+                # 写入已断开的连接（ASGI 2.4）
+                if self.on_disconnect is not None:
+                    self.on_disconnect()
+                return
+        finally:
+            disconnected.cancel()
+            if not task.done():
+                task.cancel()
+            self.watcher.stop()
+
+        if self.background is not None:
+            await self.background()
@@ -0,0 +1,493 @@
+"""
+磁盘缓存 - 响应缓存的第二级，重启和发布后仍然有效
+
+条目追加写入分段文件，哈希索引是通过mmap访问的开放寻址表，内容和索引都只在文件和系统页缓存中，容量不占用Python堆。
+超出容量时删除最旧的分段；后台线程定期把有效数据比例过低的分段中仍有效的条目复制到当前分段，再删除旧分段。
+同一目录同时只能由一个进程使用（文件锁）。拿不到锁时（如滚动发布期间旧进程还未退出）不使用磁盘缓存，后台线程定期重试。
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+# 记录头：魔数、键摘要、过期时间（Unix时间戳）、内容长度、内容crc32，后接内容
+_RECORD = struct.Struct("<4s32sdII")
+_RECORD_MAGIC = b"PXR1"
+# 索引文件头：魔数、版本、槽位数
+_INDEX_HEADER = struct.Struct("<4sIQ")
+_INDEX_MAGIC = b"PXI1"
+_INDEX_VERSION = 1
+_HEADER_SIZE = 64
+# 索引槽位：键摘要前16字节、分段号、记录长度（含记录头）、记录偏移、过期时间
+_SLOT = struct.Struct("<16sIIQd")
+_EMPTY = 0
+_TOMBSTONE = 0xFFFFFFFF
+# 已用槽位（含墓碑）超过该比例时重建索引
+_MAX_LOAD = 0.75
+# 拿不到目录锁时重试的间隔（秒）
+_RETRY_INTERVAL = 5.0
+_INDEX_FILE = "index"
+_LOCK_FILE = "lock"
+_SEGMENT_SUFFIX = ".seg"
+
+
+def _digest(key: str) -> bytes:
+    return hashlib.sha256(key.encode("utf-8")).digest()
+
+
+def _initial_slots(max_bytes: int) -> int:
+    # 按平均每个条目4KB估算，取2的幂
+    slots = 4096
+    while slots < max_bytes // 4096:
+        slots *= 2
+    return slots
+
+
+class _Index:
+    """mmap上的开放寻址哈希表（线性探测），槽位数为2的幂"""
+
+    def __init__(self, path: str, slots: Optional[int] = None):
+        """slots为None时打开已有的索引文件（格式不对时抛出ValueError），否则新建"""
+        if slots is not None:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.ftruncate(fd, _HEADER_SIZE + slots * _SLOT.size)
+            os.pwrite(fd, _INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, slots), 0)
+        else:
+            fd = os.open(path, os.O_RDWR)
+        try:
+            size = os.fstat(fd).st_size
+            if size < _HEADER_SIZE:
+                raise ValueError("索引文件不完整")
+            magic, version, slots = _INDEX_HEADER.unpack(os.pread(fd, _INDEX_HEADER.size, 0))
+            if magic != _INDEX_MAGIC or version != _INDEX_VERSION or slots & (slots - 1) \
+                    or size != _HEADER_SIZE + slots * _SLOT.size:
+                raise ValueError("索引文件格式不正确")
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.path = path
+        self.slots = slots
+        # 非空槽位数（含墓碑），打开后由 scan() 统计
+        self.used = 0
+
+    def position(self, slot: int) -> int:
+        return _HEADER_SIZE + slot * _SLOT.size
+
+    def read(self, slot: int) -> Tuple[bytes, int, int, int, float]:
+        return _SLOT.unpack_from(self.map, self.position(slot))
+
+    def write(self, slot: int, fingerprint: bytes, segment: int, length: int, offset: int, expires: float) -> None:
+        if _SLOT.unpack_from(self.map, self.position(slot))[1] == _EMPTY:
+            self.used += 1
+        _SLOT.pack_into(self.map, self.position(slot), fingerprint, segment, length, offset, expires)
+
+    def clear(self, slot: int) -> None:
+        """把槽位标记为墓碑（探测链不能在此中断）"""
+        _SLOT.pack_into(self.map, self.position(slot), b"", _TOMBSTONE, 0, 0, 0.0)
+
+    def find(self, fingerprint: bytes) -> Tuple[int, int]:
+        """返回 (命中的槽位, -1)，未命中时返回 (-1, 可写入的槽位)"""
+        mask = self.slots - 1
+        slot = int.from_bytes(fingerprint[:8], "little") & mask
+        free = -1
+        while True:
+            key, segment = _SLOT.unpack_from(self.map, self.position(slot))[:2]
+            if segment == _EMPTY:
+                return -1, (slot if free < 0 else free)
+            if segment == _TOMBSTONE:
+                if free < 0:
+                    free = slot
+            elif key == fingerprint:
+                return slot, -1
+            slot = (slot + 1) & mask
+
+    def scan(self):
+        """遍历所有条目，返回 (槽位, 键摘要前缀, 分段号, 记录长度, 记录偏移, 过期时间)，同时统计非空槽位数"""
+        self.used = 0
+        view = memoryview(self.map)[_HEADER_SIZE:]
+        try:
+            for slot, (key, segment, length, offset, expires) in enumerate(_SLOT.iter_unpack(view)):
+                if segment == _EMPTY:
+                    continue
+                self.used += 1
+                if segment != _TOMBSTONE:
+                    yield slot, key, segment, length, offset, expires
+        finally:
+            view.release()
+
+    def flush(self) -> None:
+        self.map.flush()
+
+    def close(self) -> None:
+        self.map.close()
+
+
+class DiskCache:
+    """按键存取字节串的磁盘缓存，线程安全（后台线程负责打开目录和压缩）"""
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 10 * 1024 ** 3,
+        segment_bytes: int = 256 * 1024 ** 2,
+        ttl: float = 86400.0,
+        compact_interval: float = 60.0,
+        compact_ratio: float = 0.5,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.ttl = ttl
+        self.compact_interval = compact_interval
+        # 分段中有效数据低于该比例时压缩
+        self.compact_ratio = compact_ratio
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._ready = False
+        self._lock_fd: Optional[int] = None
+        self._index: Optional[_Index] = None
+        # 分段号 -> 文件描述符、文件大小、[有效字节数, 有效条目数]
+        self._segments: Dict[int, int] = {}
+        self._sizes: Dict[int, int] = {}
+        self._live: Dict[int, List[int]] = {}
+        self._active = 0
+        self._total = 0
+
+    @property
+    def ready(self) -> bool:
+        """是否已拿到目录锁并加载完成"""
+        return self._ready
+
+    def __len__(self) -> int:
+        return sum(entries for _, entries in self._live.values())
+
+    @property
+    def size_bytes(self) -> int:
+        return self._total
+
+    def start(self) -> "DiskCache":
+        """在后台线程中打开目录（加载大索引不阻塞启动），之后定期压缩"""
+        if self._thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name="disk-cache", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            if self._index is not None:
+                self._index.flush()
+            self._reset()
+
+    def _reset(self) -> None:
+        """关闭所有文件并释放目录锁"""
+        self._ready = False
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        for fd in self._segments.values():
+            os.close(fd)
+        self._segments.clear()
+        self._sizes.clear()
+        self._live.clear()
+        self._total = 0
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def get(self, key: str) -> Optional[bytes]:
+        """读取条目，过期、已被淘汰或校验失败的条目视为未命中"""
+        if not self._ready:
+            return None
+        digest = _digest(key)
+        with self._lock:
+            if not self._ready:
+                return None
+            slot, _ = self._index.find(digest[:16])
+            if slot < 0:
+                self.misses += 1
+                return None
+            _, segment, length, offset, expires = self._index.read(slot)
+            value = None
+            if expires > time.time() and segment in self._segments:
+                value = self._read(segment, offset, length, digest)
+            if value is None:
+                self._drop(slot)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        """追加写入条目，超出容量时删除最旧的分段"""
+        if not self._ready or _RECORD.size + len(value) > self.segment_bytes:
+            return
+        digest = _digest(key)
+        expires = time.time() + self.ttl
+        record = _RECORD.pack(_RECORD_MAGIC, digest, expires, len(value), zlib.crc32(value)) + value
+        with self._lock:
+            if not self._ready:
+                return
+            self._append(digest, expires, record)
+            self._evict()
+
+    def _run(self) -> None:
+        while not self._ready:
+            try:
+                if self._open():
+                    break
+            except OSError:
+                pass
+            if self._stop.wait(_RETRY_INTERVAL):
+                return
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.compact()
+                with self._lock:
+                    if self._ready:
+                        self._index.flush()
+            except OSError:
+                pass
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:08d}{_SEGMENT_SUFFIX}")
+
+    def _open(self) -> bool:
+        """拿到目录锁后加载分段和索引，目录被其它进程占用时返回False"""
+        fd = os.open(os.path.join(self.directory, _LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        with self._lock:
+            if self._stop.is_set():
+                os.close(fd)
+                return True
+            self._lock_fd = fd
+            try:
+                self._load()
+            except BaseException:
+                self._reset()
+                raise
+            self._ready = True
+        return True
+
+    def _load(self) -> None:
+        segments = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(_SEGMENT_SUFFIX) and name[:-len(_SEGMENT_SUFFIX)].isdigit()
+        )
+        for segment in segments:
+            self._add_segment(segment)
+
+        path = os.path.join(self.directory, _INDEX_FILE)
+        tmp = path + ".tmp"
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        try:
+            self._index = _Index(path)
+        except (OSError, ValueError):
+            # 索引丢失或损坏时从分段重建
+            self._index = None
+
+        if self._index is None:
+            self._index = _Index(tmp, _initial_slots(self.max_bytes))
+            for segment in segments:
+                self._replay(segment)
+            os.replace(tmp, path)
+            self._index.path = path
+        else:
+            now = time.time()
+            for slot, _, segment, length, _, expires in self._index.scan():
+                if segment not in self._segments or expires <= now:
+                    self._index.clear(slot)
+                    continue
+                live = self._live[segment]
+                live[0] += length
+                live[1] += 1
+
+        if not segments or self._sizes[segments[-1]] >= self.segment_bytes:
+            self._roll()
+        else:
+            self._active = segments[-1]
+        self._evict()
+
+    def _add_segment(self, segment: int) -> None:
+        fd = os.open(self._segment_path(segment), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(fd).st_size
+        self._segments[segment] = fd
+        self._sizes[segment] = size
+        self._live[segment] = [0, 0]
+        self._total += size
+
+    def _roll(self) -> None:
+        """新建分段作为当前写入的分段"""
+        self._active = max(self._segments, default=0) + 1
+        self._add_segment(self._active)
+
+    def _replay(self, segment: int) -> None:
+        """重建索引时顺序读取分段中的记录（按分段号从旧到新，新记录覆盖旧记录），截掉末尾不完整的记录"""
+        fd = self._segments[segment]
+        size = self._sizes[segment]
+        now = time.time()
+        offset = 0
+        while offset + _RECORD.size <= size:
+            magic, digest, expires, length, _ = _RECORD.unpack(os.pread(fd, _RECORD.size, offset))
+            end = offset + _RECORD.size + length
+            if magic != _RECORD_MAGIC or end > size:
+                break
+            slot, free = self._index.find(digest[:16])
+            if slot >= 0:
+                self._unlink(slot)
+            if expires > now:
+                self._link(slot if slot >= 0 else free, digest, segment, end - offset, offset, expires)
+            elif slot >= 0:
+                self._index.clear(slot)
+            offset = end
+        if offset < size:
+            os.ftruncate(fd, offset)
+            self._total -= size - offset
+            self._sizes[segment] = offset
+
+    def _read(self, segment: int, offset: int, length: int, digest: bytes) -> Optional[bytes]:
+        data = os.pread(self._segments[segment], length, offset)
+        if len(data) != length:
+            return None
+        magic, key, _, size, crc = _RECORD.unpack_from(data)
+        value = data[_RECORD.size:]
+        if magic != _RECORD_MAGIC or key != digest or size != len(value) or zlib.crc32(value) != crc:
+            return None
+        return value
+
+    def _link(self, slot: int, digest: bytes, segment: int, length: int, offset: int, expires: float) -> None:
+        self._index.write(slot, digest[:16], segment, length, offset, expires)
+        live = self._live[segment]
+        live[0] += length
+        live[1] += 1
+        if self._index.used > self._index.slots * _MAX_LOAD:
+            self._rehash()
+
+    def _unlink(self, slot: int) -> None:
+        """从有效数据统计中去掉槽位指向的记录（不修改槽位）"""
+        _, segment, length, _, _ = self._index.read(slot)
+        live = self._live.get(segment)
+        if live is not None:
+            live[0] -= length
+            live[1] -= 1
+
+    def _drop(self, slot: int) -> None:
+        self._unlink(slot)
+        self._index.clear(slot)
+
+    def _append(self, digest: bytes, expires: float, record: bytes) -> None:
+        if self._sizes[self._active] + len(record) > self.segment_bytes:
+            self._roll()
+        segment = self._active
+        offset = self._sizes[segment]
+        written = os.write(self._segments[segment], record)
+        self._sizes[segment] += written
+        self._total += written
+        if written != len(record):
+            # 磁盘已满等情况，不完整的记录留在分段中，读取时校验失败
+            return
+
+        slot, free = self._index.find(digest[:16])
+        if slot >= 0:
+            self._unlink(slot)
+        else:
+            slot = free
+        self._link(slot, digest, segment, len(record), offset, expires)
+
+    def _evict(self) -> None:
+        while self._total > self.max_bytes and len(self._segments) > 1:
+            oldest = min(self._segments)
+            if oldest == self._active:
+                break
+            self._remove_segment(oldest)
+
+    def _remove_segment(self, segment: int) -> None:
+        # 指向该分段的槽位在读取或重建索引时清除
+        os.close(self._segments.pop(segment))
+        self._total -= self._sizes.pop(segment)
+        self._live.pop(segment)
+        os.unlink(self._segment_path(segment))
+
+    def _rehash(self) -> None:
+        """重建索引文件：去掉墓碑和失效的条目，有效条目超过一半槽位时扩容为两倍"""
+        old = self._index
+        slots = old.slots
+        if len(self) * 2 > slots:
+            slots *= 2
+        tmp = old.path + ".tmp"
+        index = _Index(tmp, slots)
+        now = time.time()
+        for slot, key, segment, length, offset, expires in old.scan():
+            if segment in self._segments and expires > now:
+                _, free = index.find(key)
+                index.write(free, key, segment, length, offset, expires)
+            else:
+                self._unlink(slot)
+        old.close()
+        os.replace(tmp, old.path)
+        index.path = old.path
+        self._index = index
+
+    def compact(self) -> int:
+        """压缩有效数据比例过低的分段，返回删除的分段数"""
+        with self._lock:
+            if not self._ready:
+                return 0
+            candidates = [
+                segment for segment in sorted(self._segments)
+                if segment != self._active and self._live[segment][0] < self._sizes[segment] * self.compact_ratio
+            ]
+        removed = 0
+        for segment in candidates:
+            if self._stop.is_set():
+                break
+            if self._compact_segment(segment):
+                removed += 1
+        return removed
+
+    def _compact_segment(self, segment: int) -> bool:
+        """把分段中仍有效的条目逐个复制到当前分段（每条记录单独加锁，不长时间阻塞读写），然后删除分段"""
+        offset = 0
+        while True:
+            with self._lock:
+                if not self._ready or segment not in self._segments:
+                    return False
+                if offset + _RECORD.size > self._sizes[segment]:
+                    self._remove_segment(segment)
+                    return True
+                fd = self._segments[segment]
+                magic, digest, expires, length, _ = _RECORD.unpack(os.pread(fd, _RECORD.size, offset))
+                if magic != _RECORD_MAGIC:
+                    # 记录损坏，剩余部分无法解析
+                    self._remove_segment(segment)
+                    return True
+                size = _RECORD.size + length
+                slot, _ = self._index.find(digest[:16])
+                if slot >= 0:
+                    _, current, _, current_offset, _ = self._index.read(slot)
+                    if current == segment and current_offset == offset:
+                        record = os.pread(fd, size, offset)
+                        if expires > time.time() and len(record) == size:
+                            self._append(digest, expires, record)
+                        else:
+                            self._drop(slot)
+                offset += size
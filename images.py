@@ -0,0 +1,404 @@
+"""
+图片处理 - 下载image_url图片并转为Anthropic的base64图片块，带内容寻址缓存和可选的缩放
+"""
+import asyncio
+import base64
+import hashlib
+import importlib.util
+import io
+import ipaddress
+import logging
+import os
+import socket
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# 由_load_pil在第一次缩放图片时导入，Pillow为可选依赖
+Image = None
+_pil_installed: Optional[bool] = None
+
+from coalesce import SingleFlight
+
+# Anthropic支持的图片格式
+SUPPORTED_MEDIA_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp")
+_PIL_FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+# 下载图片最多跟随的重定向次数
+MAX_REDIRECTS = 5
+_FETCH_FAILED = "下载图片失败"
+
+logger = logging.getLogger(__name__)
+
+
+class ImageError(ValueError):
+    """图片无法下载、过大或格式不支持"""
+
+
+def _httpx():
+    # 第一次下载图片时才导入
+    try:
+        # anthropic>=1.0 基于 httpx2，旧版本基于 httpx
+        import httpx2 as httpx
+    except ImportError:
+        import httpx
+    return httpx
+
+
+def sniff_media_type(data: bytes) -> Optional[str]:
+    """根据文件头识别图片格式"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def pil_available() -> bool:
+    """是否安装了Pillow（只查找，不导入）"""
+    global _pil_installed
+    if _pil_installed is None:
+        _pil_installed = importlib.util.find_spec("PIL") is not None
+    return _pil_installed
+
+
+def _load_pil() -> bool:
+    """导入Pillow，未安装时返回False"""
+    global Image
+    if Image is None and pil_available():
+        from PIL import Image as module
+        Image = module
+    return Image is not None
+
+
+def downscale(data: bytes, media_type: str, max_edge: int) -> Tuple[bytes, str]:
+    """长边超过max_edge时等比缩小，未安装Pillow或无需缩放时原样返回"""
+    if max_edge <= 0 or media_type not in _PIL_FORMATS or not _load_pil():
+        return data, media_type
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if max(image.size) <= max_edge:
+                return data, media_type
+            image.thumbnail((max_edge, max_edge))
+            if media_type == "image/jpeg" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            output = io.BytesIO()
+            image.save(output, format=_PIL_FORMATS[media_type])
+    except (OSError, ValueError):
+        # 无法解码的图片交给上游判断
+        return data, media_type
+    return output.getvalue(), media_type
+
+
+class ImageCache:
+    """内容寻址的图片缓存
+
+    以原始图片内容的sha256为键保存处理后的base64数据（内存LRU，可选落盘），
+    另外记录URL到内容哈希的映射，重复出现的URL不再下载。磁盘读写在线程中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, directory: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._blobs: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        self._urls: "OrderedDict[str, str]" = OrderedDict()
+        self._bytes = 0
+        if directory:
+            os.makedirs(os.path.join(directory, "urls"), exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._blobs)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(self.directory, "urls", hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    async def get_url(self, url: str) -> Optional[Tuple[str, str]]:
+        """按URL查找，返回 (media_type, base64数据)"""
+        digest = self._urls.get(url)
+        if digest is None and self.directory:
+            data = await asyncio.to_thread(_read_file, self._url_path(url))
+            digest = data.decode("ascii").strip() if data is not None else None
+        if digest is None:
+            return None
+        entry = await self.get(digest)
+        if entry is not None:
+            await self.link_url(url, digest)
+        return entry
+
+    async def get(self, digest: str) -> Optional[Tuple[str, str]]:
+        """按原始内容哈希查找，返回 (media_type, base64数据)"""
+        entry = self._blobs.get(digest)
+        if entry is not None:
+            self._blobs.move_to_end(digest)
+            return entry
+        if not self.directory:
+            return None
+        data = await asyncio.to_thread(_read_file, os.path.join(self.directory, digest))
+        if data is None:
+            return None
+        media_type, _, data = data.partition(b"\n")
+        entry = (media_type.decode("ascii"), data.decode("ascii"))
+        self._store(digest, entry)
+        return entry
+
+    async def set(self, digest: str, media_type: str, data: str, url: Optional[str] = None) -> None:
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        self._store(digest, (media_type, data))
+        if self.directory:
+            content = media_type.encode("ascii") + b"\n" + data.encode("ascii")
+            await asyncio.to_thread(_write_file, os.path.join(self.directory, digest), content)
+        if url is not None:
+            await self.link_url(url, digest)
+
+    def _store(self, digest: str, entry: Tuple[str, str]) -> None:
+        size = len(entry[1])
+        if size > self.max_bytes:
+            return
+        old = self._blobs.pop(digest, None)
+        if old is not None:
+            self._bytes -= len(old[1])
+        self._blobs[digest] = entry
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, data) = self._blobs.popitem(last=False)
+            self._bytes -= len(data)
+
+    async def link_url(self, url: str, digest: str) -> None:
+        """记录URL对应的图片内容哈希"""
+        if self._urls.get(url) == digest:
+            self._urls.move_to_end(url)
+            return
+        self._urls[url] = digest
+        # URL映射只保存哈希，条目数按图片数量的若干倍限制
+        while len(self._urls) > max(1024, 4 * len(self._blobs)):
+            self._urls.popitem(last=False)
+        if self.directory:
+            await asyncio.to_thread(_write_file, self._url_path(url), digest.encode("ascii"))
+
+
+def _read_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_file(path: str, content: bytes) -> None:
+    # 先写临时文件再改名，并发读取不会读到写了一半的文件
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def is_public_address(address: str) -> bool:
+    """是否为公网地址：回环、私有、链路本地（含云服务器元数据地址169.254.169.254）、运营商共享、组播等地址都不是"""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def host_allowed(host: str, allowed_hosts: Sequence[str]) -> bool:
+    """主机是否在允许列表中，以 . 开头的条目匹配该域名及其所有子域名"""
+    host = host.lower().rstrip(".")
+    for pattern in allowed_hosts:
+        pattern = pattern.lower()
+        if host == pattern or (pattern.startswith(".") and (host == pattern[1:] or host.endswith(pattern))):
+            return True
+    return False
+
+
+class ImageFetcher:
+    """把请求中的url图片下载后内联为base64图片块，多张图片并发下载，base64图片按需缩小
+
+    fetch_urls为False时不下载url图片（原样交给上游），只处理base64图片。
+
+    只下载解析到公网地址的http(s) URL（可再用allowed_hosts限制主机），每次重定向都重新检查；
+    连接时使用检查过的IP地址，避免两次DNS解析结果不同（DNS重绑定）绕过检查。
+    下载失败的错误信息不包含URL和具体原因，避免客户端借此探测代理所在网络。
+    """
+
+    def __init__(
+        self,
+        cache: ImageCache,
+        max_edge: int = 1568,
+        max_bytes: int = 20 * 1024 * 1024,
+        timeout: float = 10.0,
+        max_connections: int = 20,
+        allowed_hosts: Sequence[str] = (),
+        allow_private: bool = False,
+        fetch_urls: bool = True,
+    ):
+        self.cache = cache
+        self.fetch_urls = fetch_urls
+        self.max_edge = max_edge
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.allowed_hosts = tuple(allowed_hosts)
+        # 允许下载内网地址，只用于测试
+        self.allow_private = allow_private
+        self._client: Any = None
+        # 同一URL的并发下载只发送一次
+        self._flight = SingleFlight()
+
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            httpx = _httpx()
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                # 重定向在 _download 中逐跳检查后再跟随
+                follow_redirects=False,
+                limits=httpx.Limits(max_connections=self.max_connections),
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def resizes(self) -> bool:
+        return self.max_edge > 0 and pil_available()
+
+    async def fetch(self, url: str) -> Tuple[str, str]:
+        """下载图片，返回 (media_type, base64数据)"""
+        cached = await self.cache.get_url(url)
+        if cached is not None:
+            return cached
+        return await self._flight.do(url, lambda: self._download(url))
+
+    async def _check(self, url: Any) -> str:
+        """检查URL的协议、主机和解析出的地址，返回用于连接的IP地址"""
+        if url.scheme not in ("http", "https") or not url.host:
+            raise ImageError("图片URL必须是http或https地址")
+        if self.allowed_hosts and not host_allowed(url.host, self.allowed_hosts):
+            raise ImageError("图片URL的主机不在允许列表中")
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(
+                url.raw_host.decode("ascii"), url.port or (443 if url.scheme == "https" else 80), type=socket.SOCK_STREAM)
+        except (OSError, UnicodeError) as e:
+            raise ImageError(_FETCH_FAILED) from e
+        addresses = [info[4][0] for info in infos]
+        if not addresses or not (self.allow_private or all(is_public_address(a) for a in addresses)):
+            raise ImageError(_FETCH_FAILED)
+        return addresses[0].split("%", 1)[0]
+
+    async def _download(self, url: str) -> Tuple[str, str]:
+        httpx = _httpx()
+        chunks: List[bytes] = []
+        size = 0
+        try:
+            target = httpx.URL(url)
+            for _ in range(MAX_REDIRECTS + 1):
+                address = await self._check(target)
+                request = self.client.build_request(
+                    "GET",
+                    target.copy_with(host=address),
+                    headers={"Host": target.netloc.decode("ascii")},
+                    extensions={"sni_hostname": target.raw_host.decode("ascii")},
+                )
+                response = await self.client.send(request, stream=True)
+                try:
+                    if response.is_redirect:
+                        target = target.join(response.headers["location"])
+                        continue
+                    if response.status_code != 200:
+                        # 状态码只记录到日志，返回给客户端的信息与其它下载失败相同
+                        logger.warning("下载图片失败: %s 返回HTTP %d", target.host, response.status_code)
+                        raise ImageError(_FETCH_FAILED)
+                    header_type = response.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise ImageError(f"图片超过 {self.max_bytes} 字节")
+                        chunks.append(chunk)
+                    break
+                finally:
+                    await response.aclose()
+            else:
+                raise ImageError("图片URL重定向次数过多")
+        except (httpx.HTTPError, httpx.InvalidURL, KeyError) as e:
+            raise ImageError(_FETCH_FAILED) from e
+
+        return await self._process(b"".join(chunks), header_type, url)
+
+    async def _process(self, raw: bytes, media_type: Optional[str], url: Optional[str] = None) -> Tuple[str, str]:
+        digest = hashlib.sha256(raw).hexdigest()
+        cached = await self.cache.get(digest)
+        if cached is not None:
+            if url is not None:
+                await self.cache.link_url(url, digest)
+            return cached
+
+        media_type = sniff_media_type(raw) or media_type
+        if media_type not in SUPPORTED_MEDIA_TYPES:
+            raise ImageError(f"不支持的图片格式 {media_type or 'unknown'}")
+        if self.resizes:
+            # 解码和缩放是CPU密集操作，放到线程中执行
+            raw, media_type = await asyncio.to_thread(downscale, raw, media_type, self.max_edge)
+        data = base64.b64encode(raw).decode("ascii")
+        await self.cache.set(digest, media_type, data, url=url)
+        return media_type, data
+
+    async def _resolve(self, source: Dict[str, Any]) -> Tuple[str, str]:
+        if source.get("type") == "url":
+            return await self.fetch(source.get("url", ""))
+        try:
+            raw = base64.b64decode(source.get("data", ""), validate=True)
+        except ValueError as e:
+            raise ImageError("图片的base64数据无效") from e
+        return await self._process(raw, source.get("media_type"))
+
+    def _needs_work(self, block: Any) -> bool:
+        if not isinstance(block, dict) or block.get("type") != "image":
+            return False
+        source_type = block.get("source", {}).get("type")
+        if source_type == "url":
+            return self.fetch_urls
+        return source_type == "base64" and self.resizes
+
+    async def inline(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """返回把url图片替换为base64图片块的请求参数（不修改原对象）"""
+        messages = kwargs.get("messages") or []
+        jobs = [
+            (i, j)
+            for i, message in enumerate(messages) if isinstance(message.get("content"), list)
+            for j, block in enumerate(message["content"]) if self._needs_work(block)
+        ]
+        if not jobs:
+            return kwargs
+
+        tasks = [asyncio.ensure_future(self._resolve(messages[i]["content"][j]["source"])) for i, j in jobs]
+        try:
+            # 按完成顺序等待，第一个失败立即抛出
+            for next_done in asyncio.as_completed(tasks):
+                await next_done
+        except BaseException:
+            # 一张图片失败（或请求被取消）时取消其余下载
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        results = [task.result() for task in tasks]
+
+        new_messages = list(messages)
+        for (i, j), (media_type, data) in zip(jobs, results):
+            if new_messages[i] is messages[i]:
+                new_messages[i] = {**messages[i], "content": list(messages[i]["content"])}
+            block = new_messages[i]["content"][j]
+            new_messages[i]["content"][j] = {
+                **block, "source": {"type": "base64", "media_type": media_type, "data": data},
+            }
+        return {**kwargs, "messages": new_messages}
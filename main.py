@@ -6,20 +6,215 @@ import os
 import json
 import asyncio
 import time
-from typing import Optional
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from contextlib import asynccontextmanager, suppress
+from typing import Optional, Union
+
+import startup
+# 在导入其它模块之前开始统计导入耗时
+startup.begin()
+
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from anthropic import Anthropic, AsyncAnthropic
+from pydantic import BaseModel, PrivateAttr, ValidationError
+
+from config import (
+    API_KEY, MODEL_NAME, BASE_URL, HOST, PORT, WORKERS, SHARED_STATE_SOCKET, SERVER_LOOP, SERVER_HTTP,
+    UPSTREAMS, UPSTREAM_EJECT_FAILURES, UPSTREAM_EJECT_SECONDS,
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL,
+    SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_TTL,
+    SEMANTIC_CACHE_DIM,
+    DISK_CACHE_DIR, DISK_CACHE_MAX_BYTES, DISK_CACHE_SEGMENT_BYTES, DISK_CACHE_TTL, DISK_CACHE_COMPACT_INTERVAL,
+    COALESCE_ENABLED,
+    PROMPT_CACHE_ENABLED, PROMPT_CACHE_MIN_TOKENS, PROMPT_CACHE_MAX_PREFIXES,
+    REQUEST_STREAM_PARSE_MIN_BYTES,
+    REQUEST_MAX_DECOMPRESSED_BYTES, RESPONSE_COMPRESSION_ENABLED, RESPONSE_COMPRESSION_MIN_BYTES,
+    SSE_COMPRESSION_ENABLED,
+    IMAGE_FETCH_ENABLED, IMAGE_FETCH_ALLOWED_HOSTS, IMAGE_MAX_EDGE, IMAGE_MAX_BYTES, IMAGE_FETCH_TIMEOUT,
+    IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_DIR,
+    ADMISSION_MODEL_CONCURRENCY, ADMISSION_MODEL_LIMITS, ADMISSION_MAX_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_AFTER,
+    RATE_LIMIT_ENABLED,
+    RETRY_MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+    HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_MIN_DELAY_MS, HEDGE_MIN_SAMPLES,
+    STREAM_COALESCE_DEFAULT, STREAM_COALESCE_MAX_CHARS, STREAM_COALESCE_WINDOW_MS,
+    BATCH_DIR, BATCH_POLL_INTERVAL, BATCH_MAX_REQUESTS, BATCH_MAX_BYTES, BATCH_MAX_FILE_BYTES,
+)
+from converter import (
+    STOP_REASONS, ConversionError, convert_messages, convert_response_content, convert_tool_choice, convert_tools,
+)
+from request_body import BodyError, parse_chat_body
+from compression import (
+    BodyTooLarge, EncodingError, UnsupportedEncoding, compress, compress_stream, decompress_stream, negotiate,
+)
+from cache import ResponseCache, make_cache_key
+from disk_cache import DiskCache
+from semantic_cache import HashedNgramVectorizer, SemanticCache, split_query, is_available as semantic_cache_available
+from coalesce import SingleFlight, StreamCoalescer
+from prompt_cache import PrefixTracker, add_cache_breakpoints
+from images import ImageCache, ImageError, ImageFetcher
+from sse import SSEEncoder, DONE as SSE_DONE, StreamTranslator, batch_deltas, read_events
+from upstream import Upstream, UpstreamPool, UpstreamUnavailable
+from ratelimit import estimate_input_tokens
+from metrics import (
+    registry as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    REQUESTS, REQUEST_DURATION, TIME_TO_FIRST_TOKEN, UPSTREAM_DURATION, PROXY_OVERHEAD,
+    TOKENS_PER_SECOND, INPUT_TOKENS, OUTPUT_TOKENS, PROMPT_CACHE_READ_TOKENS, PROMPT_CACHE_WRITE_TOKENS,
+    UPSTREAM_ERRORS, INFLIGHT, CLIENT_DISCONNECTS, UPSTREAM_STREAMS_CANCELLED,
+    UPSTREAM_INFLIGHT, UPSTREAM_EJECTED, ADMISSION_QUEUED, CACHE_REQUESTS, CACHE_ENTRIES, CACHE_BYTES,
+    SEMANTIC_CACHE_ENTRIES, DISK_CACHE_ENTRIES, DISK_CACHE_BYTES,
+)
+from retry import LatencyTracker, backoff_delay, hedge, is_retryable, retry_after_of, retry_async
+from admission import AdmissionController, AdmissionRejected
+from shared_state import METRICS_PUSH_INTERVAL, StateClient, StateUnavailable
+from batches import BatchError, BatchManager, FileStore
+from disconnect import ClientDisconnected, DisconnectAwareStreamingResponse, DisconnectWatcher
+import sdk
+
+
+# 全局共享的上游池（每个上游复用一个带连接池的客户端）及其准入控制器
+upstream_pool: Optional[UpstreamPool] = None
+admission: Optional[AdmissionController] = None
+# 多worker模式下连接的共享状态服务（单进程时为None，使用本进程内的缓存和限速器）
+state_client: Optional[StateClient] = None
+
+
+def create_upstream_pool() -> UpstreamPool:
+    """根据配置创建上游池，多worker模式下使用共享的限速器"""
+    return UpstreamPool.from_config(
+        UPSTREAMS, UPSTREAM_EJECT_FAILURES, UPSTREAM_EJECT_SECONDS,
+        limiter_factory=state_client.limiter if state_client is not None else None,
+    )
+
+
+def create_disk_cache() -> DiskCache:
+    """创建磁盘缓存并在后台线程中打开"""
+    return DiskCache(
+        DISK_CACHE_DIR,
+        max_bytes=DISK_CACHE_MAX_BYTES,
+        segment_bytes=DISK_CACHE_SEGMENT_BYTES,
+        ttl=DISK_CACHE_TTL,
+        compact_interval=DISK_CACHE_COMPACT_INTERVAL,
+    ).start()
+
+
+def create_admission(pool: UpstreamPool) -> AdmissionController:
+    """根据配置创建准入控制器"""
+    return AdmissionController(
+        pool,
+        model_limits=ADMISSION_MODEL_LIMITS,
+        default_model_limit=ADMISSION_MODEL_CONCURRENCY,
+        max_queue=ADMISSION_MAX_QUEUE,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+        retry_after=ADMISSION_RETRY_AFTER,
+    )
 
-from config import API_KEY, MODEL_NAME, BASE_URL, HOST, PORT
+
+# 非流式响应缓存
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    ttl=RESPONSE_CACHE_TTL,
+)
+
+# 语义缓存（未安装numpy时不启用）
+semantic_cache: Optional[SemanticCache] = None
+if SEMANTIC_CACHE_ENABLED and semantic_cache_available():
+    semantic_cache = SemanticCache(
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        ttl=SEMANTIC_CACHE_TTL,
+        vectorizer=HashedNgramVectorizer(SEMANTIC_CACHE_DIM),
+    )
+
+# 相同并发请求的合并器
+single_flight = SingleFlight()
+stream_coalescer = StreamCoalescer()
+
+# 出现过的提示词前缀，用于自动添加缓存断点
+prefix_tracker = PrefixTracker(PROMPT_CACHE_MAX_PREFIXES)
+
+
+
+def create_image_fetcher() -> ImageFetcher:
+    """创建图片下载器（带内容寻址缓存），下载器只能在创建它的事件循环中使用"""
+    return ImageFetcher(
+        ImageCache(max_bytes=IMAGE_CACHE_MAX_BYTES, directory=IMAGE_CACHE_DIR or None),
+        max_edge=IMAGE_MAX_EDGE,
+        max_bytes=IMAGE_MAX_BYTES,
+        timeout=IMAGE_FETCH_TIMEOUT,
+        allowed_hosts=IMAGE_FETCH_ALLOWED_HOSTS,
+        fetch_urls=IMAGE_FETCH_ENABLED,
+    )
+
+
+image_fetcher = create_image_fetcher()
+
+# 按模型统计的上游延迟，用于对冲请求
+latency_tracker = LatencyTracker(min_samples=HEDGE_MIN_SAMPLES)
+
+# 批处理的上传文件和批处理管理器（在lifespan中创建）
+file_store: Optional[FileStore] = None
+batch_manager: Optional[BatchManager] = None
+
+
+async def push_metrics_loop(client: StateClient) -> None:
+    """定期把本worker的指标快照推送到状态服务"""
+    while True:
+        await asyncio.sleep(METRICS_PUSH_INTERVAL)
+        refresh_gauges()
+        try:
+            await client.push_metrics(metrics_registry.snapshot())
+        except StateUnavailable:
+            pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时创建上游客户端，关闭时释放连接"""
+    global upstream_pool, admission, state_client, batch_manager
+    # anthropic SDK在后台线程中导入，服务可以先开始监听
+    sdk.preload()
+    metrics_task = None
+    if SHARED_STATE_SOCKET:
+        state_client = StateClient(SHARED_STATE_SOCKET)
+        metrics_task = asyncio.create_task(push_metrics_loop(state_client))
+    upstream_pool = create_upstream_pool()
+    admission = create_admission(upstream_pool)
+    batch_manager = get_batch_manager()
+    # 继续处理重启前未结束的批处理
+    batch_manager.resume()
+    # 单进程模式下磁盘缓存由本进程打开，多worker模式下由状态服务打开
+    if DISK_CACHE_DIR and state_client is None:
+        response_cache.lower = create_disk_cache()
+    startup.report()
+    try:
+        yield
+    finally:
+        if response_cache.lower is not None:
+            response_cache.lower.close()
+            response_cache.lower = None
+        await batch_manager.close()
+        await upstream_pool.close()
+        await image_fetcher.close()
+        if metrics_task is not None:
+            # 等待推送任务真正结束后再关闭状态服务连接
+            metrics_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await metrics_task
+            await state_client.close()
+        upstream_pool = None
+        admission = None
+        state_client = None
+        batch_manager = None
 
 
 app = FastAPI(
     title="Anthropic Proxy",
     description="将OpenAI格式请求转换为Anthropic格式的代理服务器",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 添加CORS中间件
@@ -39,63 +234,108 @@ class ChatRequest(BaseModel):
     top_p: Optional[float] = None
     max_tokens: Optional[int] = 4096
     stream: Optional[bool] = False
+    # include_usage为True时流式响应最后输出用量chunk
+    stream_options: Optional[dict] = None
     system: Optional[str] = None
+    # 工具调用（OpenAI function格式）
+    tools: Optional[list] = None
+    tool_choice: Optional[Union[str, dict]] = None
+    parallel_tool_calls: Optional[bool] = None
+    # 流式增量合并模式，未指定时参考 X-Stream-Coalesce 请求头和默认配置
+    stream_coalesce: Optional[bool] = None
+    # 解析请求体时已转换好的 (system, Anthropic消息列表)
+    _converted: Optional[tuple] = PrivateAttr(default=None)
+    # 解析请求体时已转换好的Anthropic工具定义
+    _tools: Optional[list] = PrivateAttr(default=None)
 
 
-# 创建Anthropic客户端
-def get_anthropic_client():
-    """获取Anthropic客户端"""
-    return AsyncAnthropic(
-        api_key=API_KEY,
-        base_url=BASE_URL,
+async def read_chat_request(http_request: Request) -> ChatRequest:
+    """解析请求体，messages由解析器直接转换为Anthropic格式，不经过Pydantic校验"""
+    try:
+        incremental = int(http_request.headers.get("content-length", "")) >= REQUEST_STREAM_PARSE_MIN_BYTES
+    except ValueError:
+        # 分块传输，长度未知
+        incremental = True
+    # gzip/zstd压缩的请求体边接收边解压
+    chunks = decompress_stream(
+        http_request.stream(), http_request.headers.get("content-encoding", ""), REQUEST_MAX_DECOMPRESSED_BYTES
     )
+    try:
+        body = await parse_chat_body(chunks, incremental)
+    except BodyError as e:
+        raise RequestValidationError([{"type": "json_invalid", "loc": ("body",), "msg": str(e), "input": None}])
+    except UnsupportedEncoding as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except EncodingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except BodyTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    try:
+        request = ChatRequest.model_validate({**body.fields, "messages": []})
+    except ValidationError as e:
+        raise RequestValidationError([
+            {**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)
+        ])
+    request._converted = body.converted(request.system)
+    if request.tools:
+        try:
+            request._tools = convert_tools(request.tools)
+        except ConversionError as e:
+            raise RequestValidationError([
+                {"type": "value_error", "loc": ("body", "tools"), "msg": str(e), "input": None}
+            ])
+    return request
 
 
-def convert_openai_to_anthropoc_messages(messages: list) -> list:
-    """转换OpenAI消息格式为Anthropic格式"""
-    anthropic_messages = []
-
-    for msg in messages:
-        role = msg.get("role")
-        content = msg.get("content")
-
-        # 跳过system消息（Anthropic单独处理）
-        if role == "system":
-            continue
-
-        # 转换content为Anthropic格式
-        if isinstance(content, str):
-            anthropic_content = content
-        elif isinstance(content, list):
-            # 处理多模态内容
-            text_parts = []
-            for item in content:
-                if item.get("type") == "text":
-                    text_parts.append(item.get("text", ""))
-                elif item.get("type") == "image_url":
-                    text_parts.append(f"[Image: {item.get('image_url', {}).get('url', '')}]")
-            anthropic_content = "\n".join(text_parts) if text_parts else ""
-        else:
-            anthropic_content = str(content)
+def get_admission() -> AdmissionController:
+    """获取共享的准入控制器（未经lifespan启动时按需创建）"""
+    global upstream_pool, admission
+    if upstream_pool is None:
+        upstream_pool = create_upstream_pool()
+    if admission is None or admission.pool is not upstream_pool:
+        admission = create_admission(upstream_pool)
+    return admission
 
-        anthropic_messages.append({
-            "role": role,
-            "content": anthropic_content
-        })
 
-    return anthropic_messages
+def get_upstream_pool() -> UpstreamPool:
+    return get_admission().pool
 
 
-def convert_anthropic_to_openai_response(response, model: str) -> dict:
-    """转换Anthropic响应为OpenAI格式"""
-    # 提取文本内容
-    text_content = ""
-    if response.content:
-        for block in response.content:
-            if block.type == "text":
-                text_content = block.text
-                break
+def get_batch_manager() -> BatchManager:
+    """获取批处理管理器（未经lifespan启动时按需创建）"""
+    global file_store, batch_manager
+    if file_store is None:
+        file_store = FileStore(os.path.join(BATCH_DIR, "files"))
+    if batch_manager is None:
+        batch_manager = BatchManager(
+            file_store,
+            os.path.join(BATCH_DIR, "batches"),
+            get_upstream_pool,
+            batch_converter,
+            convert_anthropic_to_openai_response,
+            poll_interval=BATCH_POLL_INTERVAL,
+            max_requests=BATCH_MAX_REQUESTS,
+            max_bytes=BATCH_MAX_BYTES,
+            max_retries=RETRY_MAX_RETRIES,
+        )
+    return batch_manager
+
+
+def get_file_store() -> FileStore:
+    get_batch_manager()
+    return file_store
+
+
+def get_priority(http_request: Request) -> int:
+    """从 X-Priority 请求头读取排队优先级，数值越大越优先"""
+    try:
+        return int(http_request.headers.get("x-priority", "0"))
+    except ValueError:
+        return 0
+
 
+def convert_anthropic_to_openai_response(response, model: str) -> dict:
+    """转换Anthropic响应为OpenAI格式（文本块拼接为content，tool_use块转为tool_calls）"""
     return {
         "id": response.id or f"chatcmpl-{int(time.time())}",
         "object": "chat.completion",
@@ -103,11 +343,8 @@ def convert_anthropic_to_openai_response(response, model: str) -> dict:
         "model": model,
         "choices": [{
             "index": 0,
-            "message": {
-                "role": "assistant",
-                "content": text_content
-            },
-            "finish_reason": "stop"
+            "message": convert_response_content(response.content),
+            "finish_reason": STOP_REASONS.get(response.stop_reason, "stop")
         }],
         "usage": {
             "prompt_tokens": response.usage.input_tokens if response.usage else 0,
@@ -117,6 +354,104 @@ def convert_anthropic_to_openai_response(response, model: str) -> dict:
     }
 
 
+def build_anthropic_kwargs(request: ChatRequest) -> dict:
+    """根据OpenAI请求构建Anthropic调用参数"""
+    if request._converted is not None:
+        system, messages = request._converted
+    else:
+        system, messages = convert_messages(request.messages, request.system)
+    kwargs = {
+        "model": request.model or MODEL_NAME,
+        "max_tokens": request.max_tokens or 4096,
+        "messages": messages,
+    }
+
+    if request.temperature is not None:
+        kwargs["temperature"] = request.temperature
+    if request.top_p is not None:
+        kwargs["top_p"] = request.top_p
+    if system:
+        kwargs["system"] = system
+    if request.tools:
+        kwargs["tools"] = request._tools if request._tools is not None else convert_tools(request.tools)
+        tool_choice = convert_tool_choice(request.tool_choice, request.parallel_tool_calls)
+        if tool_choice is not None:
+            kwargs["tool_choice"] = tool_choice
+
+    return kwargs
+
+
+def with_cache_breakpoints(kwargs: dict) -> dict:
+    """开启提示词缓存时，为重复出现的前缀加上cache_control断点"""
+    if not PROMPT_CACHE_ENABLED:
+        return kwargs
+    return add_cache_breakpoints(kwargs, prefix_tracker, PROMPT_CACHE_MIN_TOKENS)
+
+
+async def prepare_upstream_kwargs(kwargs: dict) -> dict:
+    """发往上游前的最后处理：添加缓存断点，缩小base64图片，开启下载时下载并内联url图片"""
+    kwargs = with_cache_breakpoints(kwargs)
+    return await image_fetcher.inline(kwargs)
+
+
+@asynccontextmanager
+async def batch_converter():
+    """批处理的请求转换，在批处理的解析线程（有自己的事件循环）中使用
+
+    得到的函数把输入文件中一行的body转换为Anthropic请求参数（批处理不支持流式，忽略stream）。
+    不经过前缀统计，批处理的提示词不影响交互请求的缓存断点；图片由这个循环里单独的下载器处理。
+    """
+    fetcher = create_image_fetcher()
+
+    async def convert(body: dict) -> dict:
+        return await fetcher.inline(build_anthropic_kwargs(ChatRequest.model_validate(body)))
+
+    try:
+        yield convert
+    finally:
+        await fetcher.close()
+
+
+def is_deterministic(request: ChatRequest, http_request: Request) -> bool:
+    """判断相同请求是否可以共用一个响应：temperature=0，或通过 X-Proxy-Cache 请求头显式开启/关闭"""
+    header = http_request.headers.get("x-proxy-cache", "").lower()
+    if header in ("off", "false", "0"):
+        return False
+    if header in ("on", "true", "1"):
+        return True
+
+    return request.temperature == 0
+
+
+def is_cacheable(request: ChatRequest, http_request: Request) -> bool:
+    """判断请求是否可缓存"""
+    return RESPONSE_CACHE_ENABLED and is_deterministic(request, http_request)
+
+
+def should_batch_stream(request: ChatRequest, http_request: Request) -> bool:
+    """判断流式响应是否合并文本增量：请求字段优先，其次 X-Stream-Coalesce 请求头"""
+    if request.stream_coalesce is not None:
+        return request.stream_coalesce
+
+    header = http_request.headers.get("x-stream-coalesce", "").lower()
+    if header in ("on", "true", "1"):
+        return True
+    if header in ("off", "false", "0"):
+        return False
+
+    return STREAM_COALESCE_DEFAULT
+
+
+def wants_stream_usage(request: ChatRequest) -> bool:
+    """stream_options.include_usage为True时，流式响应最后输出用量chunk"""
+    return bool(request.stream_options and request.stream_options.get("include_usage"))
+
+
+def should_coalesce(request: ChatRequest, http_request: Request) -> bool:
+    """判断是否合并相同的并发请求，规则与缓存相同：有随机采样的请求各自请求上游，得到不同的回答"""
+    return COALESCE_ENABLED and is_deterministic(request, http_request)
+
+
 @app.get("/")
 async def root():
     """根路径"""
@@ -126,7 +461,10 @@ async def root():
         "endpoints": {
             "chat": "/v1/chat/completions",
             "health": "/health",
-            "models": "/v1/models"
+            "metrics": "/metrics",
+            "models": "/v1/models",
+            "files": "/v1/files",
+            "batches": "/v1/batches"
         }
     }
 
@@ -137,6 +475,38 @@ async def health():
     return {"status": "healthy"}
 
 
+def refresh_gauges() -> None:
+    """更新上游和准入队列的仪表"""
+    admission = get_admission()
+    for upstream in admission.pool.upstreams:
+        UPSTREAM_INFLIGHT.labels(upstream.name).set(upstream.inflight)
+        UPSTREAM_EJECTED.labels(upstream.name).set(1 if upstream.is_ejected(time.monotonic()) else 0)
+    ADMISSION_QUEUED.set(admission.queued)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus指标，多worker模式下导出所有worker汇总后的值"""
+    refresh_gauges()
+    if semantic_cache is not None:
+        SEMANTIC_CACHE_ENTRIES.set(len(semantic_cache))
+    if state_client is None:
+        CACHE_ENTRIES.set(len(response_cache))
+        CACHE_BYTES.set(response_cache.size_bytes)
+        if response_cache.lower is not None:
+            DISK_CACHE_ENTRIES.set(len(response_cache.lower))
+            DISK_CACHE_BYTES.set(response_cache.lower.size_bytes)
+    else:
+        try:
+            await state_client.push_metrics(metrics_registry.snapshot())
+            snapshots = await state_client.collect_metrics()
+            return Response(content=metrics_registry.render(snapshots), media_type=METRICS_CONTENT_TYPE)
+        except StateUnavailable:
+            # 状态服务不可用时只导出本worker的指标
+            pass
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/v1/models")
 async def list_models():
     """列出可用模型"""
@@ -151,110 +521,351 @@ async def list_models():
     }
 
 
-async def stream_generator(client, request: ChatRequest):
-    """流式响应生成器"""
+async def cache_lookup(key: str) -> Optional[bytes]:
+    """查询响应缓存，多worker模式下查询共享缓存（状态服务不可用时视为未命中）"""
+    if state_client is None:
+        return await response_cache.get(key)
     try:
-        # 转换消息格式
-        anthropic_messages = convert_openai_to_anthropoc_messages(request.messages)
+        return await state_client.cache_get(key)
+    except StateUnavailable:
+        return None
 
-        # 构建请求参数
-        kwargs = {
-            "model": request.model or MODEL_NAME,
-            "max_tokens": request.max_tokens or 4096,
-            "messages": anthropic_messages,
-        }
 
-        if request.temperature is not None:
-            kwargs["temperature"] = request.temperature
-        if request.top_p is not None:
-            kwargs["top_p"] = request.top_p
-        if request.system:
-            kwargs["system"] = request.system
+async def cache_store(key: str, body: bytes) -> None:
+    """写入响应缓存，多worker模式下写入共享缓存"""
+    if state_client is None:
+        await response_cache.set(key, body)
+    else:
+        state_client.cache_set(key, body)
+
+
+async def pace(upstream: Upstream, kwargs: dict) -> None:
+    """按上游密钥的请求数/token数限额在发送前限速"""
+    if RATE_LIMIT_ENABLED:
+        await upstream.limiter.wait(estimate_input_tokens(kwargs))
+
+
+def record_usage(model: str, usage, generation_seconds: float) -> None:
+    """记录上游返回的token用量和输出速度（usage为SDK对象，或流式响应中累计的用量字典）"""
+    if usage is None:
+        return
+    get = usage.get if isinstance(usage, dict) else lambda name: getattr(usage, name, None)
+    output_tokens = get("output_tokens") or 0
+    INPUT_TOKENS.labels(model).inc(get("input_tokens") or 0)
+    OUTPUT_TOKENS.labels(model).inc(output_tokens)
+    PROMPT_CACHE_READ_TOKENS.labels(model).inc(get("cache_read_input_tokens") or 0)
+    PROMPT_CACHE_WRITE_TOKENS.labels(model).inc(get("cache_creation_input_tokens") or 0)
+    if output_tokens and generation_seconds > 0:
+        TOKENS_PER_SECOND.labels(model).observe(output_tokens / generation_seconds)
+
+
+async def call_upstream(admission: AdmissionController, kwargs: dict, priority: int, tried: list):
+    """经过准入控制选择上游并调用一次非流式API，tried记录已使用过的上游以便重试和对冲时避开"""
+    model = kwargs["model"]
+    async with admission.admit(model, priority, tried) as upstream:
+        tried.append(upstream)
+        await sdk.ready()
+        await pace(upstream, kwargs)
+        started = time.monotonic()
+        try:
+            response = await upstream.client.messages.create(**kwargs)
+        except Exception as e:
+            UPSTREAM_ERRORS.labels(upstream.name, type(e).__name__).inc()
+            raise
+        elapsed = time.monotonic() - started
+        latency_tracker.record(model, elapsed)
+        UPSTREAM_DURATION.labels(model, upstream.name, "false").observe(elapsed)
+        record_usage(model, response.usage, elapsed)
+        return response
+
+
+async def create_message(admission: AdmissionController, kwargs: dict, priority: int = 0):
+    """调用非流式API，瞬时错误自动重试，开启对冲时慢请求会向另一个上游发送副本"""
+    tried = []
+
+    def attempt():
+        return retry_async(
+            lambda: call_upstream(admission, kwargs, priority, tried),
+            RETRY_MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+        )
+
+    if HEDGE_ENABLED:
+        delay = latency_tracker.percentile(kwargs["model"], HEDGE_PERCENTILE)
+        if delay is not None:
+            return await hedge(attempt, attempt, max(delay, HEDGE_MIN_DELAY_MS / 1000))
+
+    return await attempt()
+
 
+async def stream_generator(
+    admission: AdmissionController,
+    request: ChatRequest,
+    kwargs: Optional[dict] = None,
+    batched: bool = False,
+    priority: int = 0,
+):
+    """流式响应生成器"""
+    try:
+        # 构建请求参数
+        if kwargs is None:
+            kwargs = build_anthropic_kwargs(request)
+        kwargs = await prepare_upstream_kwargs(kwargs)
+
+        model = kwargs["model"]
         chunk_id = f"chatcmpl-{int(time.time())}"
-        model_name = request.model or MODEL_NAME
-
-        # 调用流式API
-        async with client.messages.stream(**kwargs) as stream:
-            # 发送初始chunk (role)
-            yield f"data: {json.dumps({
-                'id': chunk_id,
-                'object': 'chat.completion.chunk',
-                'created': int(time.time()),
-                'model': model_name,
-                'choices': [{
-                    'index': 0,
-                    'delta': {'role': 'assistant'},
-                    'finish_reason': None
-                }]
-            }, ensure_ascii=False)}\n\n"
-
-            # 流式传输文本
-            async for text in stream.text_stream:
-                yield f"data: {json.dumps({
-                    'id': chunk_id,
-                    'object': 'chat.completion.chunk',
-                    'created': int(time.time()),
-                    'model': model_name,
-                    'choices': [{
-                        'index': 0,
-                        'delta': {'content': text},
-                        'finish_reason': None
-                    }]
-                }, ensure_ascii=False)}\n\n"
-
-            # 发送结束chunk
-            yield f"data: {json.dumps({
-                'id': chunk_id,
-                'object': 'chat.completion.chunk',
-                'created': int(time.time()),
-                'model': model_name,
-                'choices': [{
-                    'index': 0,
-                    'delta': {},
-                    'finish_reason': 'stop'
-                }]
-            }, ensure_ascii=False)}\n\n"
-
-            yield "data: [DONE]\n\n"
+        encoder = SSEEncoder(chunk_id, request.model or MODEL_NAME, include_usage=wants_stream_usage(request))
+
+        # 调用流式API，尚未输出数据前遇到瞬时错误会换上游重试
+        tried = []
+        started = False
+        attempt = 0
+        while True:
+            try:
+                async with admission.admit(model, priority, tried) as upstream:
+                    tried.append(upstream)
+                    await sdk.ready()
+                    await pace(upstream, kwargs)
+                    upstream_started = time.monotonic()
+                    translator = None
+                    try:
+                        # 直接解析上游的SSE字节流，不为每个事件构建SDK对象，也不累积消息快照
+                        async with upstream.client.messages.with_streaming_response.create(
+                            **kwargs, stream=True
+                        ) as response:
+                            # 发送初始chunk (role)
+                            started = True
+                            yield encoder.role()
+
+                            # 流式传输文本、思考内容和工具调用
+                            first_text_at = None
+                            translator = StreamTranslator(encoder)
+                            deltas = translator.translate(read_events(response.iter_bytes()))
+                            if batched:
+                                deltas = batch_deltas(deltas, STREAM_COALESCE_MAX_CHARS, STREAM_COALESCE_WINDOW_MS / 1000)
+                            async for delta in deltas:
+                                if first_text_at is None:
+                                    first_text_at = time.monotonic()
+                                yield encoder.content(delta) if isinstance(delta, str) else delta
+
+                            finished_at = time.monotonic()
+                            UPSTREAM_DURATION.labels(model, upstream.name, "true").observe(finished_at - upstream_started)
+                            record_usage(model, translator.usage, finished_at - (first_text_at or upstream_started))
+
+                            # 发送结束chunk，需要时再发送用量chunk
+                            yield encoder.finish(translator.finish_reason)
+                            if encoder.include_usage:
+                                yield encoder.usage(translator.usage)
+
+                            yield SSE_DONE
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # 客户端断开：上游流随async with关闭，离开admit时释放并发名额；已产生的用量照常记录
+                        UPSTREAM_STREAMS_CANCELLED.labels(model, upstream.name).inc()
+                        if translator is not None:
+                            record_usage(model, translator.usage, time.monotonic() - upstream_started)
+                        raise
+                    except Exception as e:
+                        UPSTREAM_ERRORS.labels(upstream.name, type(e).__name__).inc()
+                        raise
+                break
+            except Exception as e:
+                if started or attempt >= RETRY_MAX_RETRIES or not is_retryable(e):
+                    raise
+                await asyncio.sleep(backoff_delay(attempt, RETRY_BASE_DELAY, RETRY_MAX_DELAY, retry_after_of(e)))
+                attempt += 1
 
+    except (AdmissionRejected, UpstreamUnavailable, ImageError):
+        # 尚未输出任何数据，交给调用方转换为HTTP错误
+        raise
     except Exception as e:
-        yield f"data: {json.dumps({'error': f'{type(e).__name__}: {str(e)}'})}\n\n"
+        yield f"data: {json.dumps({'error': f'{type(e).__name__}: {str(e)}'})}\n\n".encode("utf-8")
+
+
+async def prepend_chunk(first, generator):
+    """先输出已取得的首个数据块，再继续输出剩余数据"""
+    try:
+        yield first
+        async for chunk in generator:
+            yield chunk
+    finally:
+        await generator.aclose()
+
+
+async def instrument_stream(generator, model: str, started: float):
+    """记录单个流式请求的首个内容块时间、总延迟和结果"""
+    INFLIGHT.labels("true").inc()
+    # 客户端提前断开时记为499
+    status = "499"
+    count = 0
+    last = None
+    try:
+        async for chunk in generator:
+            count += 1
+            # 第一个数据块是role块，第二个才是第一个内容块
+            if count == 2:
+                TIME_TO_FIRST_TOKEN.labels(model).observe(time.monotonic() - started)
+            last = chunk
+            yield chunk
+        status = "200" if last == SSE_DONE else "500"
+    finally:
+        INFLIGHT.labels("true").dec()
+        REQUESTS.labels(model, status, "true").inc()
+        REQUEST_DURATION.labels(model, "true").observe(time.monotonic() - started)
+
+
+def compress_response(response: Response, http_request: Request) -> Response:
+    """客户端接受时按Accept-Encoding压缩非流式响应"""
+    if not RESPONSE_COMPRESSION_ENABLED:
+        return response
+    response.headers["Vary"] = "Accept-Encoding"
+    if len(response.body) < RESPONSE_COMPRESSION_MIN_BYTES:
+        return response
+    encoding = negotiate(http_request.headers.get("accept-encoding"))
+    if encoding is None:
+        return response
+    response.body = compress(response.body, encoding)
+    response.headers["Content-Encoding"] = encoding
+    response.headers["Content-Length"] = str(len(response.body))
+    return response
+
+
+def unavailable_error(e) -> HTTPException:
+    """排队已满返回429，没有可用上游返回503"""
+    return HTTPException(
+        status_code=429 if isinstance(e, AdmissionRejected) else 503,
+        detail=str(e),
+        headers={"Retry-After": str(max(1, int(e.retry_after)))}
+    )
 
 
-@app.post("/v1/chat/completions")
-async def chat_completions(request: ChatRequest):
+@app.post(
+    "/v1/chat/completions",
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": ChatRequest.model_json_schema()}},
+    }},
+)
+async def chat_completions(http_request: Request, request: ChatRequest = Depends(read_chat_request)):
     """聊天完成接口（支持流式和非流式）"""
-    client = get_anthropic_client()
+    admission = get_admission()
+    priority = get_priority(http_request)
+    model = request.model or MODEL_NAME
+    started = time.monotonic()
 
     # 流式请求
     if request.stream:
-        return StreamingResponse(
-            stream_generator(client, request),
-            media_type="text/event-stream"
+        batched = should_batch_stream(request, http_request)
+        if should_coalesce(request, http_request):
+            kwargs = build_anthropic_kwargs(request)
+            generator = stream_coalescer.subscribe(
+                f"{make_cache_key(kwargs)}:{'batched' if batched else 'raw'}:{int(wants_stream_usage(request))}",
+                lambda: stream_generator(admission, request, kwargs, batched, priority)
+            )
+        else:
+            generator = stream_generator(admission, request, batched=batched, priority=priority)
+
+        # 先取得首个数据块，准入被拒绝时仍可以返回429/503；排队或连接上游期间客户端断开则立即放弃
+        watcher = DisconnectWatcher(http_request.receive).start()
+        try:
+            first = await watcher.run(generator.__anext__())
+        except (AdmissionRejected, UpstreamUnavailable, ImageError) as e:
+            watcher.stop()
+            error = HTTPException(status_code=400, detail=str(e)) if isinstance(e, ImageError) else unavailable_error(e)
+            REQUESTS.labels(model, error.status_code, "true").inc()
+            raise error
+        except ClientDisconnected:
+            watcher.stop()
+            await generator.aclose()
+            CLIENT_DISCONNECTS.labels(model, "queued").inc()
+            REQUESTS.labels(model, 499, "true").inc()
+            return Response(status_code=499)
+        except BaseException:
+            watcher.stop()
+            raise
+        body = instrument_stream(prepend_chunk(first, generator), model, started)
+        headers = {}
+        encoding = negotiate(http_request.headers.get("accept-encoding")) if SSE_COMPRESSION_ENABLED else None
+        if encoding is not None:
+            # 每个SSE事件单独压缩并刷新，不会为了压缩率而延迟输出
+            body = compress_stream(body, encoding)
+            headers = {"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+        return DisconnectAwareStreamingResponse(
+            body,
+            watcher,
+            on_disconnect=lambda: CLIENT_DISCONNECTS.labels(model, "streaming").inc(),
+            media_type="text/event-stream",
+            headers=headers,
         )
 
     # 非流式请求
+    INFLIGHT.labels("false").inc()
+    status = 500
     try:
-        # 转换消息格式
-        anthropic_messages = convert_openai_to_anthropoc_messages(request.messages)
+        response = await create_completion(request, http_request, admission, priority, started)
+        status = 200
+        return compress_response(response, http_request)
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    finally:
+        INFLIGHT.labels("false").dec()
+        REQUESTS.labels(model, status, "false").inc()
+        REQUEST_DURATION.labels(model, "false").observe(time.monotonic() - started)
 
+
+async def create_completion(
+    request: ChatRequest,
+    http_request: Request,
+    admission: AdmissionController,
+    priority: int,
+    started: float,
+):
+    """处理非流式请求"""
+    try:
         # 构建请求参数
-        kwargs = {
-            "model": request.model or MODEL_NAME,
-            "max_tokens": request.max_tokens or 4096,
-            "messages": anthropic_messages,
-        }
+        kwargs = build_anthropic_kwargs(request)
+
+        # 命中缓存时直接返回，跳过上游调用和格式转换
+        cache_key = None
+        if is_cacheable(request, http_request):
+            cache_key = make_cache_key(kwargs)
+            cached = await cache_lookup(cache_key)
+            CACHE_REQUESTS.labels("miss" if cached is None else "hit").inc()
+            if cached is not None:
+                return Response(
+                    content=cached,
+                    media_type="application/json",
+                    headers={"X-Proxy-Cache": "HIT"}
+                )
+
+        # 精确缓存未命中时查找语义相近的请求
+        semantic_key = None
+        if cache_key is not None and semantic_cache is not None:
+            query = split_query(kwargs)
+            if query is not None:
+                semantic_key = (query[0], semantic_cache.embed(query[1]))
+                found = semantic_cache.get(*semantic_key)
+                CACHE_REQUESTS.labels("semantic_miss" if found is None else "semantic_hit").inc()
+                if found is not None:
+                    return Response(
+                        content=found[0],
+                        media_type="application/json",
+                        headers={"X-Proxy-Cache": "SEMANTIC", "X-Proxy-Cache-Similarity": f"{found[1]:.4f}"}
+                    )
 
-        if request.temperature is not None:
-            kwargs["temperature"] = request.temperature
-        if request.top_p is not None:
-            kwargs["top_p"] = request.top_p
-        if request.system:
-            kwargs["system"] = request.system
+        # 合并键按未加缓存断点的参数计算，断点取决于之前的请求，不影响请求是否相同
+        flight_key = (cache_key or make_cache_key(kwargs)) if should_coalesce(request, http_request) else None
+        kwargs = await prepare_upstream_kwargs(kwargs)
 
-        # 调用Anthropic API
-        response = await client.messages.create(**kwargs)
+        # 调用Anthropic API（相同的并发请求合并为一次上游调用）
+        upstream_started = time.monotonic()
+        if flight_key is not None:
+            response = await single_flight.do(
+                flight_key,
+                lambda: create_message(admission, kwargs, priority)
+            )
+        else:
+            response = await create_message(admission, kwargs, priority)
+        upstream_seconds = time.monotonic() - upstream_started
 
         # 转换响应格式
         openai_response = convert_anthropic_to_openai_response(
@@ -262,8 +873,26 @@ async def chat_completions(request: ChatRequest):
             request.model or MODEL_NAME
         )
 
+        if cache_key is not None:
+            body = json.dumps(openai_response, ensure_ascii=False).encode("utf-8")
+            await cache_store(cache_key, body)
+            if semantic_key is not None:
+                semantic_cache.set(*semantic_key, body)
+            openai_response = Response(
+                content=body,
+                media_type="application/json",
+                headers={"X-Proxy-Cache": "MISS"}
+            )
+        else:
+            openai_response = JSONResponse(openai_response)
+
+        PROXY_OVERHEAD.labels(kwargs["model"]).observe(time.monotonic() - started - upstream_seconds)
         return openai_response
 
+    except (AdmissionRejected, UpstreamUnavailable) as e:
+        raise unavailable_error(e)
+    except ImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -271,6 +900,97 @@ async def chat_completions(request: ChatRequest):
         )
 
 
+@app.post("/v1/files")
+async def upload_file(http_request: Request):
+    """上传批处理输入文件（multipart表单，字段file和purpose）"""
+    form = await http_request.form()
+    upload = form.get("file")
+    purpose = form.get("purpose")
+    if upload is None or isinstance(upload, str):
+        raise HTTPException(status_code=400, detail="缺少file字段")
+    if purpose != "batch":
+        raise HTTPException(status_code=400, detail="purpose只支持batch")
+
+    async def chunks():
+        while chunk := await upload.read(1024 * 1024):
+            yield chunk
+
+    try:
+        return await get_file_store().create(upload.filename or "upload.jsonl", purpose, chunks(), BATCH_MAX_FILE_BYTES)
+    except BatchError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    finally:
+        await form.close()
+
+
+@app.get("/v1/files")
+async def list_files(purpose: Optional[str] = None):
+    return {"object": "list", "data": get_file_store().list(purpose)}
+
+
+def get_file_or_404(file_id: str) -> dict:
+    info = get_file_store().get(file_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail=f"文件不存在: {file_id}")
+    return info
+
+
+@app.get("/v1/files/{file_id}")
+async def retrieve_file(file_id: str):
+    return get_file_or_404(file_id)
+
+
+@app.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str):
+    get_file_or_404(file_id)
+    get_file_store().delete(file_id)
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+@app.get("/v1/files/{file_id}/content")
+async def file_content(file_id: str):
+    """下载文件内容（批处理的输出文件和错误文件为JSONL）"""
+    info = get_file_or_404(file_id)
+    return FileResponse(get_file_store().content_path(file_id), media_type="application/jsonl", filename=info["filename"])
+
+
+@app.post("/v1/batches")
+async def create_batch(http_request: Request):
+    """创建批处理：输入文件逐行转换后提交为Anthropic Message Batches"""
+    try:
+        body = await http_request.json()
+        return get_batch_manager().create(
+            body["input_file_id"],
+            body["endpoint"],
+            body.get("completion_window", "24h"),
+            body.get("metadata"),
+        )
+    except (ValueError, KeyError, TypeError) as e:
+        detail = str(e) if isinstance(e, BatchError) else f"请求无效: {type(e).__name__}: {e}"
+        raise HTTPException(status_code=400, detail=detail)
+
+
+@app.get("/v1/batches")
+async def list_batches(limit: int = 20, after: Optional[str] = None):
+    return get_batch_manager().list(limit, after)
+
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str):
+    batch = get_batch_manager().get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"批处理不存在: {batch_id}")
+    return batch
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    batch = await get_batch_manager().cancel(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"批处理不存在: {batch_id}")
+    return batch
+
+
 if __name__ == "__main__":
     import uvicorn
     print(f"""
@@ -282,9 +1002,29 @@ if __name__ == "__main__":
     ║  Base URL: {BASE_URL}              ║
     ╠═══════════════════════════════════════════════════════════════╣
     ║  Server: http://{HOST}:{PORT}                                ║
+    ║  Workers: {WORKERS}                                                  ║
     ║  API: http://localhost:{PORT}/v1/chat/completions              ║
     ║  Docs: http://localhost:{PORT}/docs                           ║
     ╚═══════════════════════════════════════════════════════════════╝
     """)
 
-    uvicorn.run(app, host=HOST, port=PORT)
+    if WORKERS > 1:
+        import shutil
+        import tempfile
+        from shared_state import start_server_process
+
+        # worker共用父进程监听的socket（预先fork），缓存、限速和指标保存在单独的状态服务进程中
+        state_dir = None if SHARED_STATE_SOCKET else tempfile.mkdtemp(prefix="anthropic-proxy-")
+        socket_path = SHARED_STATE_SOCKET or os.path.join(state_dir, "state.sock")
+        state_process = start_server_process(socket_path)
+        # worker是新启动的进程，通过环境变量得到状态服务的地址
+        os.environ["SHARED_STATE_SOCKET"] = socket_path
+        try:
+            uvicorn.run("main:app", host=HOST, port=PORT, workers=WORKERS, loop=SERVER_LOOP, http=SERVER_HTTP)
+        finally:
+            state_process.terminate()
+            state_process.join(5)
+            if state_dir is not None:
+                shutil.rmtree(state_dir, ignore_errors=True)
+    else:
+        uvicorn.run(app, host=HOST, port=PORT, loop=SERVER_LOOP, http=SERVER_HTTP)
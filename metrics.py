@@ -0,0 +1,318 @@
+"""
+Prometheus指标 - 轻量的计数器/仪表/直方图实现和文本格式导出
+"""
+import math
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# 延迟直方图默认分桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# 每秒token数直方图分桶
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _escape_help(value: str) -> str:
+    # HELP行只转义反斜杠和换行
+    return value.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values):
+        """按标签值取得子指标"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _dump(self, child) -> Any:
+        raise NotImplementedError
+
+    def _load(self, child, data: Any) -> None:
+        raise NotImplementedError
+
+    def _combine(self, child, data: Any) -> None:
+        raise NotImplementedError
+
+    def _samples(self, children: Dict[Tuple[str, ...], object]) -> List[str]:
+        raise NotImplementedError
+
+    def snapshot(self) -> Dict[str, Any]:
+        """导出可JSON序列化的当前值，用于多进程汇总"""
+        return {
+            "kind": self.kind,
+            "samples": [[list(key), self._dump(child)] for key, child in self._children.items()],
+        }
+
+    def _merge(self, snapshots: Sequence[Dict[str, Any]]) -> Dict[Tuple[str, ...], object]:
+        merged: Dict[Tuple[str, ...], object] = {}
+        for snapshot in snapshots:
+            for labels, data in snapshot.get(self.name, {}).get("samples", ()):
+                key = tuple(labels)
+                child = merged.get(key)
+                if child is None:
+                    child = merged[key] = self._new_child()
+                    self._load(child, data)
+                else:
+                    self._combine(child, data)
+        return merged
+
+    def render(self, snapshots: Optional[Sequence[Dict[str, Any]]] = None) -> List[str]:
+        """导出文本格式，给出snapshots时导出这些快照汇总后的值"""
+        children = self._children if snapshots is None else self._merge(snapshots)
+        lines = [
+            f"# HELP {self.name} {_escape_help(self.documentation)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self._samples(children))
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _ValueMetric(_Metric):
+    def _new_child(self):
+        return _Value()
+
+    def _dump(self, child) -> float:
+        return child.value
+
+    def _load(self, child, data: float) -> None:
+        child.value = data
+
+    def _combine(self, child, data: float) -> None:
+        child.value += data
+
+
+class Counter(_ValueMetric):
+    """单调递增计数器"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self, children) -> List[str]:
+        return [
+            f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+            for key, child in children.items()
+        ]
+
+
+class Gauge(_ValueMetric):
+    """可增可减的仪表，aggregate为多进程汇总方式：sum（求和）或 max（取最大值）"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), aggregate: str = "sum"):
+        super().__init__(name, documentation, labelnames)
+        self.aggregate = aggregate
+
+    def _combine(self, child, data: float) -> None:
+        if self.aggregate == "max":
+            child.value = max(child.value, data)
+        else:
+            child.value += data
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def _samples(self, children) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+            for key, child in children.items()
+        ]
+
+
+class _HistogramValue:
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * len(upper_bounds)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+
+
+class Histogram(_Metric):
+    """直方图"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.upper_bounds = tuple(sorted(buckets)) + (math.inf,)
+
+    def _new_child(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _dump(self, child) -> List[Any]:
+        return [child.counts, child.sum]
+
+    def _load(self, child, data: List[Any]) -> None:
+        child.counts = list(data[0])
+        child.sum = data[1]
+
+    def _combine(self, child, data: List[Any]) -> None:
+        child.counts = [a + b for a, b in zip(child.counts, data[0])]
+        child.sum += data[1]
+
+    def _samples(self, children) -> List[str]:
+        lines = []
+        for key, child in children.items():
+            cumulative = 0
+            for bound, count in zip(self.upper_bounds, child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), aggregate: str = "sum") -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, aggregate))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """导出所有指标的当前值（可JSON序列化）"""
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def render(self, snapshots: Optional[Sequence[Dict[str, Any]]] = None) -> str:
+        """导出Prometheus文本格式，给出snapshots（多个进程的快照）时导出汇总值"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(snapshots))
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    "proxy_requests", "聊天完成请求数", ("model", "status", "stream"))
+REQUEST_DURATION = registry.histogram(
+    "proxy_request_duration_seconds", "客户端看到的请求总延迟", ("model", "stream"))
+TIME_TO_FIRST_TOKEN = registry.histogram(
+    "proxy_time_to_first_token_seconds", "从收到请求到第一个内容块的时间", ("model",))
+UPSTREAM_DURATION = registry.histogram(
+    "proxy_upstream_duration_seconds", "单次上游调用的延迟", ("model", "upstream", "stream"))
+PROXY_OVERHEAD = registry.histogram(
+    "proxy_overhead_seconds", "请求延迟中不属于等待上游的部分", ("model",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+TOKENS_PER_SECOND = registry.histogram(
+    "proxy_output_tokens_per_second", "上游每秒输出的token数", ("model",), buckets=RATE_BUCKETS)
+INPUT_TOKENS = registry.counter(
+    "proxy_input_tokens", "上游返回的输入token数", ("model",))
+OUTPUT_TOKENS = registry.counter(
+    "proxy_output_tokens", "上游返回的输出token数", ("model",))
+PROMPT_CACHE_READ_TOKENS = registry.counter(
+    "proxy_prompt_cache_read_tokens", "命中上游提示词缓存的输入token数", ("model",))
+PROMPT_CACHE_WRITE_TOKENS = registry.counter(
+    "proxy_prompt_cache_write_tokens", "写入上游提示词缓存的输入token数", ("model",))
+UPSTREAM_ERRORS = registry.counter(
+    "proxy_upstream_errors", "失败的上游调用数", ("upstream", "error"))
+CLIENT_DISCONNECTS = registry.counter(
+    "proxy_client_disconnects", "客户端提前断开的流式请求数（stage为queued时尚未开始输出）", ("model", "stage"))
+UPSTREAM_STREAMS_CANCELLED = registry.counter(
+    "proxy_upstream_streams_cancelled", "客户端断开后取消的上游流，每个释放一个上游并发名额", ("model", "upstream"))
+INFLIGHT = registry.gauge(
+    "proxy_inflight_requests", "正在处理的请求数", ("stream",))
+UPSTREAM_INFLIGHT = registry.gauge(
+    "proxy_upstream_inflight_requests", "每个上游正在处理的请求数", ("upstream",))
+UPSTREAM_EJECTED = registry.gauge(
+    "proxy_upstream_ejected", "上游当前是否被摘除", ("upstream",), aggregate="max")
+ADMISSION_QUEUED = registry.gauge(
+    "proxy_admission_queued_requests", "等待准入的请求数")
+CACHE_REQUESTS = registry.counter(
+    "proxy_cache_requests", "响应缓存查询次数", ("result",))
+CACHE_ENTRIES = registry.gauge(
+    "proxy_cache_entries", "响应缓存条目数")
+CACHE_BYTES = registry.gauge(
+    "proxy_cache_bytes", "响应缓存占用的字节数")
+DISK_CACHE_ENTRIES = registry.gauge(
+    "proxy_disk_cache_entries", "磁盘缓存条目数")
+DISK_CACHE_BYTES = registry.gauge(
+    "proxy_disk_cache_bytes", "磁盘缓存分段文件的总字节数（含待压缩的无效数据）")
+SHARED_STATE_DROPPED = registry.counter(
+    "proxy_shared_state_dropped_messages", "未能发送到状态服务而丢弃的缓存写入和限速更新（reason为queue_full或disconnected）",
+    ("op", "reason"))
+SEMANTIC_CACHE_ENTRIES = registry.gauge(
+    "proxy_semantic_cache_entries", "语义缓存条目数")
@@ -0,0 +1,316 @@
+"""
+模拟Anthropic上游 - 实现 /v1/messages（流式和非流式）和 Message Batches API，用于离线压测和测试
+支持配置首包延迟、输出速度、输出长度和错误注入；请求带tools且最后一条消息不是工具结果时返回一次工具调用
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+
+@dataclass
+class MockConfig:
+    """模拟上游的行为配置"""
+    # 首包延迟（秒）
+    latency: float = 0.05
+    # 流式输出速度（token/秒），0表示不限速
+    tokens_per_second: float = 0.0
+    # 输出token数（不超过请求的max_tokens）
+    output_tokens: int = 64
+    # 每个流式增量包含的token数
+    tokens_per_chunk: int = 1
+    # 错误注入概率和状态码
+    error_rate: float = 0.0
+    error_status: int = 529
+    # 返回的限流响应头中的每分钟请求数限额，0表示不返回
+    ratelimit_rpm: int = 0
+    # 批处理从创建到处理完成的时间（秒）
+    batch_seconds: float = 1.0
+
+
+def _error_body(status: int) -> dict:
+    kinds = {429: "rate_limit_error", 529: "overloaded_error", 500: "api_error", 503: "api_error"}
+    return {"type": "error", "error": {"type": kinds.get(status, "api_error"), "message": f"mock error {status}"}}
+
+
+def _timestamp(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _sse(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+def create_mock_app(config: Optional[MockConfig] = None) -> FastAPI:
+    """创建模拟上游应用"""
+    config = config or MockConfig()
+    app = FastAPI(title="Mock Anthropic Upstream")
+    app.state.config = config
+    app.state.requests = 0
+    # 正在输出的流式响应数，下游断开连接后减少
+    app.state.streams = 0
+    # 批处理ID -> {"requests", "created_at", "ends_at", "cancel_at"}
+    app.state.batches = {}
+
+    def ratelimit_headers() -> dict:
+        if not config.ratelimit_rpm:
+            return {}
+        return {
+            "anthropic-ratelimit-requests-limit": str(config.ratelimit_rpm),
+            "anthropic-ratelimit-requests-remaining": str(config.ratelimit_rpm - 1),
+        }
+
+    def count_input_tokens(body: dict) -> int:
+        text = json.dumps(body.get("messages", []), ensure_ascii=False) + json.dumps(body.get("system", ""))
+        return max(1, len(text) // 4)
+
+    def count_output_tokens(body: dict) -> int:
+        return max(1, min(config.output_tokens, int(body.get("max_tokens", config.output_tokens))))
+
+    def tool_call_for(body: dict) -> Optional[dict]:
+        """需要调用工具时返回tool_use块：使用tool_choice指定的工具，否则使用第一个工具"""
+        tools = body.get("tools")
+        choice = body.get("tool_choice") or {}
+        if not tools or choice.get("type") == "none":
+            return None
+        messages = body.get("messages") or [{}]
+        content = messages[-1].get("content")
+        if isinstance(content, list) and any(block.get("type") == "tool_result" for block in content):
+            return None
+        name = choice.get("name") or tools[0]["name"]
+        return {
+            "type": "tool_use",
+            "id": f"toolu_{uuid.uuid4().hex[:24]}",
+            "name": name,
+            "input": {"query": "token " * count_output_tokens(body), "limit": 3},
+        }
+
+    def build_message(body: dict) -> dict:
+        output_tokens = count_output_tokens(body)
+        tool_use = tool_call_for(body)
+        if tool_use is not None:
+            content = [{"type": "text", "text": "calling tool"}, tool_use]
+            stop_reason = "tool_use"
+        else:
+            content = [{"type": "text", "text": "token " * output_tokens}]
+            stop_reason = "max_tokens" if output_tokens == body.get("max_tokens") else "end_turn"
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "mock-model"),
+            "content": content,
+            "stop_reason": stop_reason,
+            "stop_sequence": None,
+            "usage": {"input_tokens": count_input_tokens(body), "output_tokens": output_tokens},
+        }
+
+    async def tracked(events):
+        app.state.streams += 1
+        try:
+            async for event in events:
+                yield event
+        finally:
+            app.state.streams -= 1
+
+    @app.get("/health")
+    async def health():
+        return {"status": "healthy", "requests": app.state.requests, "streams": app.state.streams}
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        app.state.requests += 1
+        body = await request.json()
+        model = body.get("model", "mock-model")
+        output_tokens = count_output_tokens(body)
+        input_tokens = count_input_tokens(body)
+        message_id = f"msg_{uuid.uuid4().hex[:24]}"
+
+        await asyncio.sleep(config.latency)
+
+        if config.error_rate and random.random() < config.error_rate:
+            headers = {"retry-after": "1"} if config.error_status == 429 else {}
+            return JSONResponse(_error_body(config.error_status), status_code=config.error_status, headers=headers)
+
+        if not body.get("stream"):
+            if config.tokens_per_second:
+                await asyncio.sleep(output_tokens / config.tokens_per_second)
+            return JSONResponse(build_message(body), headers=ratelimit_headers())
+
+        async def events():
+            yield _sse("message_start", {"type": "message_start", "message": {
+                "id": message_id, "type": "message", "role": "assistant", "model": model, "content": [],
+                "stop_reason": None, "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+            }})
+            yield _sse("content_block_start", {
+                "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+            yield _sse("ping", {"type": "ping"})
+
+            step = max(1, config.tokens_per_chunk)
+            interval = step / config.tokens_per_second if config.tokens_per_second else 0.0
+            next_at = time.monotonic()
+            for sent in range(0, output_tokens, step):
+                if interval:
+                    next_at += interval
+                    await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+                yield _sse("content_block_delta", {
+                    "type": "content_block_delta", "index": 0,
+                    "delta": {"type": "text_delta", "text": "token " * min(step, output_tokens - sent)}})
+
+            yield _sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+
+            stop_reason = "max_tokens" if output_tokens == body.get("max_tokens") else "end_turn"
+            tool_use = tool_call_for(body)
+            if tool_use is not None:
+                # 工具参数按固定长度切成多个input_json_delta
+                stop_reason = "tool_use"
+                yield _sse("content_block_start", {"type": "content_block_start", "index": 1, "content_block": {
+                    "type": "tool_use", "id": tool_use["id"], "name": tool_use["name"], "input": {}}})
+                arguments = json.dumps(tool_use["input"])
+                for start in range(0, len(arguments), 16):
+                    yield _sse("content_block_delta", {
+                        "type": "content_block_delta", "index": 1,
+                        "delta": {"type": "input_json_delta", "partial_json": arguments[start:start + 16]}})
+                yield _sse("content_block_stop", {"type": "content_block_stop", "index": 1})
+
+            yield _sse("message_delta", {
+                "type": "message_delta",
+                "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                "usage": {"output_tokens": output_tokens}})
+            yield _sse("message_stop", {"type": "message_stop"})
+
+        return StreamingResponse(tracked(events()), media_type="text/event-stream", headers=ratelimit_headers())
+
+    def batch_object(batch_id: str, base_url: str) -> dict:
+        batch = app.state.batches[batch_id]
+        now = time.time()
+        ended_at = batch["cancel_at"] or batch["ends_at"]
+        ended = now >= ended_at
+        total = len(batch["requests"])
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        if not ended:
+            counts["processing"] = total
+        else:
+            for result in batch_results(batch):
+                counts[result["result"]["type"]] += 1
+        if ended:
+            status = "ended"
+        elif batch["cancel_at"]:
+            status = "canceling"
+        else:
+            status = "in_progress"
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": status,
+            "request_counts": counts,
+            "created_at": _timestamp(batch["created_at"]),
+            "expires_at": _timestamp(batch["created_at"] + 86400),
+            "ended_at": _timestamp(ended_at) if ended else None,
+            "cancel_initiated_at": _timestamp(batch["cancel_at"]) if batch["cancel_at"] else None,
+            "archived_at": None,
+            "results_url": f"{base_url}v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def batch_results(batch: dict) -> list:
+        # 结果在批处理结束后生成一次，之后保持不变
+        if batch.get("results") is None:
+            results = []
+            for item in batch["requests"]:
+                if batch["cancel_at"] and batch["cancel_at"] < batch["ends_at"]:
+                    result = {"type": "canceled"}
+                elif config.error_rate and random.random() < config.error_rate:
+                    result = {"type": "errored", "error": _error_body(config.error_status)}
+                else:
+                    result = {"type": "succeeded", "message": build_message(item["params"])}
+                results.append({"custom_id": item["custom_id"], "result": result})
+            batch["results"] = results
+        return batch["results"]
+
+    def get_batch(batch_id: str) -> dict:
+        if batch_id not in app.state.batches:
+            raise HTTPException(status_code=404, detail="batch not found")
+        return app.state.batches[batch_id]
+
+    @app.post("/v1/messages/batches")
+    async def create_batch(request: Request):
+        body = await request.json()
+        requests = body.get("requests") or []
+        custom_ids = [item.get("custom_id") for item in requests]
+        if not requests or len(set(custom_ids)) != len(custom_ids):
+            return JSONResponse({"type": "error", "error": {
+                "type": "invalid_request_error", "message": "requests must be non-empty with unique custom_id"}},
+                status_code=400)
+        app.state.requests += 1
+        batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+        now = time.time()
+        app.state.batches[batch_id] = {
+            "requests": requests, "created_at": now, "ends_at": now + config.batch_seconds, "cancel_at": None,
+        }
+        return batch_object(batch_id, str(request.base_url))
+
+    @app.get("/v1/messages/batches/{batch_id}")
+    async def retrieve_batch(batch_id: str, request: Request):
+        get_batch(batch_id)
+        return batch_object(batch_id, str(request.base_url))
+
+    @app.post("/v1/messages/batches/{batch_id}/cancel")
+    async def cancel_batch(batch_id: str, request: Request):
+        batch = get_batch(batch_id)
+        if batch["cancel_at"] is None and time.time() < batch["ends_at"]:
+            batch["cancel_at"] = time.time()
+        return batch_object(batch_id, str(request.base_url))
+
+    @app.get("/v1/messages/batches/{batch_id}/results")
+    async def batch_results_file(batch_id: str):
+        batch = get_batch(batch_id)
+        if time.time() < (batch["cancel_at"] or batch["ends_at"]):
+            return JSONResponse(_error_body(400), status_code=400)
+        lines = (json.dumps(result, ensure_ascii=False) for result in batch_results(batch))
+        return Response("\n".join(lines) + "\n", media_type="application/binary")
+
+    return app
+
+
+app = create_mock_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟Anthropic上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=MockConfig.latency, help="首包延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=MockConfig.tokens_per_second)
+    parser.add_argument("--output-tokens", type=int, default=MockConfig.output_tokens)
+    parser.add_argument("--tokens-per-chunk", type=int, default=MockConfig.tokens_per_chunk)
+    parser.add_argument("--error-rate", type=float, default=MockConfig.error_rate)
+    parser.add_argument("--error-status", type=int, default=MockConfig.error_status)
+    parser.add_argument("--ratelimit-rpm", type=int, default=MockConfig.ratelimit_rpm)
+    parser.add_argument("--batch-seconds", type=float, default=MockConfig.batch_seconds, help="批处理完成耗时（秒）")
+    args = parser.parse_args()
+
+    import uvicorn
+    config = MockConfig(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        tokens_per_chunk=args.tokens_per_chunk,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        ratelimit_rpm=args.ratelimit_rpm,
+        batch_seconds=args.batch_seconds,
+    )
+    uvicorn.run(create_mock_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+提示词缓存 - 为重复出现的system和消息前缀自动加上 cache_control 断点，使上游的提示词缓存生效
+"""
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from ratelimit import estimate_message_tokens, estimate_system_tokens, estimate_tools_tokens
+
+EPHEMERAL = {"type": "ephemeral"}
+# 上游每个请求最多允许的cache_control断点数
+MAX_BREAKPOINTS = 4
+
+
+class PrefixTracker:
+    """记录最近出现过的前缀哈希，超过容量时淘汰最久未出现的"""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[bytes, None]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def seen(self, key: bytes) -> bool:
+        """查询前缀是否出现过，并记录本次出现"""
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return True
+        self._seen[key] = None
+        if len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+        return False
+
+
+def _mark_content(content: Any) -> List[Dict[str, Any]]:
+    """把content转为内容块列表，并在最后一个块上加断点（不修改原对象）"""
+    if isinstance(content, str):
+        return [{"type": "text", "text": content, "cache_control": EPHEMERAL}]
+    blocks = list(content)
+    blocks[-1] = {**blocks[-1], "cache_control": EPHEMERAL}
+    return blocks
+
+
+def _count_breakpoints(blocks: Any) -> int:
+    if not isinstance(blocks, list):
+        return 0
+    return sum(1 for block in blocks if isinstance(block, dict) and "cache_control" in block)
+
+
+def existing_breakpoints(kwargs: Dict[str, Any]) -> int:
+    """请求中已有的cache_control断点数"""
+    count = _count_breakpoints(kwargs.get("tools")) + _count_breakpoints(kwargs.get("system"))
+    for message in kwargs.get("messages") or ():
+        count += _count_breakpoints(message.get("content"))
+    return count
+
+
+def add_cache_breakpoints(kwargs: Dict[str, Any], tracker: PrefixTracker, min_tokens: int = 1024) -> Dict[str, Any]:
+    """返回加上cache_control断点的请求参数
+
+    断点只加在之前出现过的前缀上：工具定义、system提示词，以及messages中最长的重复前缀。
+    前缀估算的token数少于min_tokens时上游不会缓存，不加断点。加上请求中已有的断点不超过
+    MAX_BREAKPOINTS 个，名额不够时优先保留覆盖前缀最长的断点（消息、system、工具定义）。
+    """
+    system = kwargs.get("system")
+    messages = kwargs.get("messages") or []
+
+    # 前缀哈希依次累加模型、工具定义、system和每条消息（与上游缓存前缀的顺序一致），不同模型的缓存互不共用
+    digest = hashlib.sha256(kwargs.get("model", "").encode("utf-8"))
+    digest.update(b"\0")
+    tools = kwargs.get("tools")
+    tokens = estimate_tools_tokens(tools)
+    mark_tools = False
+    if tools:
+        digest.update(json.dumps(tools, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+        mark_tools = tracker.seen(digest.digest()) and tokens >= min_tokens
+    digest.update(b"\0")
+    mark_system = False
+    if isinstance(system, str) and system:
+        digest.update(system.encode("utf-8"))
+        tokens += estimate_system_tokens(system)
+        mark_system = tracker.seen(digest.digest()) and tokens >= min_tokens
+
+    mark_index: Optional[int] = None
+    for index, message in enumerate(messages):
+        digest.update(b"\0")
+        digest.update(json.dumps(message, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+        tokens += estimate_message_tokens(message)
+        if tracker.seen(digest.digest()) and tokens >= min_tokens and message.get("content"):
+            mark_index = index
+
+    # 名额不够时依次放弃覆盖前缀较短的断点
+    budget = MAX_BREAKPOINTS - existing_breakpoints(kwargs)
+    if mark_index is not None:
+        if budget > 0:
+            budget -= 1
+        else:
+            mark_index = None
+    if mark_system:
+        if budget > 0:
+            budget -= 1
+        else:
+            mark_system = False
+    mark_tools = mark_tools and budget > 0
+
+    if not mark_tools and not mark_system and mark_index is None:
+        return kwargs
+
+    result = dict(kwargs)
+    if mark_tools:
+        result["tools"] = [*tools[:-1], {**tools[-1], "cache_control": EPHEMERAL}]
+    if mark_system:
+        result["system"] = _mark_content(system)
+    if mark_index is not None:
+        marked = list(messages)
+        marked[mark_index] = {**messages[mark_index], "content": _mark_content(messages[mark_index]["content"])}
+        result["messages"] = marked
+    return result
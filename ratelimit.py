@@ -0,0 +1,184 @@
+"""
+速率限制 - 根据上游返回的限流响应头维护每个密钥的令牌桶，在发送前预先限速
+"""
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Mapping, Optional
+
+# 上游限流响应头前缀
+HEADER_PREFIX = "anthropic-ratelimit-"
+
+
+def parse_reset(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    """解析RFC 3339格式的重置时间，返回距离现在的秒数"""
+    if not value:
+        return None
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if reset_at.tzinfo is None:
+        reset_at = reset_at.replace(tzinfo=timezone.utc)
+    current = time.time() if now is None else now
+    return max(0.0, reset_at.timestamp() - current)
+
+
+def _text_tokens(text: str) -> int:
+    # 英文约4个字符一个token，中日韩等非ASCII文本按UTF-8字节数粗略估算
+    if text.isascii():
+        return len(text) // 4 + 1
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def _content_tokens(content: Any) -> int:
+    if isinstance(content, str):
+        return _text_tokens(content)
+    if isinstance(content, list):
+        total = 0
+        for block in content:
+            if isinstance(block, dict):
+                text = block.get("text")
+                if isinstance(text, str):
+                    total += _text_tokens(text)
+                elif block.get("type") == "tool_use":
+                    total += _text_tokens(json.dumps(block.get("input"), ensure_ascii=False))
+                elif block.get("type") == "tool_result":
+                    total += _content_tokens(block.get("content"))
+                else:
+                    # 图片等非文本块按固定数量估算
+                    total += 256
+        return total
+    return 0
+
+
+def estimate_system_tokens(system: Any) -> int:
+    """粗略估算system提示词的token数"""
+    return _content_tokens(system)
+
+
+def estimate_message_tokens(message: Mapping[str, Any]) -> int:
+    """粗略估算单条消息的token数，包括每条消息额外的格式开销"""
+    return 4 + _content_tokens(message.get("content"))
+
+
+def estimate_tools_tokens(tools: Any) -> int:
+    """粗略估算工具定义的token数"""
+    return _text_tokens(json.dumps(tools, ensure_ascii=False)) if tools else 0
+
+
+def estimate_input_tokens(kwargs: Mapping[str, Any]) -> int:
+    """根据转换后的Anthropic请求粗略估算输入token数"""
+    total = estimate_tools_tokens(kwargs.get("tools")) + estimate_system_tokens(kwargs.get("system"))
+    for message in kwargs.get("messages", ()):
+        total += estimate_message_tokens(message)
+    return total
+
+
+class TokenBucket:
+    """令牌桶，capacity为0时表示限额未知，不做限速"""
+
+    def __init__(self, capacity: float = 0.0, period: float = 60.0):
+        self.period = period
+        self.capacity = capacity
+        self.rate = capacity / period if capacity > 0 else 0.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: Optional[float] = None) -> float:
+        """预占令牌，返回需要等待的秒数"""
+        if self.capacity <= 0:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        # 单次请求超过桶容量时按容量计算，避免永远无法发送
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def sync(self, limit: Optional[float], remaining: Optional[float], reset_in: Optional[float]) -> None:
+        """用上游返回的限额、剩余量和重置时间校准令牌桶"""
+        now = time.monotonic()
+        self._refill(now)
+        if limit is not None and limit > 0:
+            if self.capacity <= 0:
+                self.tokens = limit
+            self.capacity = limit
+            self.rate = limit / self.period
+            if remaining is not None and reset_in and remaining < limit:
+                # 上游令牌持续补充，到重置时间时补满
+                self.rate = max(self.rate, (limit - remaining) / reset_in)
+        if remaining is not None and self.capacity > 0:
+            # 本地已预占了在途请求的令牌，只在上游剩余量更少时下调
+            self.tokens = min(self.tokens, remaining)
+
+
+class RateLimiter:
+    """单个上游密钥的请求数/分钟和token数/分钟限速器"""
+
+    def __init__(self, rpm: float = 0.0, tpm: float = 0.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        # 上游是否返回了单独的输入token限额
+        self._input_limited = False
+        # 上游返回429后，在Retry-After之前暂停发送
+        self.blocked_until = 0.0
+
+    def reserve(self, input_tokens: int) -> float:
+        """预占一次请求的令牌，返回发送前需要等待的秒数"""
+        now = time.monotonic()
+        return max(
+            self.requests.reserve(1, now),
+            self.tokens.reserve(input_tokens, now),
+            self.blocked_until - now,
+        )
+
+    async def wait(self, input_tokens: int) -> float:
+        """发送前预占令牌并等待，返回实际等待的秒数"""
+        delay = self.reserve(input_tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def update(self, headers: Mapping[str, str], status_code: int = 200) -> None:
+        """根据上游响应头更新令牌桶"""
+        self._sync(self.requests, headers, "requests")
+        if self._sync(self.tokens, headers, "input-tokens"):
+            self._input_limited = True
+        elif not self._input_limited:
+            self._sync(self.tokens, headers, "tokens")
+
+        if status_code == 429:
+            retry_after = _to_float(headers.get("retry-after")) or 1.0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    @staticmethod
+    def _sync(bucket: TokenBucket, headers: Mapping[str, str], kind: str) -> bool:
+        limit = _to_float(headers.get(f"{HEADER_PREFIX}{kind}-limit"))
+        remaining = _to_float(headers.get(f"{HEADER_PREFIX}{kind}-remaining"))
+        if limit is None and remaining is None:
+            return False
+        bucket.sync(limit, remaining, parse_reset(headers.get(f"{HEADER_PREFIX}{kind}-reset")))
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "requests_per_minute": self.requests.capacity,
+            "tokens_per_minute": self.tokens.capacity,
+        }
+
+
+def _to_float(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
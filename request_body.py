@@ -0,0 +1,177 @@
+"""
+请求体解析 - 边接收边解析聊天请求体，messages逐条转换为Anthropic格式，不保留完整的中间字典树
+"""
+import importlib.util
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+# 由_load_ijson在第一次增量解析时导入，ijson为可选依赖
+ijson = None
+ObjectBuilder = None
+_ijson_installed: Optional[bool] = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson为可选依赖
+    orjson = None
+
+from converter import ConversionError, convert_message, join_system
+
+_SCALARS = ("null", "boolean", "integer", "double", "number", "string")
+
+
+def ijson_available() -> bool:
+    """是否安装了ijson（只查找，不导入）"""
+    global _ijson_installed
+    if _ijson_installed is None:
+        _ijson_installed = importlib.util.find_spec("ijson") is not None
+    return _ijson_installed
+
+
+def _load_ijson() -> bool:
+    """导入ijson，未安装时返回False"""
+    global ijson, ObjectBuilder
+    if ijson is None and ijson_available():
+        import ijson as module
+        from ijson.common import ObjectBuilder as builder
+        ijson, ObjectBuilder = module, builder
+    return ijson is not None
+
+
+class BodyError(ValueError):
+    """请求体不是合法的JSON对象，或messages格式错误"""
+
+
+class ParsedBody:
+    """解析结果：messages以外的字段，以及转换好的system和Anthropic消息"""
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self.system_parts: List[str] = []
+        self.messages: List[Dict[str, Any]] = []
+        self.has_messages = False
+        # 已处理的消息数，用于在错误信息中指出出错的消息
+        self.count = 0
+
+    def add_message(self, message: Any) -> None:
+        index = self.count
+        self.count += 1
+        if not isinstance(message, dict):
+            raise BodyError(f"messages[{index}]必须是对象")
+        try:
+            convert_message(message, self.system_parts, self.messages)
+        except ConversionError as e:
+            raise BodyError(f"messages[{index}]: {e}") from e
+        except (AttributeError, TypeError) as e:
+            # 其它结构错误（如字段类型不对）同样作为请求体错误返回
+            raise BodyError(f"messages[{index}]格式错误: {e}") from e
+
+    def converted(self, system: Optional[str]) -> Tuple[Optional[str], List[Dict[str, Any]]]:
+        """返回 (system, Anthropic消息列表)，请求体中的system字段排在system消息之前"""
+        parts = [system] + self.system_parts if system else self.system_parts
+        return join_system(parts), self.messages
+
+
+class _EventBuilder:
+    """接收ijson事件：顶层字段照常构建，messages数组中的每条消息构建完成后立即转换"""
+
+    def __init__(self, body: ParsedBody):
+        self.body = body
+        self.depth = 0
+        self.key: Optional[str] = None
+        self.in_messages = False
+        self.builder: Optional[Any] = None
+        # 当前构建的值结束时的深度
+        self.value_depth = 0
+
+    def send(self, event: Tuple[str, Any]) -> None:
+        kind, value = event
+        if self.builder is not None:
+            self.builder.event(kind, value)
+            if kind in ("start_map", "start_array"):
+                self.depth += 1
+            elif kind in ("end_map", "end_array"):
+                self.depth -= 1
+            if self.depth == self.value_depth:
+                self._finish(self.builder.value)
+            return
+
+        if self.depth == 0:
+            if kind != "start_map":
+                raise BodyError("请求体必须是JSON对象")
+            self.depth = 1
+        elif self.depth == 1:
+            if kind == "map_key":
+                self.key = value
+            elif kind == "end_map":
+                self.depth = 0
+            elif kind in _SCALARS:
+                if self.key == "messages":
+                    raise BodyError("messages必须是数组")
+                self.body.fields[self.key] = value
+            elif kind == "start_array" and self.key == "messages":
+                self.body.has_messages = True
+                self.in_messages = True
+                self.depth = 2
+            else:
+                if self.key == "messages":
+                    raise BodyError("messages必须是数组")
+                self._start(kind, value, 1)
+        elif kind == "end_array":
+            # messages数组结束
+            self.in_messages = False
+            self.depth = 1
+        elif kind == "start_map":
+            self._start(kind, value, 2)
+        else:
+            raise BodyError(f"messages[{self.body.count}]必须是对象")
+
+    def _start(self, kind: str, value: Any, value_depth: int) -> None:
+        self.builder = ObjectBuilder()
+        self.builder.event(kind, value)
+        self.value_depth = value_depth
+        self.depth = value_depth + 1
+
+    def _finish(self, value: Any) -> None:
+        self.builder = None
+        if self.in_messages:
+            self.body.add_message(value)
+        else:
+            self.body.fields[self.key] = value
+
+
+async def parse_chat_body(chunks: AsyncIterator[bytes], incremental: bool = True) -> ParsedBody:
+    """解析聊天请求体
+
+    incremental为True且安装了ijson时随数据块到达增量解析，每条消息解析完即转换，内存峰值约为一次性解析的一半；
+    否则读取完整请求体后一次性解析（CPU开销更小，适合较小的请求体）。
+    """
+    body = ParsedBody()
+    if incremental and _load_ijson():
+        parser = ijson.basic_parse_coro(_EventBuilder(body), use_float=True)
+        try:
+            async for chunk in chunks:
+                if chunk:
+                    parser.send(chunk)
+            parser.close()
+        except ijson.JSONError as e:
+            raise BodyError(f"JSON解析失败: {e}") from e
+        if not body.has_messages:
+            raise BodyError("缺少messages字段")
+        return body
+
+    raw = b"".join([chunk async for chunk in chunks])
+    try:
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    except ValueError as e:
+        raise BodyError(f"JSON解析失败: {e}") from e
+    if not isinstance(data, dict):
+        raise BodyError("请求体必须是JSON对象")
+    messages = data.pop("messages", None)
+    if not isinstance(messages, list):
+        raise BodyError("缺少messages字段" if messages is None else "messages必须是数组")
+    body.fields = data
+    body.has_messages = True
+    for message in messages:
+        body.add_message(message)
+    return body
@@ -0,0 +1,108 @@
+"""
+重试与对冲请求 - 瞬时错误按指数退避加抖动重试，慢请求在p95延迟后向另一个上游发送副本
+"""
+import asyncio
+import random
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+import sdk
+
+
+def is_retryable(error: BaseException) -> bool:
+    """连接错误、超时、429、529和5xx可以重试"""
+    anthropic = sdk.load()
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 429) or error.status_code >= 500
+    return False
+
+
+def retry_after_of(error: BaseException) -> Optional[float]:
+    """读取上游错误响应中的Retry-After（秒）"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after", ""))
+    except ValueError:
+        return None
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, retry_after: Optional[float] = None) -> float:
+    """指数退避+完全抖动，上游给出Retry-After时至少等待该时长"""
+    delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, max_delay))
+    return delay
+
+
+async def retry_async(
+    fn: Callable[[], Awaitable[Any]],
+    max_retries: int,
+    base_delay: float,
+    max_delay: float,
+) -> Any:
+    """调用fn，遇到可重试的错误时退避后重试，最多重试max_retries次"""
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            await asyncio.sleep(backoff_delay(attempt, base_delay, max_delay, retry_after_of(e)))
+            attempt += 1
+
+
+class LatencyTracker:
+    """按模型记录最近的上游延迟，用于计算对冲请求的触发时间"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, model: str, seconds: float) -> None:
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, model: str, q: float) -> Optional[float]:
+        """样本不足时返回None"""
+        samples = self._samples.get(model)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def hedge(
+    primary: Callable[[], Awaitable[Any]],
+    secondary: Callable[[], Awaitable[Any]],
+    delay: float,
+) -> Any:
+    """先发送primary，delay秒内未完成则再发送secondary，返回先成功的结果并取消另一个"""
+    first = asyncio.ensure_future(primary())
+    tasks = {first}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return first.result()
+
+        tasks.add(asyncio.ensure_future(secondary()))
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
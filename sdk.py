@@ -0,0 +1,42 @@
+"""
+anthropic SDK按需加载 - SDK的导入耗时占冷启动的大部分，启动时在后台线程中预加载，不阻塞服务开始监听
+"""
+import asyncio
+import importlib
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Optional
+
+_preload: Optional[Future] = None
+# 后台预加载耗时（秒），未预加载时为None
+preload_seconds: Optional[float] = None
+
+
+def load() -> Any:
+    """返回anthropic模块，尚未导入时在当前线程同步导入"""
+    import anthropic
+    return anthropic
+
+
+def _timed_load() -> Any:
+    global preload_seconds
+    started = time.perf_counter()
+    module = importlib.import_module("anthropic")
+    preload_seconds = time.perf_counter() - started
+    return module
+
+
+def preload() -> Future:
+    """在后台线程中导入SDK，多次调用共用同一次导入"""
+    global _preload
+    if _preload is None:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sdk-preload")
+        _preload = executor.submit(_timed_load)
+        executor.shutdown(wait=False)
+    return _preload
+
+
+async def ready() -> None:
+    """等待后台预加载完成，避免第一次调用上游时在事件循环线程中等待导入"""
+    if _preload is not None and not _preload.done():
+        await asyncio.wrap_future(_preload)
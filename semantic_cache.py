@@ -0,0 +1,226 @@
+"""
+语义缓存 - 对精确缓存未命中的请求，按最后一条用户消息的相似度查找近似重复的请求并复用响应
+
+文本用哈希n-gram向量化（不需要下载模型），向量存放在每个命名空间的NumPy矩阵中，查询时一次矩阵乘法算出全部余弦相似度。
+numpy在第一次创建向量器时才导入，未启用语义缓存时不增加启动时间。
+"""
+import importlib.util
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from cache import make_cache_key
+
+# 由_load_numpy在第一次使用时导入
+np = None
+
+
+def is_available() -> bool:
+    """是否安装了numpy（只查找，不导入）"""
+    return np is not None or importlib.util.find_spec("numpy") is not None
+
+
+def _load_numpy() -> None:
+    global np
+    if np is None:
+        if not is_available():
+            raise RuntimeError("语义缓存需要安装 numpy")
+        import numpy
+        np = numpy
+
+
+_WORD = re.compile(r"\w+")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+class HashedNgramVectorizer:
+    """把文本映射为L2归一化的定长向量：词和字符三元组经crc32哈希到dim维，符号位减少哈希冲突的偏差"""
+
+    def __init__(self, dim: int = 512, ngram: int = 3):
+        _load_numpy()
+        self.dim = dim
+        self.ngram = ngram
+
+    def features(self, text: str) -> List[str]:
+        words = _WORD.findall(text.lower())
+        normalized = " " + " ".join(words) + " "
+        n = self.ngram
+        grams = [normalized[i:i + n] for i in range(len(normalized) - n + 1)]
+        # 词特征加前缀，避免与同样内容的字符三元组落到同一个桶
+        return ["w:" + word for word in words] + grams
+
+    def transform(self, text: str) -> "np.ndarray":
+        vector = np.zeros(self.dim, dtype=np.float32)
+        features = self.features(text)
+        if not features:
+            return vector
+        hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint32, count=len(features))
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, (hashes % self.dim).astype(np.intp), signs)
+        norm = float(np.linalg.norm(vector))
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+def _text_of(content: Any) -> Optional[str]:
+    """纯文本消息内容，含图片、工具调用等非文本块时返回None"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list) and content:
+        parts = []
+        for block in content:
+            if not isinstance(block, dict) or block.get("type") != "text":
+                return None
+            parts.append(block.get("text", ""))
+        return "\n".join(parts)
+    return None
+
+
+def split_query(kwargs: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """把请求拆成 (命名空间, 查询文本)，最后一条消息不是纯文本的用户消息时返回None
+
+    命名空间包含模型、参数、工具、system和之前的所有消息，只有命名空间完全相同的请求之间才比较相似度；
+    查询文本中的数字也计入命名空间，数字不同的问题（如“2+2等于几”和“3+3等于几”）不会互相命中。
+    """
+    messages = kwargs.get("messages") or []
+    if not messages or messages[-1].get("role") != "user":
+        return None
+    text = _text_of(messages[-1].get("content"))
+    if not text or not text.strip():
+        return None
+
+    scope = {key: value for key, value in kwargs.items() if key != "messages"}
+    scope["messages"] = messages[:-1]
+    scope["numbers"] = _NUMBER.findall(text)
+    return make_cache_key(scope), text
+
+
+class _Namespace:
+    """一个命名空间的向量矩阵，行号与条目键一一对应，删除时用最后一行填补空位"""
+
+    __slots__ = ("matrix", "keys")
+
+    def __init__(self, dim: int):
+        self.matrix = np.empty((4, dim), dtype=np.float32)
+        self.keys: List[str] = []
+
+    def add(self, key: str, vector: "np.ndarray") -> int:
+        row = len(self.keys)
+        if row == len(self.matrix):
+            grown = np.empty((row * 2, self.matrix.shape[1]), dtype=np.float32)
+            grown[:row] = self.matrix
+            self.matrix = grown
+        self.matrix[row] = vector
+        self.keys.append(key)
+        return row
+
+    def remove(self, row: int) -> Optional[str]:
+        """删除一行，返回被移动到该行的条目键（删除的是最后一行时返回None）"""
+        last = len(self.keys) - 1
+        moved = None
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            moved = self.keys[row] = self.keys[last]
+        self.keys.pop()
+        # 条目大量减少后收缩矩阵
+        if len(self.matrix) > 64 and len(self.keys) * 4 < len(self.matrix):
+            self.matrix = self.matrix[:len(self.matrix) // 2].copy()
+        return moved
+
+    def search(self, vector: "np.ndarray", threshold: float) -> List[Tuple[str, float]]:
+        """相似度不低于threshold的 (条目键, 相似度)，按相似度从高到低排列"""
+        scores = self.matrix[:len(self.keys)] @ vector
+        rows = np.flatnonzero(scores >= threshold)
+        rows = rows[np.argsort(-scores[rows], kind="stable")]
+        return [(self.keys[row], float(scores[row])) for row in rows]
+
+
+class SemanticCache:
+    """按命名空间分组的语义缓存，全局按条目数做LRU淘汰，每个条目带TTL
+
+    每个命名空间的条目数受max_entries限制，逐行计算相似度是精确的最近邻查询，不需要近似索引。
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        max_entries: int = 10000,
+        ttl: float = 3600.0,
+        vectorizer: Optional[HashedNgramVectorizer] = None,
+    ):
+        _load_numpy()
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.vectorizer = vectorizer or HashedNgramVectorizer()
+        self._namespaces: Dict[str, _Namespace] = {}
+        # 条目键 -> [命名空间, 行号, 响应体, 过期时间]，按最近使用排序
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def embed(self, text: str) -> "np.ndarray":
+        return self.vectorizer.transform(text)
+
+    def get(self, namespace: str, vector: "np.ndarray") -> Optional[Tuple[bytes, float]]:
+        """查找相似度不低于阈值且未过期的最近条目，返回 (响应体, 相似度)"""
+        space = self._namespaces.get(namespace)
+        if space is None or not space.keys:
+            return None
+
+        # 跳过已过期的候选，相似度稍低但未过期的条目仍然可以命中；过期条目在查找结束后删除
+        now = time.monotonic()
+        found = None
+        expired = []
+        for key, score in space.search(vector, self.threshold):
+            if self._entries[key][3] > now:
+                found = key, score
+                break
+            expired.append(key)
+        for key in expired:
+            self._remove(key)
+        if found is None:
+            return None
+
+        key, score = found
+        self._entries.move_to_end(key)
+        return self._entries[key][2], score
+
+    def set(self, namespace: str, vector: "np.ndarray", body: bytes) -> None:
+        """写入条目，超出容量或过期的最久未使用条目被淘汰"""
+        if not vector.any():
+            return
+
+        space = self._namespaces.get(namespace)
+        if space is None:
+            space = self._namespaces[namespace] = _Namespace(self.vectorizer.dim)
+
+        key = str(self._next_id)
+        self._next_id += 1
+        row = space.add(key, vector)
+        self._entries[key] = [namespace, row, body, time.monotonic() + self.ttl]
+
+        now = time.monotonic()
+        while self._entries:
+            oldest, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and entry[3] > now:
+                break
+            self._remove(oldest)
+
+    def clear(self) -> None:
+        self._namespaces.clear()
+        self._entries.clear()
+
+    def _remove(self, key: str) -> None:
+        namespace, row, _, _ = self._entries.pop(key)
+        space = self._namespaces[namespace]
+        moved = space.remove(row)
+        if moved is not None:
+            self._entries[moved][1] = row
+        if not space.keys:
+            del self._namespaces[namespace]
@@ -0,0 +1,385 @@
+"""
+共享状态 - 多worker模式下通过Unix socket上的状态服务共享响应缓存、限速令牌桶和监控指标
+
+状态服务是一个单独的进程，所有状态只保存在这里，各worker通过一条长连接访问；
+协议为长度前缀的帧：JSON头部（操作和参数）加上可选的二进制负载（缓存内容、指标快照）。
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import struct
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Mapping, Optional, Tuple
+
+from cache import ResponseCache
+from config import (
+    RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL,
+    DISK_CACHE_DIR, DISK_CACHE_MAX_BYTES, DISK_CACHE_SEGMENT_BYTES, DISK_CACHE_TTL, DISK_CACHE_COMPACT_INTERVAL,
+)
+from disk_cache import DiskCache
+from metrics import CACHE_BYTES, CACHE_ENTRIES, DISK_CACHE_BYTES, DISK_CACHE_ENTRIES, SHARED_STATE_DROPPED
+from ratelimit import HEADER_PREFIX, RateLimiter
+
+# 帧头：JSON头部长度、二进制负载长度
+_FRAME = struct.Struct(">II")
+# 单帧大小上限，避免异常数据导致一次分配大量内存
+MAX_FRAME_BYTES = 256 * 1024 * 1024
+# worker推送指标快照的间隔（秒）
+METRICS_PUSH_INTERVAL = 1.0
+# 连接失败后再次尝试连接的间隔（秒）
+RECONNECT_INTERVAL = 1.0
+# 不需要回复的操作（缓存写入、限速更新）的发送队列上限，超出后丢弃新消息
+SEND_QUEUE_MAX_MESSAGES = 1024
+SEND_QUEUE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class StateUnavailable(ConnectionError):
+    """状态服务不可用"""
+
+
+def encode_frame(header: Dict[str, Any], payload: bytes = b"") -> bytes:
+    data = json.dumps(header, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return _FRAME.pack(len(data), len(payload)) + data + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[Dict[str, Any], bytes]:
+    header_size, payload_size = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    if header_size + payload_size > MAX_FRAME_BYTES:
+        raise ValueError(f"帧大小超过 {MAX_FRAME_BYTES} 字节")
+    header = json.loads(await reader.readexactly(header_size))
+    payload = await reader.readexactly(payload_size) if payload_size else b""
+    return header, payload
+
+
+class StateServer:
+    """状态服务：所有状态只在同一个事件循环中修改，不需要加锁；磁盘缓存的读写在线程池中进行"""
+
+    def __init__(self, cache: ResponseCache):
+        self.cache = cache
+        self.limiters: Dict[str, RateLimiter] = {}
+        # 每个worker最近一次推送的指标快照（按进程号），worker退出后只保留计数器和直方图
+        self.snapshots: Dict[int, Dict[str, Any]] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        pids = set()
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                if header.get("op") == "metrics_push":
+                    pids.add(header.get("pid"))
+                result, data = await self.dispatch(header, payload)
+                if header.get("id"):
+                    writer.write(encode_frame({**result, "id": header["id"]}, data))
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            for pid in pids:
+                self._retire(pid)
+            writer.close()
+
+    async def dispatch(self, header: Dict[str, Any], payload: bytes) -> Tuple[Dict[str, Any], bytes]:
+        handler = getattr(self, f"_op_{header.get('op')}", None)
+        if handler is None:
+            return {"error": f"未知操作: {header.get('op')}"}, b""
+        try:
+            result = handler(header, payload)
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result
+        except (KeyError, TypeError, ValueError) as e:
+            return {"error": f"{type(e).__name__}: {e}"}, b""
+
+    async def _op_cache_get(self, header, payload):
+        value = await self.cache.get(header["key"])
+        return {"hit": value is not None}, value or b""
+
+    async def _op_cache_set(self, header, payload):
+        await self.cache.set(header["key"], payload)
+        return {}, b""
+
+    def _limiter(self, header) -> RateLimiter:
+        limiter = self.limiters.get(header["key"])
+        if limiter is None:
+            limiter = self.limiters[header["key"]] = RateLimiter(header.get("rpm", 0.0), header.get("tpm", 0.0))
+        return limiter
+
+    def _op_ratelimit_reserve(self, header, payload):
+        limiter = self._limiter(header)
+        return {"delay": limiter.reserve(header["tokens"]), "status": limiter.status()}, b""
+
+    def _op_ratelimit_update(self, header, payload):
+        self._limiter(header).update(header["headers"], header["status"])
+        return {}, b""
+
+    def _op_metrics_push(self, header, payload):
+        self.snapshots[header["pid"]] = json.loads(payload)
+        return {}, b""
+
+    def _op_metrics_collect(self, header, payload):
+        # 缓存相关的仪表由状态服务提供，worker本地没有缓存
+        CACHE_ENTRIES.set(len(self.cache))
+        CACHE_BYTES.set(self.cache.size_bytes)
+        gauges = [CACHE_ENTRIES, CACHE_BYTES]
+        if self.cache.lower is not None:
+            DISK_CACHE_ENTRIES.set(len(self.cache.lower))
+            DISK_CACHE_BYTES.set(self.cache.lower.size_bytes)
+            gauges += [DISK_CACHE_ENTRIES, DISK_CACHE_BYTES]
+        cache_snapshot = {metric.name: metric.snapshot() for metric in gauges}
+        snapshots = list(self.snapshots.values()) + [cache_snapshot]
+        return {}, json.dumps(snapshots, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    def _retire(self, pid: Any) -> None:
+        """worker断开后丢弃它的仪表值，计数器和直方图继续计入总数"""
+        snapshot = self.snapshots.get(pid)
+        if snapshot is not None:
+            self.snapshots[pid] = {name: metric for name, metric in snapshot.items() if metric.get("kind") != "gauge"}
+
+
+async def serve(path: str, cache: ResponseCache) -> None:
+    """在Unix socket上运行状态服务，直到被取消"""
+    state = StateServer(cache)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(state.handle, path=path)
+    os.chmod(path, 0o600)
+    async with server:
+        await server.serve_forever()
+
+
+def run_server(path: str) -> None:
+    """在当前进程中运行状态服务（阻塞），缓存容量取自配置"""
+    cache = ResponseCache(
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        ttl=RESPONSE_CACHE_TTL,
+    )
+    # 多worker模式下只有状态服务打开磁盘缓存目录
+    if DISK_CACHE_DIR:
+        cache.lower = DiskCache(
+            DISK_CACHE_DIR,
+            max_bytes=DISK_CACHE_MAX_BYTES,
+            segment_bytes=DISK_CACHE_SEGMENT_BYTES,
+            ttl=DISK_CACHE_TTL,
+            compact_interval=DISK_CACHE_COMPACT_INTERVAL,
+        ).start()
+    try:
+        asyncio.run(serve(path, cache))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if cache.lower is not None:
+            cache.lower.close()
+
+
+def start_server_process(path: str, timeout: float = 10.0) -> multiprocessing.Process:
+    """在子进程中启动状态服务，等待socket可以连接后返回"""
+    process = multiprocessing.Process(target=run_server, args=(path,), name="shared-state", daemon=True)
+    process.start()
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if not process.is_alive():
+            raise RuntimeError(f"状态服务启动失败（退出码 {process.exitcode}）")
+        if time.monotonic() > deadline:
+            process.terminate()
+            raise RuntimeError(f"状态服务在 {timeout} 秒内未就绪: {path}")
+        time.sleep(0.05)
+    return process
+
+
+class StateClient:
+    """状态服务客户端：每个worker共用一条连接，多个请求可以同时在途，连接断开后自动重连"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._connect_lock = asyncio.Lock()
+        self._drain_lock = asyncio.Lock()
+        self._retry_at = 0.0
+        # 不需要回复的消息：(操作, 帧)，由后台任务按顺序写出
+        self._outbox: Deque[Tuple[str, bytes]] = deque()
+        self._outbox_bytes = 0
+        self._outbox_ready = asyncio.Event()
+        self._send_task: Optional[asyncio.Task] = None
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        async with self._connect_lock:
+            if self._writer is not None:
+                return self._writer
+            if time.monotonic() < self._retry_at:
+                raise StateUnavailable(f"状态服务不可用: {self.path}")
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                self._retry_at = time.monotonic() + RECONNECT_INTERVAL
+                raise StateUnavailable(f"无法连接状态服务 {self.path}: {e}") from e
+            self._read_task = asyncio.create_task(self._read_loop(self._reader))
+            return self._writer
+
+    async def _read_loop(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                future = self._pending.pop(header.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result((header, payload))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            self._disconnect()
+
+    def _disconnect(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(StateUnavailable("与状态服务的连接已断开"))
+
+    async def close(self) -> None:
+        if self._send_task is not None:
+            self._send_task.cancel()
+            self._send_task = None
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+        self._disconnect()
+
+    async def call(self, op: str, payload: bytes = b"", **fields) -> Tuple[Dict[str, Any], bytes]:
+        """发送操作并等待回复，返回 (回复头部, 回复负载)"""
+        writer = await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            writer.write(encode_frame({"op": op, "id": request_id, **fields}, payload))
+            async with self._drain_lock:
+                await writer.drain()
+            header, data = await future
+        except StateUnavailable:
+            raise
+        except ConnectionError as e:
+            self._pending.pop(request_id, None)
+            future.cancel()
+            self._disconnect()
+            raise StateUnavailable(f"与状态服务通信失败: {e}") from e
+        finally:
+            self._pending.pop(request_id, None)
+        if "error" in header:
+            raise StateUnavailable(header["error"])
+        return header, data
+
+    def send(self, op: str, payload: bytes = b"", **fields) -> None:
+        """发送不需要回复的操作：放入有界的发送队列，由后台任务写出（断开后自动重连），队列已满时丢弃并计数"""
+        frame = encode_frame({"op": op, **fields}, payload)
+        if len(self._outbox) >= SEND_QUEUE_MAX_MESSAGES or self._outbox_bytes + len(frame) > SEND_QUEUE_MAX_BYTES:
+            SHARED_STATE_DROPPED.labels(op, "queue_full").inc()
+            return
+        self._outbox.append((op, frame))
+        self._outbox_bytes += len(frame)
+        self._outbox_ready.set()
+        if self._send_task is None or self._send_task.done():
+            self._send_task = asyncio.get_running_loop().create_task(self._send_loop())
+
+    async def _send_loop(self) -> None:
+        while True:
+            if not self._outbox:
+                self._outbox_ready.clear()
+                await self._outbox_ready.wait()
+                continue
+            try:
+                writer = await self._connect()
+            except StateUnavailable:
+                # 消息留在队列中，到可以重连时再发送；这期间队列满了就丢弃新消息
+                await asyncio.sleep(max(self._retry_at - time.monotonic(), 0.05))
+                continue
+            op, frame = self._outbox.popleft()
+            self._outbox_bytes -= len(frame)
+            try:
+                writer.write(frame)
+                # 等待写缓冲区排空，状态服务处理不过来时发送队列随之积压，而不是在内存中无限堆积
+                async with self._drain_lock:
+                    await writer.drain()
+            except ConnectionError:
+                SHARED_STATE_DROPPED.labels(op, "disconnected").inc()
+                self._disconnect()
+
+    async def cache_get(self, key: str) -> Optional[bytes]:
+        header, data = await self.call("cache_get", key=key)
+        return data if header["hit"] else None
+
+    def cache_set(self, key: str, value: bytes) -> None:
+        self.send("cache_set", value, key=key)
+
+    async def push_metrics(self, snapshot: Dict[str, Any]) -> None:
+        payload = json.dumps(snapshot, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        await self.call("metrics_push", payload, pid=os.getpid())
+
+    async def collect_metrics(self) -> List[Dict[str, Any]]:
+        """返回所有worker的指标快照"""
+        _, data = await self.call("metrics_collect")
+        return json.loads(data)
+
+    def limiter(self, base_url: str, api_key: str, rpm: float = 0.0, tpm: float = 0.0) -> "SharedRateLimiter":
+        """返回共享的限速器，同一上游密钥在所有worker中使用同一组令牌桶"""
+        key = hashlib.sha256(f"{base_url}\0{api_key}".encode("utf-8")).hexdigest()
+        return SharedRateLimiter(self, key, rpm, tpm)
+
+
+class SharedRateLimiter:
+    """令牌桶保存在状态服务中的限速器，接口与RateLimiter相同；状态服务不可用时不限速"""
+
+    def __init__(self, client: StateClient, key: str, rpm: float = 0.0, tpm: float = 0.0):
+        self.client = client
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        self._status = {"requests_per_minute": rpm, "tokens_per_minute": tpm}
+
+    async def wait(self, input_tokens: int) -> float:
+        """发送前预占令牌并等待，返回实际等待的秒数"""
+        try:
+            header, _ = await self.client.call(
+                "ratelimit_reserve", key=self.key, rpm=self.rpm, tpm=self.tpm, tokens=input_tokens)
+        except StateUnavailable:
+            return 0.0
+        self._status = header["status"]
+        delay = header["delay"]
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    def update(self, headers: Mapping[str, str], status_code: int = 200) -> None:
+        """把上游的限流响应头转发给状态服务"""
+        picked = {
+            name.lower(): value for name, value in headers.items()
+            if name.lower().startswith(HEADER_PREFIX) or name.lower() == "retry-after"
+        }
+        if picked or status_code == 429:
+            self.client.send(
+                "ratelimit_update", key=self.key, rpm=self.rpm, tpm=self.tpm, headers=picked, status=status_code)
+
+    def status(self) -> Dict[str, Any]:
+        """最近一次从状态服务得到的限额"""
+        return dict(self._status)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="单独运行共享状态服务（配合 uvicorn --workers 使用）")
+    parser.add_argument("--socket", default=os.getenv("SHARED_STATE_SOCKET", ""), help="Unix socket路径")
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error("需要 --socket 或 SHARED_STATE_SOCKET")
+    run_server(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+SSE编码器 - 预先序列化流式响应中不变的部分，每个增量只转义并拼接文本
+"""
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, Mapping, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson为可选依赖
+    orjson = None
+
+from converter import STOP_REASONS
+
+
+DONE = b"data: [DONE]\n\n"
+
+# 占位符，序列化后用于切分出增量文本前后不变的部分
+_PLACEHOLDER = "\x00delta\x00"
+
+
+def _dumps_str_python(text: str) -> bytes:
+    try:
+        return json.dumps(text, ensure_ascii=False).encode("utf-8")
+    except UnicodeEncodeError:
+        # 含有孤立代理字符时退回ASCII转义
+        return json.dumps(text).encode("utf-8")
+
+
+def _dumps_str_orjson(text: str) -> bytes:
+    try:
+        return orjson.dumps(text)
+    except orjson.JSONEncodeError:
+        return json.dumps(text).encode("utf-8")
+
+
+# orjson与 json.dumps(ensure_ascii=False) 对字符串的转义结果一致
+dumps_str = _dumps_str_orjson if orjson is not None else _dumps_str_python
+
+
+class StreamError(Exception):
+    """上游在流中返回的错误事件"""
+
+    def __init__(self, error_type: str, message: str):
+        super().__init__(f"{error_type}: {message}")
+        self.error_type = error_type
+
+
+if orjson is not None:
+    _loads = orjson.loads
+else:
+    def _loads(data: memoryview) -> Any:
+        return json.loads(bytes(data))
+
+
+async def read_events(chunks: AsyncIterator[bytes]) -> AsyncIterator[Dict[str, Any]]:
+    """解析上游的SSE字节流，逐个返回data行中的事件（事件类型取自data中的type字段，event行忽略）"""
+    buffer = b""
+    async for chunk in chunks:
+        buffer = buffer + chunk if buffer else chunk
+        view = memoryview(buffer)
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            if buffer.startswith(b"data:", start):
+                yield _loads(view[start + 5:end])
+            start = end + 1
+        view.release()
+        buffer = buffer[start:]
+
+
+class StreamTranslator:
+    """把Anthropic原始流事件翻译为chat.completion.chunk，同时记录用量和停止原因
+
+    文本增量返回str（便于合并后再编码），其它增量直接返回编码好的bytes；
+    工具参数的JSON片段和思考内容收到即转发，不在代理中拼接。
+    """
+
+    def __init__(self, encoder: "SSEEncoder"):
+        self.encoder = encoder
+        # 累计用量：message_start中的输入用量，message_delta中的累计输出用量
+        self.usage: Dict[str, int] = {}
+        self.stop_reason: Optional[str] = None
+        # Anthropic内容块序号 -> OpenAI tool_calls序号
+        self._tool_indexes: Dict[int, int] = {}
+
+    @property
+    def finish_reason(self) -> str:
+        return STOP_REASONS.get(self.stop_reason, "stop")
+
+    async def translate(self, events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Union[str, bytes]]:
+        encoder = self.encoder
+        tool_indexes = self._tool_indexes
+        async for event in events:
+            kind = event["type"]
+            if kind == "content_block_delta":
+                delta = event["delta"]
+                delta_type = delta["type"]
+                if delta_type == "text_delta":
+                    yield delta["text"]
+                elif delta_type == "input_json_delta":
+                    if delta["partial_json"]:
+                        yield encoder.tool_arguments(tool_indexes[event["index"]], delta["partial_json"])
+                elif delta_type == "thinking_delta":
+                    yield encoder.reasoning(delta["thinking"])
+                # signature_delta只用于回传思考块，OpenAI格式没有对应字段
+            elif kind == "content_block_start":
+                block = event["content_block"]
+                block_type = block["type"]
+                if block_type == "tool_use":
+                    index = tool_indexes[event["index"]] = len(tool_indexes)
+                    yield encoder.tool_call_start(index, block["id"], block["name"])
+                elif block_type == "text" and block.get("text"):
+                    yield block["text"]
+                elif block_type == "thinking" and block.get("thinking"):
+                    yield encoder.reasoning(block["thinking"])
+            elif kind == "message_start":
+                self.usage.update(event["message"].get("usage") or {})
+            elif kind == "message_delta":
+                self.stop_reason = event["delta"].get("stop_reason")
+                for key, value in (event.get("usage") or {}).items():
+                    # message_delta中的用量是累计值
+                    if isinstance(value, int):
+                        self.usage[key] = value
+            elif kind == "error":
+                error = event.get("error") or {}
+                raise StreamError(error.get("type", "api_error"), error.get("message", ""))
+
+
+class SSEEncoder:
+    """单个流的chat.completion.chunk编码器
+
+    include_usage为True时（stream_options.include_usage），每个chunk带 "usage": null，结束后再输出用量chunk。
+    """
+
+    def __init__(self, chunk_id: str, model: str, created: Optional[int] = None, include_usage: bool = False):
+        self.chunk_id = chunk_id
+        self.model = model
+        self.created = int(time.time()) if created is None else created
+        self.include_usage = include_usage
+
+        self._content_prefix, self._content_suffix = self._split({"content": _PLACEHOLDER})
+        self._reasoning_prefix, self._reasoning_suffix = self._split({"reasoning_content": _PLACEHOLDER})
+        # tool_calls序号 -> 参数增量chunk的前后缀
+        self._argument_parts: Dict[int, Tuple[bytes, bytes]] = {}
+
+    def _split(self, delta: dict) -> Tuple[bytes, bytes]:
+        envelope = self._dumps_chunk(delta, None)
+        prefix, suffix = envelope.split(json.dumps(_PLACEHOLDER, ensure_ascii=False), 1)
+        return prefix.encode("utf-8"), suffix.encode("utf-8")
+
+    def _dumps_chunk(self, delta: dict, finish_reason: Optional[str]) -> str:
+        chunk = {
+            "id": self.chunk_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }]
+        }
+        if self.include_usage:
+            chunk["usage"] = None
+        return "data: " + json.dumps(chunk, ensure_ascii=False) + "\n\n"
+
+    def role(self) -> bytes:
+        """初始chunk (role)"""
+        return self._dumps_chunk({"role": "assistant"}, None).encode("utf-8")
+
+    def content(self, text: str) -> bytes:
+        """文本增量chunk"""
+        return self._content_prefix + dumps_str(text) + self._content_suffix
+
+    def reasoning(self, text: str) -> bytes:
+        """思考内容增量chunk（reasoning_content）"""
+        return self._reasoning_prefix + dumps_str(text) + self._reasoning_suffix
+
+    def tool_call_start(self, index: int, call_id: str, name: str) -> bytes:
+        """工具调用开始chunk，带id、type和函数名"""
+        return self._dumps_chunk({"tool_calls": [{
+            "index": index,
+            "id": call_id,
+            "type": "function",
+            "function": {"name": name, "arguments": ""},
+        }]}, None).encode("utf-8")
+
+    def tool_arguments(self, index: int, arguments: str) -> bytes:
+        """工具参数片段chunk"""
+        parts = self._argument_parts.get(index)
+        if parts is None:
+            parts = self._argument_parts[index] = self._split(
+                {"tool_calls": [{"index": index, "function": {"arguments": _PLACEHOLDER}}]})
+        return parts[0] + dumps_str(arguments) + parts[1]
+
+    def finish(self, finish_reason: str = "stop") -> bytes:
+        """结束chunk"""
+        return self._dumps_chunk({}, finish_reason).encode("utf-8")
+
+    def usage(self, usage: Mapping[str, int]) -> bytes:
+        """用量chunk（choices为空），在结束chunk之后输出"""
+        prompt_tokens = usage.get("input_tokens") or 0
+        completion_tokens = usage.get("output_tokens") or 0
+        return ("data: " + json.dumps({
+            "id": self.chunk_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }, ensure_ascii=False) + "\n\n").encode("utf-8")
+
+
+async def batch_deltas(source: AsyncIterator[Any], max_chars: int, window: float) -> AsyncIterator[Any]:
+    """合并文本增量：缓冲区达到max_chars或首个增量等待超过window秒时输出，以先到者为准
+
+    非文本的增量（已编码的工具调用、思考内容等chunk）不合并，先输出缓冲的文本再原样输出。
+    """
+    iterator = source.__aiter__()
+    buffer = []
+    buffered = 0
+    deadline = 0.0
+    pending = None
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+
+            if buffer:
+                # 缓冲区非空时最多等到时间窗口结束
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    await asyncio.wait((pending,), timeout=timeout)
+                if not pending.done():
+                    yield "".join(buffer)
+                    buffer.clear()
+                    buffered = 0
+                    continue
+            else:
+                await asyncio.wait((pending,))
+
+            try:
+                text = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            if not isinstance(text, str):
+                if buffer:
+                    yield "".join(buffer)
+                    buffer.clear()
+                    buffered = 0
+                yield text
+                continue
+
+            if not buffer:
+                deadline = time.monotonic() + window
+            buffer.append(text)
+            buffered += len(text)
+
+            if buffered >= max_chars:
+                yield "".join(buffer)
+                buffer.clear()
+                buffered = 0
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
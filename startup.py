@@ -0,0 +1,99 @@
+"""
+启动耗时 - 统计启动过程中各模块的导入耗时，用于排查冷启动慢的原因（STARTUP_REPORT=true时开启）
+"""
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import STARTUP_REPORT
+
+started = time.perf_counter()
+
+
+class _TimedLoader:
+    """包装模块加载器，记录执行模块代码的耗时（扣除其中导入其它模块的时间）"""
+
+    def __init__(self, loader: Any, timer: "ImportTimer", name: str):
+        self._loader = loader
+        self._timer = timer
+        self._name = name
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._loader, attr)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module) -> None:
+        stack = self._timer.stack()
+        stack.append(0.0)
+        began = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - began
+            children = stack.pop()
+            self._timer.record(self._name, elapsed - children)
+            if stack:
+                stack[-1] += elapsed
+
+
+class ImportTimer:
+    """按顶层包汇总模块导入耗时的meta path查找器"""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def stack(self) -> List[float]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[name.partition(".")[0]] += seconds
+
+    def find_spec(self, fullname: str, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = _TimedLoader(spec.loader, self, fullname)
+        return spec
+
+    def top(self, limit: int = 15) -> List[Tuple[str, float]]:
+        with self._lock:
+            return sorted(self.seconds.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+_timer: Optional[ImportTimer] = None
+
+
+def begin() -> None:
+    """开始统计之后的模块导入（需要在导入其它模块之前调用）"""
+    global _timer
+    if STARTUP_REPORT and _timer is None:
+        _timer = ImportTimer()
+        sys.meta_path.insert(0, _timer)
+
+
+def report(limit: int = 15) -> None:
+    """输出从开始启动到现在的耗时和各顶层包的导入耗时，并停止统计"""
+    global _timer
+    if _timer is None:
+        return
+    sys.meta_path.remove(_timer)
+    timer, _timer = _timer, None
+    lines = [f"启动耗时 {time.perf_counter() - started:.3f}s，导入耗时 {sum(timer.seconds.values()):.3f}s："]
+    lines.extend(f"  {name:<24} {seconds * 1000:8.1f} ms" for name, seconds in timer.top(limit))
+    print("\n".join(lines), flush=True)
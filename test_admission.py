@@ -0,0 +1,155 @@
+"""
+准入控制测试 - 优先级排队、队列满和排队超时的拒绝、请求取消后归还名额
+"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from admission import AdmissionController, AdmissionRejected
+from upstream import Upstream, UpstreamPool
+
+
+def make_controller(concurrency: int = 1, **options) -> AdmissionController:
+    pool = UpstreamPool([Upstream("a", object(), max_concurrency=concurrency)])
+    return AdmissionController(pool, **options)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_priority_order_and_fifo_within_priority():
+    async def scenario():
+        controller = make_controller()
+        order = []
+        first = await controller.acquire("m")
+
+        async def request(name, priority):
+            async with controller.admit("m", priority):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        tasks = []
+        for name, priority in [("low-1", 0), ("low-2", 0), ("high", 5), ("mid", 1)]:
+            tasks.append(asyncio.create_task(request(name, priority)))
+            await settle()
+        assert controller.queued == 4
+
+        controller._release("m", first, None)
+        await asyncio.gather(*tasks)
+        assert order == ["high", "mid", "low-1", "low-2"]
+        assert controller.queued == 0
+        assert controller.model_inflight == {}
+
+    asyncio.run(scenario())
+
+
+def test_queue_full_rejects_with_retry_after():
+    async def scenario():
+        controller = make_controller(max_queue=1, retry_after=2.5)
+        await controller.acquire("m")
+        waiter = asyncio.create_task(controller.acquire("m"))
+        await settle()
+        with pytest.raises(AdmissionRejected) as info:
+            await controller.acquire("m")
+        assert info.value.retry_after == 2.5
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+    asyncio.run(scenario())
+
+
+def test_rejection_maps_to_429_with_retry_after():
+    from main import unavailable_error
+
+    error = unavailable_error(AdmissionRejected("请求排队已满", 2.5))
+    assert isinstance(error, HTTPException)
+    assert error.status_code == 429
+    assert error.headers == {"Retry-After": "2"}
+    # 不足1秒时至少等1秒
+    assert unavailable_error(AdmissionRejected("full", 0.1)).headers == {"Retry-After": "1"}
+
+
+def test_queue_timeout():
+    async def scenario():
+        controller = make_controller(queue_timeout=0.05)
+        await controller.acquire("m")
+        with pytest.raises(AdmissionRejected, match="超时"):
+            await controller.acquire("m")
+        assert controller.queued == 0
+
+    asyncio.run(scenario())
+
+
+def test_model_limit():
+    async def scenario():
+        controller = make_controller(concurrency=0, model_limits={"small": 1}, queue_timeout=0.05)
+        await controller.acquire("small")
+        # 其它模型不受影响
+        await controller.acquire("large")
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire("small")
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        controller = make_controller()
+        first = await controller.acquire("m")
+        cancelled = asyncio.create_task(controller.acquire("m"))
+        await settle()
+        waiter = asyncio.create_task(controller.acquire("m"))
+        await settle()
+        assert controller.queued == 2
+
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert controller.queued == 1
+
+        # 名额分给仍在排队的请求，而不是已取消的
+        controller._release("m", first, None)
+        assert await waiter is first
+        assert controller.queued == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancel_after_grant_returns_slot():
+    async def scenario():
+        controller = make_controller()
+        first = await controller.acquire("m")
+        waiter = asyncio.create_task(controller.acquire("m"))
+        await settle()
+        # 分配名额和取消发生在同一轮事件循环中，名额要归还
+        controller._release("m", first, None)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert controller.model_inflight == {}
+        assert first.inflight == 0
+        assert await controller.acquire("m") is first
+
+    asyncio.run(scenario())
+
+
+def test_admit_releases_slot_when_cancelled():
+    async def scenario():
+        controller = make_controller()
+        entered = asyncio.Event()
+
+        async def request():
+            async with controller.admit("m"):
+                entered.set()
+                await asyncio.sleep(10)
+
+        task = asyncio.create_task(request())
+        await entered.wait()
+        assert controller.pool.upstreams[0].inflight == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert controller.pool.upstreams[0].inflight == 0
+        assert controller.model_inflight == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,140 @@
+"""
+转换函数微基准测试 - 需要安装 pytest-benchmark（pip install -e ".[bench]"），设置 RUN_BENCHMARKS=1 时才运行
+
+只用于本地对比，不是回归门禁：耗时与机器有关，基线不提交到仓库。改动前后在同一台机器上运行:
+    RUN_BENCHMARKS=1 pytest test_bench_converter.py --benchmark-save=before
+    RUN_BENCHMARKS=1 pytest test_bench_converter.py --benchmark-compare --benchmark-compare-fail=min:10%
+"""
+import asyncio
+import json
+import os
+
+import pytest
+
+if os.getenv("RUN_BENCHMARKS", "").lower() not in ("1", "true", "yes"):
+    pytest.skip("基准测试默认不运行，设置 RUN_BENCHMARKS=1 开启", allow_module_level=True)
+
+pytest.importorskip("pytest_benchmark")
+
+from anthropic.types import Message
+
+from converter import OpenAIToAnthropicConverter, convert_messages
+from main import convert_anthropic_to_openai_response
+from sse import SSEEncoder, StreamTranslator, read_events
+
+TURNS = [1, 10, 100, 500]
+# 超长文本（约64KB），模拟粘贴的文件和工具输出
+LONG_TEXT = "长文本 long text with mixed 内容。" * 2048
+
+
+def make_conversation(turns: int) -> list:
+    """生成多轮对话：包含system消息、多模态内容列表和超长文本"""
+    messages = [{"role": "system", "content": "You are a helpful assistant. 你是一个有用的助手。"}]
+    for i in range(turns):
+        if i % 10 == 9:
+            user_content = LONG_TEXT
+        elif i % 3 == 2:
+            user_content = [
+                {"type": "text", "text": f"第{i}轮：请描述这张图片。"},
+                {"type": "image_url", "image_url": {"url": f"https://example.com/images/{i}.png"}},
+                {"type": "text", "text": "Focus on the colors and the layout."},
+            ]
+        else:
+            user_content = f"Turn {i}: what is {i} * {i}? 请解释计算过程。"
+        messages.append({"role": "user", "content": user_content})
+        messages.append({"role": "assistant", "content": f"The answer is {i * i}. 计算过程如下……" * 4})
+    return messages
+
+
+def make_message(text: str) -> Message:
+    return Message.model_validate({
+        "id": "msg_bench",
+        "type": "message",
+        "role": "assistant",
+        "model": "claude-3-sonnet-20240229",
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 1200, "output_tokens": 300},
+    })
+
+
+def make_stream_chunks(deltas: int) -> list:
+    """上游的原始SSE字节流：文本增量之后是一个工具调用，每个事件一个网络块"""
+    events = [
+        {"type": "message_start", "message": {"id": "msg_bench", "role": "assistant", "usage": {"input_tokens": 1200}}},
+        {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+    ]
+    events.extend(
+        {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": f"token{i} 词"}}
+        for i in range(deltas)
+    )
+    events.extend([
+        {"type": "content_block_stop", "index": 0},
+        {"type": "content_block_start", "index": 1,
+         "content_block": {"type": "tool_use", "id": "toolu_bench", "name": "search", "input": {}}},
+        {"type": "content_block_delta", "index": 1, "delta": {"type": "input_json_delta", "partial_json": '{"q": "x"}'}},
+        {"type": "content_block_stop", "index": 1},
+        {"type": "message_delta", "delta": {"stop_reason": "tool_use"}, "usage": {"output_tokens": deltas}},
+        {"type": "message_stop"},
+    ])
+    return [f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8") for event in events]
+
+
+@pytest.mark.benchmark(group="convert_messages")
+@pytest.mark.parametrize("turns", TURNS)
+def test_convert_messages(benchmark, turns):
+    messages = make_conversation(turns)
+    system, result = benchmark(convert_messages, messages)
+    assert system and len(result) == 2 * turns
+
+
+@pytest.mark.benchmark(group="OpenAIToAnthropicConverter.convert_request")
+@pytest.mark.parametrize("turns", TURNS)
+def test_convert_request(benchmark, turns):
+    request = {
+        "model": "claude-3-sonnet-20240229",
+        "messages": make_conversation(turns),
+        "max_tokens": 1024,
+        "temperature": 0.7,
+        "stream": True,
+    }
+    result = benchmark(OpenAIToAnthropicConverter.convert_request, request)
+    assert len(result["messages"]) == 2 * turns
+
+
+@pytest.mark.benchmark(group="convert_anthropic_to_openai_response")
+@pytest.mark.parametrize("text", ["短回答", LONG_TEXT], ids=["short", "long"])
+def test_convert_anthropic_to_openai_response(benchmark, text):
+    response = make_message(text)
+    result = benchmark(convert_anthropic_to_openai_response, response, "claude-3-sonnet-20240229")
+    assert result["choices"][0]["message"]["content"] == text
+
+
+@pytest.mark.benchmark(group="StreamTranslator.translate")
+@pytest.mark.parametrize("deltas", [1, 100, 500])
+def test_stream_translator(benchmark, deltas):
+    """与stream_generator相同的路径：解析原始SSE字节，翻译事件并编码为chat.completion.chunk"""
+    chunks = make_stream_chunks(deltas)
+
+    async def upstream():
+        for chunk in chunks:
+            yield chunk
+
+    async def translate_all():
+        encoder = SSEEncoder("chatcmpl-bench", "claude-3-sonnet-20240229", created=0)
+        translator = StreamTranslator(encoder)
+        output = [encoder.role()]
+        async for delta in translator.translate(read_events(upstream())):
+            output.append(encoder.content(delta) if isinstance(delta, str) else delta)
+        output.append(encoder.finish(translator.finish_reason))
+        return output
+
+    loop = asyncio.new_event_loop()
+    try:
+        result = benchmark(lambda: loop.run_until_complete(translate_all()))
+    finally:
+        loop.close()
+    # role + 文本增量 + 工具调用开始 + 工具参数 + finish
+    assert len(result) == deltas + 4
+    assert b'"finish_reason": "tool_calls"' in result[-1]
@@ -0,0 +1,156 @@
+"""
+响应缓存测试 - LRU/字节数/TTL淘汰、缓存键规范化和不缓存的请求
+"""
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+import cache
+import main
+from cache import ResponseCache, make_cache_key
+from main import ChatRequest, is_cacheable
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return clock
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_lru_evicts_least_recently_used():
+    responses = ResponseCache(max_entries=2)
+    run(responses.set("a", b"1"))
+    run(responses.set("b", b"2"))
+    # 读取a后b成为最久未使用的条目
+    assert run(responses.get("a")) == b"1"
+    run(responses.set("c", b"3"))
+    assert run(responses.get("b")) is None
+    assert run(responses.get("a")) == b"1"
+    assert run(responses.get("c")) == b"3"
+    assert len(responses) == 2
+
+
+def test_evicts_by_bytes_and_skips_oversized_values():
+    responses = ResponseCache(max_entries=100, max_bytes=10)
+    run(responses.set("a", b"aaaa"))
+    run(responses.set("b", b"bbbb"))
+    run(responses.set("c", b"cccc"))
+    assert run(responses.get("a")) is None
+    assert responses.size_bytes == 8
+
+    run(responses.set("huge", b"x" * 11))
+    assert run(responses.get("huge")) is None
+    assert responses.size_bytes == 8
+    assert len(responses) == 2
+
+
+def test_overwrite_updates_size():
+    responses = ResponseCache()
+    run(responses.set("a", b"12345"))
+    run(responses.set("a", b"12"))
+    assert responses.size_bytes == 2
+    assert run(responses.get("a")) == b"12"
+
+
+def test_ttl_expiry(clock):
+    responses = ResponseCache(ttl=10)
+    run(responses.set("a", b"1"))
+    clock.now += 9.9
+    assert run(responses.get("a")) == b"1"
+    clock.now += 0.1
+    assert run(responses.get("a")) is None
+    assert len(responses) == 0
+    assert responses.size_bytes == 0
+    assert (responses.hits, responses.misses) == (1, 1)
+
+
+def test_rewrite_resets_ttl(clock):
+    responses = ResponseCache(ttl=10)
+    run(responses.set("a", b"1"))
+    clock.now += 8
+    run(responses.set("a", b"2"))
+    clock.now += 8
+    assert run(responses.get("a")) == b"2"
+
+
+class Lower:
+    """同步的下一级缓存"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+
+def test_lower_tier_write_through_and_promotion():
+    lower = Lower()
+    responses = ResponseCache(max_entries=1, lower=lower)
+    run(responses.set("a", b"1"))
+    run(responses.set("b", b"2"))
+    assert lower.data == {"a": b"1", "b": b"2"}
+    # a已被内存淘汰，从下一级缓存读到后放回内存
+    assert run(responses.get("a")) == b"1"
+    assert list(responses._entries) == ["a"]
+
+
+def test_cache_key_ignores_dict_order():
+    first = {"model": "m", "max_tokens": 10, "messages": [{"role": "user", "content": "你好"}]}
+    second = {"messages": [{"content": "你好", "role": "user"}], "max_tokens": 10, "model": "m"}
+    assert make_cache_key(first) == make_cache_key(second)
+
+
+@pytest.mark.parametrize("change", [
+    {"model": "other"},
+    {"max_tokens": 11},
+    {"temperature": 0},
+    {"messages": [{"role": "user", "content": "你好 "}]},
+    {"messages": [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "hi"}]},
+])
+def test_cache_key_distinguishes_requests(change):
+    base = {"model": "m", "max_tokens": 10, "messages": [{"role": "user", "content": "你好"}]}
+    assert make_cache_key(base) != make_cache_key({**base, **change})
+
+
+def http_request(headers=None) -> Request:
+    raw = [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    return Request({"type": "http", "method": "POST", "path": "/v1/chat/completions", "headers": raw})
+
+
+@pytest.mark.parametrize("temperature, headers, expected", [
+    (0, {}, True),
+    (None, {}, False),
+    (0.7, {}, False),
+    (1, {}, False),
+    (0.7, {"X-Proxy-Cache": "on"}, True),
+    (None, {"X-Proxy-Cache": "true"}, True),
+    (0, {"X-Proxy-Cache": "off"}, False),
+    (0, {"X-Proxy-Cache": "0"}, False),
+])
+def test_is_cacheable(monkeypatch, temperature, headers, expected):
+    monkeypatch.setattr(main, "RESPONSE_CACHE_ENABLED", True)
+    request = ChatRequest(messages=[], temperature=temperature)
+    assert is_cacheable(request, http_request(headers)) is expected
+
+
+def test_not_cacheable_when_disabled(monkeypatch):
+    monkeypatch.setattr(main, "RESPONSE_CACHE_ENABLED", False)
+    request = ChatRequest(messages=[], temperature=0)
+    assert not is_cacheable(request, http_request({"X-Proxy-Cache": "on"}))
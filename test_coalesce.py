@@ -0,0 +1,221 @@
+"""
+请求合并测试 - SingleFlight共享结果和异常，StreamCoalescer的回放、异常传播和取消清理
+"""
+import asyncio
+
+import pytest
+
+from coalesce import SingleFlight, StreamCoalescer
+
+
+def test_single_flight_shares_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        calls = 0
+        release = asyncio.Event()
+
+        async def fn():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"id": calls}
+
+        waiters = [asyncio.create_task(flight.do("k", fn)) for _ in range(4)]
+        await asyncio.sleep(0)
+        assert len(flight) == 1
+        release.set()
+        results = await asyncio.gather(*waiters)
+        assert calls == 1
+        assert all(result is results[0] for result in results)
+        assert len(flight) == 0
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_leader_failure_reaches_followers():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def fn():
+            await release.wait()
+            raise RuntimeError("upstream failed")
+
+        waiters = [asyncio.create_task(flight.do("k", fn)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) and str(result) == "upstream failed" for result in results)
+        # 失败的调用不会留在表中，下一次请求重新调用
+        assert len(flight) == 0
+        assert await flight.do("k", lambda: asyncio.sleep(0, "ok")) == "ok"
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_cancelled_leader_does_not_affect_followers():
+    async def scenario():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def fn():
+            await release.wait()
+            return "done"
+
+        leader = asyncio.create_task(flight.do("k", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("k", fn))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await follower == "done"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert len(flight) == 0
+
+    asyncio.run(scenario())
+
+
+def test_single_flight_cancelled_when_all_waiters_leave():
+    async def scenario():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def fn():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.create_task(flight.do("k", fn)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert len(flight) == 0
+        assert await flight.do("k", lambda: asyncio.sleep(0, "again")) == "again"
+
+    asyncio.run(scenario())
+
+
+class Source:
+    """可控的上游流：每次put一个块，记录是否被关闭"""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+
+    def put(self, item) -> None:
+        self.queue.put_nowait(item)
+
+    async def stream(self):
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self.closed = True
+
+
+async def collect(generator, into: list) -> None:
+    async for chunk in generator:
+        into.append(chunk)
+
+
+def test_stream_late_joiner_replays_buffered_chunks():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        source = Source()
+        created = 0
+
+        def factory():
+            nonlocal created
+            created += 1
+            return source.stream()
+
+        first: list = []
+        leader = asyncio.create_task(collect(coalescer.subscribe("k", factory), first))
+        source.put("a")
+        source.put("b")
+        while len(first) < 2:
+            await asyncio.sleep(0)
+
+        second: list = []
+        late = asyncio.create_task(collect(coalescer.subscribe("k", factory), second))
+        await asyncio.sleep(0)
+        source.put("c")
+        source.put(None)
+        await asyncio.gather(leader, late)
+
+        assert created == 1
+        assert first == second == ["a", "b", "c"]
+        assert len(coalescer) == 0
+
+    asyncio.run(scenario())
+
+
+def test_stream_error_reaches_all_subscribers():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        source = Source()
+        received = [[], []]
+        subscribers = [
+            asyncio.create_task(collect(coalescer.subscribe("k", source.stream), chunks)) for chunks in received
+        ]
+        source.put("a")
+        source.put(RuntimeError("stream broken"))
+        results = await asyncio.gather(*subscribers, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert received == [["a"], ["a"]]
+        assert len(coalescer) == 0
+        assert source.closed
+
+    asyncio.run(scenario())
+
+
+def test_stream_cancelled_leader_keeps_follower_then_cleans_up():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        source = Source()
+        first: list = []
+        second: list = []
+        leader = asyncio.create_task(collect(coalescer.subscribe("k", source.stream), first))
+        follower = asyncio.create_task(collect(coalescer.subscribe("k", source.stream), second))
+        source.put("a")
+        while len(second) < 1:
+            await asyncio.sleep(0)
+
+        # 发起上游流的订阅者离开后，其它订阅者继续接收
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        source.put("b")
+        while len(second) < 2:
+            await asyncio.sleep(0)
+        assert second == ["a", "b"]
+        assert len(coalescer) == 1
+
+        # 最后一个订阅者离开时取消上游流，关闭源并移除key
+        follower.cancel()
+        await asyncio.gather(follower, return_exceptions=True)
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert len(coalescer) == 0
+        assert source.closed
+
+        # 同一个key的新请求重新创建上游流
+        fresh = Source()
+        third: list = []
+        task = asyncio.create_task(collect(coalescer.subscribe("k", fresh.stream), third))
+        fresh.put("x")
+        fresh.put(None)
+        await task
+        assert third == ["x"]
+
+    asyncio.run(scenario())
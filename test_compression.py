@@ -0,0 +1,140 @@
+"""
+压缩测试 - 请求体解压的长度上限、压缩炸弹和不完整的压缩数据，响应压缩的往返
+"""
+import asyncio
+import gzip
+import json
+import os
+import zlib
+
+import pytest
+
+from compression import (
+    BodyTooLarge, EncodingError, StreamCompressor, UnsupportedEncoding, compress, decompress_stream, negotiate,
+)
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstandard为可选依赖
+    zstandard = None
+
+ENCODINGS = ["gzip", pytest.param("zstd", marks=pytest.mark.skipif(zstandard is None, reason="需要zstandard"))]
+BODY = json.dumps({"messages": [{"role": "user", "content": os.urandom(200000).hex()}]}).encode("utf-8")
+
+
+def decompress(data: bytes, encoding: str, max_bytes: int = 10 * 1024 * 1024, chunk_size: int = 4096):
+    """按chunk_size分块送入decompress_stream，返回 (解压结果, 最大的一段输出)"""
+
+    async def chunks():
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    async def run():
+        pieces = [piece async for piece in decompress_stream(chunks(), encoding, max_bytes)]
+        return b"".join(pieces), max(map(len, pieces), default=0)
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+@pytest.mark.parametrize("chunk_size", [1, 4096, 1 << 20])
+def test_roundtrip(encoding, chunk_size):
+    data, _ = decompress(compress(BODY, encoding), encoding, chunk_size=chunk_size)
+    assert data == BODY
+
+
+def test_identity_passthrough():
+    assert decompress(BODY, "identity")[0] == BODY
+
+
+def test_deflate():
+    assert decompress(zlib.compress(BODY), "deflate")[0] == BODY
+
+
+def test_unsupported_encoding():
+    with pytest.raises(UnsupportedEncoding):
+        decompress(BODY, "br")
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_over_limit(encoding):
+    with pytest.raises(BodyTooLarge):
+        decompress(compress(BODY, encoding), encoding, max_bytes=len(BODY) - 1)
+    assert decompress(compress(BODY, encoding), encoding, max_bytes=len(BODY))[0] == BODY
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_bomb_stops_at_bounded_pieces(encoding):
+    """几KB的压缩炸弹必须逐段解压，一超过上限就停止，不能先整块解压出几十MB"""
+    bomb = compress(b"\0" * (64 * 1024 * 1024), encoding)
+    produced = []
+
+    async def chunks():
+        yield bomb
+
+    async def run():
+        async for piece in decompress_stream(chunks(), encoding, 4 * 1024 * 1024):
+            produced.append(len(piece))
+
+    with pytest.raises(BodyTooLarge):
+        asyncio.run(run())
+    assert sum(produced) <= 4 * 1024 * 1024
+    assert max(produced) <= 2 * 1024 * 1024
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_truncated_body_rejected(encoding):
+    data = compress(BODY, encoding)
+    with pytest.raises(EncodingError, match="不完整"):
+        decompress(data[:len(data) // 2], encoding)
+    with pytest.raises(EncodingError, match="不完整"):
+        decompress(data[:-1], encoding)
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_empty_body_rejected(encoding):
+    with pytest.raises(EncodingError):
+        decompress(b"", encoding)
+
+
+@pytest.mark.skipif(zstandard is None, reason="需要zstandard")
+def test_zstd_trailing_data_rejected():
+    data = compress(BODY, "zstd")
+    with pytest.raises(EncodingError, match="多余"):
+        decompress(data + b"junk", "zstd")
+    with pytest.raises(EncodingError, match="多余"):
+        decompress(data + data, "zstd", chunk_size=len(data))
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_corrupt_body_rejected(encoding):
+    data = bytearray(compress(BODY, encoding))
+    # 破坏帧头（zstd帧默认不带校验和，改动中间的字面量不一定能发现）
+    data[0] ^= 0xFF
+    with pytest.raises(EncodingError):
+        decompress(bytes(data), encoding)
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_stream_compressor_flushes_each_chunk(encoding):
+    compressor = StreamCompressor(encoding)
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for i in range(3):
+        event = f"data: {i}\n\n".encode("utf-8")
+        assert decompressor.decompress(compressor.compress(event)) == event
+    decompressor.decompress(compressor.finish())
+    assert decompressor.eof
+
+
+def test_negotiate():
+    best = "zstd" if zstandard is not None else "gzip"
+    assert negotiate(None) is None
+    assert negotiate("gzip") == "gzip"
+    assert negotiate("gzip, zstd") == best
+    assert negotiate("zstd;q=0, gzip;q=0.5") == "gzip"
+    assert negotiate("br") is None
+    assert negotiate("*") == best
+    assert gzip.decompress(compress(b"x", "gzip")) == b"x"
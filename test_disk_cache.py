@@ -0,0 +1,272 @@
+"""
+磁盘缓存测试 - 过期、重启后加载、索引丢失或损坏后从分段重建、容量淘汰、压缩和目录锁
+"""
+import os
+import time
+
+import pytest
+
+import disk_cache
+from disk_cache import DiskCache
+
+
+class Clock:
+    """替换disk_cache模块中的time，控制条目过期"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(disk_cache, "time", clock)
+    return clock
+
+
+def open_cache(directory, **kwargs) -> DiskCache:
+    kwargs.setdefault("compact_interval", 3600)
+    cache = DiskCache(str(directory), **kwargs).start()
+    deadline = time.monotonic() + 10
+    while not cache.ready:
+        assert time.monotonic() < deadline, "磁盘缓存未就绪"
+        time.sleep(0.01)
+    return cache
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".seg"))
+
+
+def test_set_get_and_overwrite(tmp_path):
+    cache = open_cache(tmp_path)
+    try:
+        assert cache.get("missing") is None
+        cache.set("a", b"first")
+        cache.set("b", b"")
+        cache.set("a", b"second")
+        assert cache.get("a") == b"second"
+        assert cache.get("b") == b""
+        assert len(cache) == 2
+    finally:
+        cache.close()
+
+
+def test_not_ready_before_start(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.set("a", b"x")
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_ttl(tmp_path, clock):
+    cache = open_cache(tmp_path, ttl=10)
+    try:
+        cache.set("a", b"x")
+        clock.now += 9
+        assert cache.get("a") == b"x"
+        clock.now += 2
+        assert cache.get("a") is None
+        assert len(cache) == 0
+    finally:
+        cache.close()
+
+
+def test_survives_restart(tmp_path):
+    cache = open_cache(tmp_path)
+    values = {f"key-{i}": os.urandom(100 + i) for i in range(200)}
+    for key, value in values.items():
+        cache.set(key, value)
+    cache.close()
+
+    cache = open_cache(tmp_path)
+    try:
+        assert len(cache) == 200
+        assert all(cache.get(key) == value for key, value in values.items())
+    finally:
+        cache.close()
+
+
+def test_expired_entries_dropped_on_restart(tmp_path, clock):
+    cache = open_cache(tmp_path, ttl=10)
+    cache.set("old", b"x")
+    clock.now += 5
+    cache.set("new", b"y")
+    cache.close()
+
+    clock.now += 6
+    cache = open_cache(tmp_path, ttl=10)
+    try:
+        assert len(cache) == 1
+        assert cache.get("old") is None
+        assert cache.get("new") == b"y"
+    finally:
+        cache.close()
+
+
+@pytest.mark.parametrize("damage", ["delete", "truncate", "garbage"])
+def test_index_rebuilt_from_segments(tmp_path, damage):
+    cache = open_cache(tmp_path)
+    for i in range(50):
+        cache.set(f"key-{i}", b"v1-%d" % i)
+    # 覆盖写入的键在重建后取最新的记录
+    for i in range(10):
+        cache.set(f"key-{i}", b"v2-%d" % i)
+    cache.close()
+
+    index = tmp_path / "index"
+    if damage == "delete":
+        index.unlink()
+    elif damage == "truncate":
+        os.truncate(index, 10)
+    else:
+        index.write_bytes(b"\0" * 4096)
+
+    cache = open_cache(tmp_path)
+    try:
+        assert len(cache) == 50
+        for i in range(50):
+            assert cache.get(f"key-{i}") == (b"v2-%d" % i if i < 10 else b"v1-%d" % i)
+    finally:
+        cache.close()
+
+
+def test_incomplete_tail_record_truncated(tmp_path):
+    cache = open_cache(tmp_path)
+    cache.set("a", b"complete")
+    cache.close()
+
+    segment = tmp_path / segments(tmp_path)[-1]
+    size = segment.stat().st_size
+    with open(segment, "ab") as f:
+        # 写入到一半时进程退出：记录头完整但内容不完整
+        f.write(disk_cache._RECORD.pack(disk_cache._RECORD_MAGIC, b"\1" * 32, time.time() + 100, 1000, 0) + b"partial")
+    (tmp_path / "index").unlink()
+
+    cache = open_cache(tmp_path)
+    try:
+        assert segment.stat().st_size == size
+        assert cache.get("a") == b"complete"
+        cache.set("b", b"after")
+        assert cache.get("b") == b"after"
+    finally:
+        cache.close()
+
+
+def test_corrupted_record_is_a_miss(tmp_path):
+    cache = open_cache(tmp_path)
+    try:
+        cache.set("a", b"x" * 100)
+        cache.set("b", b"y" * 100)
+        segment = str(tmp_path / segments(tmp_path)[-1])
+        # 分段以O_APPEND打开，pwrite会追加到末尾，用另一个描述符修改第一条记录的内容
+        fd = os.open(segment, os.O_WRONLY)
+        try:
+            os.pwrite(fd, b"z", disk_cache._RECORD.size + 50)
+        finally:
+            os.close(fd)
+        assert cache.get("a") is None
+        assert cache.get("b") == b"y" * 100
+        assert len(cache) == 1
+    finally:
+        cache.close()
+
+
+def test_eviction_removes_oldest_segments(tmp_path):
+    value = b"v" * 1000
+    cache = open_cache(tmp_path, max_bytes=20_000, segment_bytes=4_000)
+    try:
+        for i in range(100):
+            cache.set(f"key-{i}", value)
+            assert cache.size_bytes <= 20_000 + 4_000
+        assert cache.get("key-0") is None
+        assert cache.get("key-99") == value
+        assert 0 < len(cache) < 100
+        assert sum(os.path.getsize(tmp_path / name) for name in segments(tmp_path)) == cache.size_bytes
+    finally:
+        cache.close()
+
+    # 重启时按新的容量上限淘汰
+    cache = open_cache(tmp_path, max_bytes=8_000, segment_bytes=4_000)
+    try:
+        assert cache.size_bytes <= 8_000 + 4_000
+        assert cache.get("key-99") == value
+    finally:
+        cache.close()
+
+
+def test_oversized_value_not_stored(tmp_path):
+    cache = open_cache(tmp_path, segment_bytes=1_000)
+    try:
+        cache.set("big", b"x" * 2_000)
+        assert cache.get("big") is None
+        assert len(cache) == 0
+    finally:
+        cache.close()
+
+
+def test_compaction_keeps_live_entries(tmp_path, clock):
+    cache = open_cache(tmp_path, segment_bytes=4_000, max_bytes=10 ** 6, ttl=100)
+    try:
+        cache.set("expiring", b"e" * 300)
+        clock.now += 60
+        # 每个键覆盖写入5次，旧分段中大部分记录失效
+        for round in range(5):
+            for i in range(10):
+                cache.set(f"key-{i}", b"%d" % round * 300)
+        cache.set("fresh", b"f" * 300)
+        clock.now += 50
+        before = len(segments(tmp_path))
+
+        assert cache.compact() > 0
+        assert len(segments(tmp_path)) < before
+        assert all(cache.get(f"key-{i}") == b"4" * 300 for i in range(10))
+        assert cache.get("fresh") == b"f" * 300
+        assert cache.get("expiring") is None
+    finally:
+        cache.close()
+
+    cache = open_cache(tmp_path, segment_bytes=4_000, max_bytes=10 ** 6, ttl=100)
+    try:
+        assert all(cache.get(f"key-{i}") == b"4" * 300 for i in range(10))
+    finally:
+        cache.close()
+
+
+def test_index_grows(tmp_path):
+    cache = open_cache(tmp_path, max_bytes=10 ** 6)
+    try:
+        slots = cache._index.slots
+        count = int(slots * 0.8)
+        for i in range(count):
+            cache.set(f"key-{i}", b"v")
+        assert cache._index.slots > slots
+        assert len(cache) == count
+        assert cache.get("key-0") == b"v" and cache.get(f"key-{count - 1}") == b"v"
+    finally:
+        cache.close()
+
+
+def test_directory_lock(tmp_path, monkeypatch):
+    """同一目录同时只能由一个进程使用，拿不到锁的实例在锁释放后接管"""
+    monkeypatch.setattr(disk_cache, "_RETRY_INTERVAL", 0.05)
+    first = open_cache(tmp_path)
+    first.set("a", b"x")
+    # flock按打开的文件描述加锁，同一进程中的第二个实例同样拿不到锁
+    second = DiskCache(str(tmp_path), compact_interval=3600).start()
+    try:
+        time.sleep(0.3)
+        assert not second.ready
+        assert second.get("a") is None
+        first.close()
+        deadline = time.monotonic() + 5
+        while not second.ready:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        assert second.get("a") == b"x"
+    finally:
+        first.close()
+        second.close()
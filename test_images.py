@@ -0,0 +1,268 @@
+"""
+图片内联测试 - 使用本地HTTP服务代替远程图片服务器，不需要网络
+"""
+import asyncio
+import base64
+import io
+import logging
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from converter import convert_messages
+from images import ImageCache, ImageError, ImageFetcher, host_allowed, is_public_address
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - Pillow为可选依赖
+    Image = None
+
+# 1x1 透明PNG
+TINY_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+# 每次下载的延迟（秒），用于验证并发下载
+DELAY = 0.3
+SLOW = 3.0
+
+
+def make_png(width: int, height: int) -> bytes:
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), (200, 30, 30)).save(output, format="PNG")
+    return output.getvalue()
+
+
+@pytest.fixture(scope="module")
+def server():
+    """本地图片服务器，记录每个路径被请求的次数"""
+    hits = Counter()
+    images = {"/a.png": TINY_PNG, "/b.png": TINY_PNG, "/c.png": TINY_PNG, "/slow.png": TINY_PNG}
+    if Image is not None:
+        images["/large.png"] = make_png(3000, 1000)
+    redirects = {
+        "/redirect-ok": "/a.png",
+        "/redirect-localhost": "http://localhost:{port}/a.png",
+        "/loop": "/loop",
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits[self.path] += 1
+            redirect = redirects.get(self.path)
+            if redirect is not None:
+                self.send_response(302)
+                self.send_header("Location", redirect.format(port=self.server.server_address[1]))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            time.sleep(SLOW if self.path == "/slow.png" else DELAY)
+            body = images.get(self.path)
+            if body is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", hits
+    httpd.shutdown()
+
+
+def image_part(url: str) -> dict:
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def build_kwargs(*parts) -> dict:
+    _, messages = convert_messages([{"role": "user", "content": [{"type": "text", "text": "看图"}, *parts]}])
+    return {"model": "m", "max_tokens": 16, "messages": messages}
+
+
+def local_fetcher(cache: Optional[ImageCache] = None, **kwargs) -> ImageFetcher:
+    """测试图片服务器在本机，需要允许内网地址"""
+    return ImageFetcher(cache if cache is not None else ImageCache(), allow_private=True, **kwargs)
+
+
+def run_inline(fetcher: ImageFetcher, kwargs: dict) -> dict:
+    async def go():
+        try:
+            return await fetcher.inline(kwargs)
+        finally:
+            await fetcher.close()
+    return asyncio.run(go())
+
+
+def test_data_url_converted_to_base64_block():
+    data = base64.b64encode(TINY_PNG).decode("ascii")
+    kwargs = build_kwargs(image_part(f"data:image/png;base64,{data}"))
+    block = kwargs["messages"][0]["content"][1]
+    assert block == {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": data}}
+
+
+def test_remote_images_fetched_concurrently(server):
+    base_url, hits = server
+    kwargs = build_kwargs(image_part(f"{base_url}/a.png"), image_part(f"{base_url}/b.png"))
+
+    started = time.monotonic()
+    result = run_inline(local_fetcher(), kwargs)
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 2 * DELAY
+    blocks = result["messages"][0]["content"][1:]
+    for block in blocks:
+        assert block["source"]["type"] == "base64"
+        assert block["source"]["media_type"] == "image/png"
+        assert base64.b64decode(block["source"]["data"]) == TINY_PNG
+    # 原请求参数不被修改
+    assert kwargs["messages"][0]["content"][1]["source"]["type"] == "url"
+
+
+def test_repeat_urls_downloaded_once(server, tmp_path):
+    base_url, hits = server
+    url = f"{base_url}/c.png"
+    cache = ImageCache(directory=str(tmp_path))
+
+    run_inline(local_fetcher(cache), build_kwargs(image_part(url), image_part(url)))
+    run_inline(local_fetcher(cache), build_kwargs(image_part(url)))
+    assert hits["/c.png"] == 1
+
+    # 磁盘缓存在重启后仍然有效
+    result = run_inline(local_fetcher(ImageCache(directory=str(tmp_path))), build_kwargs(image_part(url)))
+    assert hits["/c.png"] == 1
+    assert base64.b64decode(result["messages"][0]["content"][1]["source"]["data"]) == TINY_PNG
+
+
+def test_fetch_error_raises_image_error(server, caplog):
+    base_url, _ = server
+    with caplog.at_level(logging.WARNING, logger="images"):
+        with pytest.raises(ImageError) as excinfo:
+            run_inline(local_fetcher(), build_kwargs(image_part(f"{base_url}/missing.png")))
+    # 上游状态码只记录到日志，不返回给客户端
+    assert str(excinfo.value) == "下载图片失败"
+    assert "404" in caplog.text
+
+
+def test_failure_cancels_other_downloads(server):
+    base_url, _ = server
+    fetcher = local_fetcher()
+    kwargs = build_kwargs(image_part(f"{base_url}/slow.png"), image_part("file:///etc/passwd"))
+
+    started = time.monotonic()
+    with pytest.raises(ImageError):
+        run_inline(fetcher, kwargs)
+    assert time.monotonic() - started < SLOW / 2
+    # 没有其它请求等待时，进行中的下载也被取消
+    assert len(fetcher._flight) == 0
+
+
+def test_oversized_image_rejected(server):
+    base_url, _ = server
+    with pytest.raises(ImageError):
+        run_inline(local_fetcher(max_bytes=10), build_kwargs(image_part(f"{base_url}/a.png")))
+
+
+@pytest.mark.skipif(Image is None, reason="需要安装 Pillow")
+def test_data_url_downscaled_without_fetching(server):
+    base_url, hits = server
+    data = base64.b64encode(make_png(3000, 1000)).decode("ascii")
+    kwargs = build_kwargs(image_part(f"data:image/png;base64,{data}"), image_part(f"{base_url}/b.png?kept"))
+    result = run_inline(local_fetcher(max_edge=1568, fetch_urls=False), kwargs)
+
+    resized, kept = result["messages"][0]["content"][1:]
+    with Image.open(io.BytesIO(base64.b64decode(resized["source"]["data"]))) as image:
+        assert image.size == (1568, 523)
+    # 不开启下载时url图片原样交给上游
+    assert kept == kwargs["messages"][0]["content"][2]
+    assert hits["/b.png?kept"] == 0
+
+
+@pytest.mark.skipif(Image is None, reason="需要安装 Pillow")
+def test_large_image_downscaled(server):
+    base_url, _ = server
+    result = run_inline(local_fetcher(max_edge=1568), build_kwargs(image_part(f"{base_url}/large.png")))
+    data = base64.b64decode(result["messages"][0]["content"][1]["source"]["data"])
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.size == (1568, 523)
+
+
+@pytest.mark.parametrize("address", [
+    "127.0.0.1", "10.0.0.1", "172.16.0.1", "192.168.1.1", "169.254.169.254", "100.100.100.200",
+    "0.0.0.0", "224.0.0.1", "::1", "::ffff:127.0.0.1", "fe80::1", "fd00:ec2::254",
+])
+def test_internal_addresses_not_public(address):
+    assert not is_public_address(address)
+
+
+@pytest.mark.parametrize("address", ["93.184.216.34", "8.8.8.8", "2606:4700:4700::1111"])
+def test_public_addresses(address):
+    assert is_public_address(address)
+
+
+def test_host_allowlist():
+    assert host_allowed("images.example.com", [".example.com"])
+    assert host_allowed("example.com", [".example.com"])
+    assert host_allowed("cdn.test", ["cdn.test"])
+    assert not host_allowed("example.com.evil.test", [".example.com"])
+    assert not host_allowed("badexample.com", [".example.com"])
+
+
+def test_loopback_refused_with_generic_error(server):
+    base_url, hits = server
+    with pytest.raises(ImageError) as excinfo:
+        run_inline(ImageFetcher(ImageCache()), build_kwargs(image_part(f"{base_url}/b.png?probe")))
+    # 不泄露URL、异常类型，不可访问的地址和连接失败的错误信息相同
+    assert str(excinfo.value) == "下载图片失败"
+    assert hits["/b.png?probe"] == 0
+
+
+def test_unreachable_port_error_is_generic():
+    with pytest.raises(ImageError) as excinfo:
+        run_inline(local_fetcher(), build_kwargs(image_part("http://127.0.0.1:1/x.png")))
+    assert str(excinfo.value) == "下载图片失败"
+
+
+def test_non_http_scheme_refused():
+    with pytest.raises(ImageError):
+        run_inline(local_fetcher(), build_kwargs(image_part("file:///etc/passwd")))
+
+
+def test_redirects_checked_on_every_hop(server):
+    base_url, hits = server
+    fetcher = local_fetcher(allowed_hosts=["127.0.0.1"])
+    result = run_inline(fetcher, build_kwargs(image_part(f"{base_url}/redirect-ok")))
+    assert base64.b64decode(result["messages"][0]["content"][1]["source"]["data"]) == TINY_PNG
+
+    # 重定向到允许列表之外的主机时拒绝
+    with pytest.raises(ImageError):
+        run_inline(local_fetcher(allowed_hosts=["127.0.0.1"]), build_kwargs(image_part(f"{base_url}/redirect-localhost")))
+
+
+def test_redirect_loop_refused(server):
+    base_url, hits = server
+    with pytest.raises(ImageError):
+        run_inline(local_fetcher(), build_kwargs(image_part(f"{base_url}/loop")))
+    assert hits["/loop"] == 6
+
+
+@pytest.mark.skipif(Image is None, reason="需要安装 Pillow")
+def test_pillow_not_imported_until_downscale():
+    code = (
+        "import sys, images; assert 'PIL' not in sys.modules; "
+        "assert images.ImageFetcher(images.ImageCache()).resizes; assert 'PIL' not in sys.modules; "
+        "images.downscale(b'', 'image/png', 10); assert 'PIL' in sys.modules"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
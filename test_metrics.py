@@ -0,0 +1,72 @@
+"""
+指标导出测试 - 与预期的Prometheus文本格式逐字节比较：标签转义、直方图的 _bucket/_sum/_count 和 +Inf
+"""
+from metrics import Registry
+
+EXPECTED = '''\
+# HELP test_requests 请求数，说明中的 \\\\ 和\\n换行需要转义
+# TYPE test_requests counter
+test_requests_total{model="claude",status="200"} 3
+test_requests_total{model="a\\\\b \\"q\\" \\n 中文",status="500"} 1
+# HELP test_inflight 正在处理的请求数
+# TYPE test_inflight gauge
+test_inflight 1.5
+# HELP test_duration_seconds 延迟
+# TYPE test_duration_seconds histogram
+test_duration_seconds_bucket{model="claude",le="0.1"} 1
+test_duration_seconds_bucket{model="claude",le="1"} 3
+test_duration_seconds_bucket{model="claude",le="2.5"} 3
+test_duration_seconds_bucket{model="claude",le="+Inf"} 4
+test_duration_seconds_sum{model="claude"} 5.5625
+test_duration_seconds_count{model="claude"} 4
+# HELP test_empty 没有样本的指标
+# TYPE test_empty counter
+'''
+
+
+def build() -> Registry:
+    registry = Registry()
+    requests = registry.counter("test_requests", "请求数，说明中的 \\ 和\n换行需要转义", ("model", "status"))
+    inflight = registry.gauge("test_inflight", "正在处理的请求数")
+    duration = registry.histogram("test_duration_seconds", "延迟", ("model",), buckets=(1.0, 0.1, 2.5))
+    registry.counter("test_empty", "没有样本的指标")
+
+    requests.labels("claude", 200).inc(2)
+    requests.labels("claude", "200").inc()
+    requests.labels('a\\b "q" \n 中文', 500).inc()
+    inflight.inc(2)
+    inflight.dec(0.5)
+    # 等于上界的值计入该分桶
+    for value in (0.0625, 1.0, 0.5, 4.0):
+        duration.labels("claude").observe(value)
+    return registry
+
+
+def test_exposition_golden_text():
+    assert build().render() == EXPECTED
+
+
+def test_merged_snapshots():
+    """多个进程的快照汇总：计数器和直方图相加，max仪表取最大值"""
+    snapshots = []
+    for value in (1, 3):
+        registry = Registry()
+        registry.counter("c", "c", ("k",)).labels("x").inc(value)
+        registry.gauge("g", "g", aggregate="max").set(value)
+        registry.histogram("h", "h", buckets=(2.0,)).observe(value)
+        snapshots.append(registry.snapshot())
+
+    assert registry.render(snapshots) == '''\
+# HELP c c
+# TYPE c counter
+c_total{k="x"} 4
+# HELP g g
+# TYPE g gauge
+g 3
+# HELP h h
+# TYPE h histogram
+h_bucket{le="2"} 1
+h_bucket{le="+Inf"} 2
+h_sum 4
+h_count 2
+'''
@@ -0,0 +1,343 @@
+"""
+端到端测试 - 模拟上游在本地线程中运行，代理作为子进程启动，不需要网络和真实密钥
+"""
+import contextlib
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import httpx
+import pytest
+import uvicorn
+
+from mock_upstream import MockConfig, create_mock_app
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+TOOLS = [
+    {"type": "function", "function": {
+        "name": "search", "description": "搜索",
+        "parameters": {"type": "object", "properties": {"query": {"type": "string"}, "limit": {"type": "integer"}}},
+    }},
+    {"type": "function", "function": {
+        "name": "lookup", "description": "查询",
+        "parameters": {"type": "object", "properties": {"query": {"type": "string"}}},
+    }},
+]
+
+
+def listen() -> socket.socket:
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(128)
+    return sock
+
+
+@pytest.fixture(scope="module")
+def mock():
+    """模拟上游：每个流式token间隔5毫秒，max_tokens大的请求可以持续数秒"""
+    app = create_mock_app(MockConfig(latency=0.01, tokens_per_second=200, output_tokens=2000))
+    sock = listen()
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    app.state.url = "http://127.0.0.1:%d" % sock.getsockname()[1]
+    yield app
+    server.should_exit = True
+    thread.join(5)
+
+
+@contextlib.contextmanager
+def run_proxy(mock, directory, **settings):
+    """以子进程运行代理，上游指向模拟上游，settings为额外的环境变量，返回代理地址"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = {
+        **os.environ,
+        "BASE_URL": mock.state.url, "API_KEY": "sk-test", "HOST": "127.0.0.1", "PORT": str(port),
+        "RESPONSE_CACHE_ENABLED": "false", "WORKERS": "1", **settings,
+    }
+    # 在临时目录中运行，不读取开发环境的.env
+    log = open(os.path.join(directory, "proxy.log"), "a+")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "main.py")], env=env, cwd=directory, stdout=log, stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if httpx.get(url + "/health", timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if process.poll() is not None or time.monotonic() > deadline:
+                log.seek(0)
+                pytest.fail("代理启动失败:\n" + log.read())
+            time.sleep(0.1)
+        yield url
+    finally:
+        process.terminate()
+        process.wait(10)
+        log.close()
+
+
+@pytest.fixture(scope="module")
+def proxy(mock, tmp_path_factory):
+    with run_proxy(mock, tmp_path_factory.mktemp("proxy")) as url:
+        yield url
+
+
+def chat(proxy: str, **body) -> dict:
+    response = httpx.post(proxy + "/v1/chat/completions", json={"model": "mock-model", **body}, timeout=30)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def stream(proxy: str, **body) -> List[dict]:
+    chunks = []
+    with httpx.stream("POST", proxy + "/v1/chat/completions",
+                      json={"model": "mock-model", "stream": True, **body}, timeout=30) as response:
+        assert response.status_code == 200, response.read()
+        for line in response.iter_lines():
+            if not line.startswith("data: "):
+                continue
+            if line == "data: [DONE]":
+                return chunks
+            chunks.append(json.loads(line[6:]))
+    pytest.fail("流没有以[DONE]结束")
+
+
+def metric(proxy: str, name: str) -> float:
+    """读取代理 /metrics 中某个指标所有样本的和"""
+    text = httpx.get(proxy + "/metrics", timeout=5).text
+    return sum(float(value) for value in re.findall(rf"^{name}(?:{{[^}}]*}})? (\S+)$", text, re.M))
+
+
+def wait_for(check, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline, "超时"
+        time.sleep(0.05)
+
+
+def finish_reasons(chunks: List[dict]) -> List[str]:
+    return [choice["finish_reason"] for chunk in chunks for choice in chunk["choices"] if choice.get("finish_reason")]
+
+
+def text_of(chunks: List[dict]) -> str:
+    return "".join(choice["delta"].get("content") or "" for chunk in chunks for choice in chunk["choices"])
+
+
+def test_tool_call_non_stream(proxy):
+    data = chat(proxy, max_tokens=8, tools=TOOLS, messages=[{"role": "user", "content": "找一下"}])
+    choice = data["choices"][0]
+    assert choice["finish_reason"] == "tool_calls"
+    call, = choice["message"]["tool_calls"]
+    assert call["type"] == "function" and call["id"].startswith("toolu_")
+    assert call["function"]["name"] == "search"
+    assert json.loads(call["function"]["arguments"]) == {"query": "token " * 8, "limit": 3}
+    assert choice["message"]["content"] == "calling tool"
+
+
+@pytest.mark.parametrize("tools, expected", [
+    ([{"type": "retrieval"}], "tools[0]的type必须是function"),
+    ([TOOLS[0], {"type": "function"}], "tools[1]缺少function对象"),
+    ([TOOLS[0], "search"], "tools[1]的type必须是function"),
+])
+def test_unsupported_tool_rejected(proxy, tools, expected):
+    # 不能转换的工具不会被静默丢弃，整个请求返回422
+    for is_stream in (False, True):
+        response = httpx.post(proxy + "/v1/chat/completions", timeout=30, json={
+            "model": "mock-model", "stream": is_stream, "tools": tools, "messages": [{"role": "user", "content": "hi"}],
+        })
+        assert response.status_code == 422
+        assert expected in response.text
+
+
+def test_tool_choice_selects_function(proxy):
+    data = chat(proxy, max_tokens=4, tools=TOOLS, tool_choice={"type": "function", "function": {"name": "lookup"}},
+                messages=[{"role": "user", "content": "查一下"}])
+    assert data["choices"][0]["message"]["tool_calls"][0]["function"]["name"] == "lookup"
+    data = chat(proxy, max_tokens=4, tools=TOOLS, tool_choice="none", messages=[{"role": "user", "content": "hi"}])
+    assert data["choices"][0]["finish_reason"] == "length"
+    assert not data["choices"][0]["message"].get("tool_calls")
+
+
+def test_tool_call_stream_arguments_are_incremental(proxy):
+    chunks = stream(proxy, max_tokens=12, tools=TOOLS, messages=[{"role": "user", "content": "找一下"}])
+    deltas = [call for chunk in chunks for choice in chunk["choices"]
+              for call in choice["delta"].get("tool_calls") or ()]
+    first = deltas[0]
+    assert first["index"] == 0 and first["id"].startswith("toolu_")
+    assert first["type"] == "function" and first["function"]["name"] == "search"
+    arguments = [delta["function"]["arguments"] for delta in deltas if delta["function"].get("arguments")]
+    # 模拟上游把参数切成16字节的片段，代理逐片转发而不是拼好后一次发送
+    assert len(arguments) > 2
+    assert json.loads("".join(arguments)) == {"query": "token " * 12, "limit": 3}
+    assert all(delta["index"] == 0 for delta in deltas)
+    assert finish_reasons(chunks) == ["tool_calls"]
+
+
+def test_tool_result_round_trip(proxy):
+    """assistant的tool_calls和role为tool的消息转换为tool_use和tool_result，上游不再要求调用工具"""
+    call = {"id": "toolu_1", "type": "function", "function": {"name": "search", "arguments": '{"query": "x"}'}}
+    messages = [
+        {"role": "user", "content": "找一下"},
+        {"role": "assistant", "content": None, "tool_calls": [call]},
+        {"role": "tool", "tool_call_id": "toolu_1", "content": "结果"},
+    ]
+    data = chat(proxy, max_tokens=3, tools=TOOLS, messages=messages)
+    assert data["choices"][0]["finish_reason"] == "length"
+    assert data["choices"][0]["message"]["content"] == "token " * 3
+    chunks = stream(proxy, max_tokens=3, tools=TOOLS, messages=messages)
+    assert text_of(chunks) == "token " * 3
+    assert finish_reasons(chunks) == ["length"]
+
+
+def test_stream_finish_reasons(proxy):
+    messages = [{"role": "user", "content": "hi"}]
+    # 模拟上游输出max_tokens个token时停止原因为max_tokens
+    assert finish_reasons(stream(proxy, max_tokens=5, messages=messages)) == ["length"]
+    data = chat(proxy, max_tokens=5, messages=messages)
+    assert data["choices"][0]["finish_reason"] == "length"
+
+
+def test_stream_usage_chunk(proxy):
+    messages = [{"role": "user", "content": "hi"}]
+    chunks = stream(proxy, max_tokens=7, messages=messages, stream_options={"include_usage": True})
+    usage_chunks = [chunk for chunk in chunks if chunk.get("usage")]
+    assert len(usage_chunks) == 1 and usage_chunks[0] is chunks[-1]
+    assert usage_chunks[0]["choices"] == []
+    usage = usage_chunks[0]["usage"]
+    assert usage["completion_tokens"] == 7
+    assert usage["prompt_tokens"] > 0
+    assert usage["total_tokens"] == usage["prompt_tokens"] + usage["completion_tokens"]
+    assert text_of(chunks) == "token " * 7
+    assert chunks[0]["choices"][0]["delta"].get("role") == "assistant"
+
+    chunks = stream(proxy, max_tokens=7, messages=messages)
+    assert not any(chunk.get("usage") for chunk in chunks)
+
+
+def test_client_disconnect_cancels_upstream_stream(proxy, mock):
+    """客户端读到几个增量后断开，代理立即取消上游流（约10秒的输出不会继续生成），并释放上游并发名额"""
+    wait_for(lambda: mock.state.streams == 0)
+    cancelled = metric(proxy, "proxy_upstream_streams_cancelled_total")
+    disconnects = metric(proxy, "proxy_client_disconnects_total")
+
+    body = {"model": "mock-model", "stream": True, "max_tokens": 2000, "messages": [{"role": "user", "content": "hi"}]}
+    with httpx.stream("POST", proxy + "/v1/chat/completions", json=body, timeout=30) as response:
+        lines = response.iter_lines()
+        received = 0
+        for line in lines:
+            if line.startswith("data: "):
+                received += 1
+            if received >= 5:
+                break
+        assert mock.state.streams == 1
+    started = time.monotonic()
+
+    wait_for(lambda: mock.state.streams == 0)
+    assert time.monotonic() - started < 3
+    wait_for(lambda: metric(proxy, "proxy_upstream_streams_cancelled_total") == cancelled + 1)
+    assert metric(proxy, "proxy_client_disconnects_total") == disconnects + 1
+    assert metric(proxy, "proxy_upstream_inflight_requests") == 0
+
+    # 取消后代理仍能正常处理新请求
+    assert text_of(stream(proxy, max_tokens=3, messages=[{"role": "user", "content": "hi"}])) == "token " * 3
+
+
+def test_disk_cache_survives_proxy_restart(mock, tmp_path):
+    """磁盘缓存中的响应在代理重启后仍然命中，不再请求上游"""
+    # 容量小时索引只有几千个槽位，重启后很快加载完
+    settings = {
+        "RESPONSE_CACHE_ENABLED": "true", "DISK_CACHE_DIR": str(tmp_path / "cache"),
+        "DISK_CACHE_MAX_BYTES": str(16 * 1024 * 1024),
+    }
+    body = {"model": "mock-model", "max_tokens": 4, "messages": [{"role": "user", "content": "cache me"}]}
+    headers = {"x-proxy-cache": "on"}
+
+    with run_proxy(mock, tmp_path, **settings) as proxy:
+        response = httpx.post(proxy + "/v1/chat/completions", json=body, headers=headers, timeout=30)
+        assert response.headers["x-proxy-cache"] == "MISS"
+        wait_for(lambda: metric(proxy, "proxy_disk_cache_entries") == 1)
+        expected = response.json()
+
+    requests = mock.state.requests
+    with run_proxy(mock, tmp_path, **settings) as proxy:
+        # 磁盘缓存在后台线程中加载
+        wait_for(lambda: metric(proxy, "proxy_disk_cache_entries") == 1)
+        time.sleep(0.2)
+        response = httpx.post(proxy + "/v1/chat/completions", json=body, headers=headers, timeout=30)
+        assert response.headers["x-proxy-cache"] == "HIT"
+        assert response.json() == expected
+    assert mock.state.requests == requests
+
+
+def test_batch_round_trip(mock, tmp_path):
+    """批处理按数量上限拆分提交，无效行和重复custom_id写入错误文件，映射过的custom_id在结果中还原"""
+    settings = {"BATCH_DIR": str(tmp_path / "batches"), "BATCH_POLL_INTERVAL": "0.2", "BATCH_MAX_REQUESTS": "3"}
+    custom_ids = ["a-1", "a-2", "请求 3", "a-4", "a-5"]
+    lines = [
+        json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": {
+            "model": "mock-model", "max_tokens": 2, "messages": [{"role": "user", "content": custom_id}]}})
+        for custom_id in custom_ids
+    ]
+    lines[1:1] = ["{not json", lines[0]]
+
+    with run_proxy(mock, tmp_path, **settings) as proxy:
+        requests = mock.state.requests
+        uploaded = httpx.post(proxy + "/v1/files", data={"purpose": "batch"},
+                              files={"file": ("input.jsonl", "\n".join(lines).encode())}, timeout=30).json()
+        batch = httpx.post(proxy + "/v1/batches", json={
+            "input_file_id": uploaded["id"], "endpoint": "/v1/chat/completions"}, timeout=30).json()
+
+        def completed():
+            nonlocal batch
+            batch = httpx.get(f"{proxy}/v1/batches/{batch['id']}", timeout=30).json()
+            return batch["status"] == "completed"
+
+        wait_for(completed, timeout=20)
+        output = httpx.get(f"{proxy}/v1/files/{batch['output_file_id']}/content", timeout=30).text
+        errors = httpx.get(f"{proxy}/v1/files/{batch['error_file_id']}/content", timeout=30).text
+
+    # 5个有效请求按上限3拆成两个Anthropic批处理
+    assert mock.state.requests - requests == 2
+    assert batch["request_counts"] == {"total": 7, "completed": 5, "failed": 2}
+    results = [json.loads(line) for line in output.splitlines()]
+    assert sorted(result["custom_id"] for result in results) == sorted(custom_ids)
+    assert all(result["response"]["status_code"] == 200 for result in results)
+    failed = [json.loads(line) for line in errors.splitlines()]
+    assert len(failed) == 2
+    assert [item["custom_id"] for item in failed] == [None, "a-1"]
+
+
+def test_coalesce_only_deterministic_requests(proxy, mock):
+    """未指定temperature的并发请求各自请求上游；声明为确定性（X-Proxy-Cache: on）的相同请求合并为一次上游调用"""
+    body = {"model": "mock-model", "max_tokens": 100, "messages": [{"role": "user", "content": "coalesce"}]}
+
+    def concurrent(headers: dict) -> List[dict]:
+        with ThreadPoolExecutor(4) as pool:
+            return list(pool.map(lambda _: httpx.post(
+                proxy + "/v1/chat/completions", json=body, headers=headers, timeout=30).json(), range(4)))
+
+    requests = mock.state.requests
+    sampled = concurrent({})
+    assert mock.state.requests - requests == 4
+    assert len({item["id"] for item in sampled}) == 4
+
+    requests = mock.state.requests
+    deterministic = concurrent({"x-proxy-cache": "on"})
+    assert mock.state.requests - requests == 1
+    assert len({item["id"] for item in deterministic}) == 1
@@ -0,0 +1,133 @@
+"""
+提示词缓存测试 - 重复前缀的断点位置（工具定义、system、消息前缀）、token数下限和最多4个断点
+"""
+import pytest
+
+from prompt_cache import EPHEMERAL, MAX_BREAKPOINTS, PrefixTracker, add_cache_breakpoints, existing_breakpoints
+
+LONG = "lorem ipsum dolor sit amet " * 200
+TOOLS = [
+    {"name": "lookup", "description": LONG, "input_schema": {"type": "object"}},
+    {"name": "search", "description": "search", "input_schema": {"type": "object"}},
+]
+
+
+def request(*contents, system=None, tools=None, model="claude"):
+    kwargs = {"model": model, "max_tokens": 16, "messages": [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": content} for i, content in enumerate(contents)
+    ]}
+    if system is not None:
+        kwargs["system"] = system
+    if tools is not None:
+        kwargs["tools"] = tools
+    return kwargs
+
+
+def marked_messages(kwargs) -> list:
+    return [
+        index for index, message in enumerate(kwargs["messages"])
+        if isinstance(message["content"], list) and "cache_control" in message["content"][-1]
+    ]
+
+
+def test_first_occurrence_is_not_marked():
+    tracker = PrefixTracker()
+    kwargs = request("hi", system=LONG, tools=TOOLS)
+    assert add_cache_breakpoints(kwargs, tracker, 10) is kwargs
+
+
+def test_repeated_system_and_message_prefix():
+    tracker = PrefixTracker()
+    add_cache_breakpoints(request(LONG, system=LONG), tracker, 10)
+    # 第二轮对话：system和第一条消息重复，后面是新消息
+    kwargs = request(LONG, "answer", "follow up", system=LONG)
+    result = add_cache_breakpoints(kwargs, tracker, 10)
+
+    assert result["system"] == [{"type": "text", "text": LONG, "cache_control": EPHEMERAL}]
+    assert marked_messages(result) == [0]
+    assert result["messages"][0]["content"] == [{"type": "text", "text": LONG, "cache_control": EPHEMERAL}]
+    # 不修改原请求
+    assert kwargs["system"] == LONG and kwargs["messages"][0]["content"] == LONG
+
+
+def test_longest_repeated_prefix_wins():
+    tracker = PrefixTracker()
+    add_cache_breakpoints(request(LONG, "a", "b", "c"), tracker, 10)
+    result = add_cache_breakpoints(request(LONG, "a", "b", "different"), tracker, 10)
+    assert marked_messages(result) == [2]
+
+
+def test_repeated_tools_marked_on_last_tool():
+    tracker = PrefixTracker()
+    add_cache_breakpoints(request("first", tools=TOOLS), tracker, 10)
+    result = add_cache_breakpoints(request("second", system="changes every time", tools=TOOLS), tracker, 10)
+    assert "cache_control" not in result["tools"][0]
+    assert result["tools"][-1] == {**TOOLS[-1], "cache_control": EPHEMERAL}
+    assert "cache_control" not in TOOLS[-1]
+    assert result["system"] == "changes every time"
+    assert marked_messages(result) == []
+
+
+def test_block_content_marks_last_block():
+    tracker = PrefixTracker()
+    blocks = [{"type": "text", "text": LONG}, {"type": "text", "text": "tail"}]
+    add_cache_breakpoints(request(blocks, "x"), tracker, 10)
+    result = add_cache_breakpoints(request(blocks, "y"), tracker, 10)
+    assert result["messages"][0]["content"] == [blocks[0], {**blocks[1], "cache_control": EPHEMERAL}]
+    assert "cache_control" not in blocks[1]
+
+
+def test_short_prefix_below_min_tokens():
+    tracker = PrefixTracker()
+    add_cache_breakpoints(request("short", system="short"), tracker, 1024)
+    kwargs = request("short", "next", system="short")
+    assert add_cache_breakpoints(kwargs, tracker, 1024) is kwargs
+
+
+def test_prefixes_are_per_model():
+    tracker = PrefixTracker()
+    add_cache_breakpoints(request(LONG, system=LONG, model="a"), tracker, 10)
+    kwargs = request(LONG, system=LONG, model="b")
+    assert add_cache_breakpoints(kwargs, tracker, 10) is kwargs
+
+
+def with_existing(count: int) -> list:
+    """带有count个客户端断点的历史消息"""
+    return [[{"type": "text", "text": f"{LONG} {i}", "cache_control": EPHEMERAL}] for i in range(count)]
+
+
+@pytest.mark.parametrize("existing, expected", [
+    (0, {"message", "system", "tools"}),
+    (1, {"message", "system", "tools"}),
+    (2, {"message", "system"}),
+    (3, {"message"}),
+    (4, set()),
+])
+def test_breakpoint_cap(existing, expected):
+    tracker = PrefixTracker()
+    history = with_existing(existing) + [LONG]
+    add_cache_breakpoints(request(*history, system=LONG, tools=TOOLS), tracker, 10)
+    kwargs = request(*history, "new", system=LONG, tools=TOOLS)
+    result = add_cache_breakpoints(kwargs, tracker, 10)
+
+    added = set()
+    if "cache_control" in result["tools"][-1]:
+        added.add("tools")
+    if isinstance(result["system"], list):
+        added.add("system")
+    if len(marked_messages(result)) > existing:
+        added.add("message")
+    assert added == expected
+    assert existing_breakpoints(result) == existing + len(expected) <= MAX_BREAKPOINTS
+
+
+def test_tracker_evicts_least_recent():
+    tracker = PrefixTracker(max_entries=2)
+    assert not tracker.seen(b"a")
+    assert not tracker.seen(b"b")
+    assert tracker.seen(b"a")
+    assert not tracker.seen(b"c")
+    assert len(tracker) == 2
+    # b最久未出现，已被淘汰
+    assert not tracker.seen(b"b")
+    assert not tracker.seen(b"a")
@@ -0,0 +1,160 @@
+"""
+限速测试 - 令牌桶的补充和等待时间、从 anthropic-ratelimit-* 响应头校准、429后暂停发送
+"""
+import asyncio
+
+import pytest
+
+import ratelimit
+from ratelimit import RateLimiter, TokenBucket, parse_reset
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        # 2025-01-01T00:00:00Z
+        self.wall = 1735689600.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.wall
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+        self.wall += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    monkeypatch.setattr(ratelimit.time, "time", clock.time)
+    return clock
+
+
+def headers(kind: str, limit=None, remaining=None, reset=None) -> dict:
+    result = {}
+    if limit is not None:
+        result[f"anthropic-ratelimit-{kind}-limit"] = str(limit)
+    if remaining is not None:
+        result[f"anthropic-ratelimit-{kind}-remaining"] = str(remaining)
+    if reset is not None:
+        result[f"anthropic-ratelimit-{kind}-reset"] = reset
+    return result
+
+
+def test_parse_reset(clock):
+    assert parse_reset("2025-01-01T00:00:30Z") == 30
+    assert parse_reset("2025-01-01T00:00:30+00:00") == 30
+    # 没有时区时按UTC处理，已过去的时间返回0
+    assert parse_reset("2025-01-01T00:00:30") == 30
+    assert parse_reset("2024-12-31T23:59:00Z") == 0
+    assert parse_reset("not a date") is None
+    assert parse_reset(None) is None
+
+
+def test_unknown_limit_never_waits(clock):
+    bucket = TokenBucket()
+    assert all(bucket.reserve(1000) == 0 for _ in range(100))
+
+
+def test_reserve_and_refill(clock):
+    bucket = TokenBucket(60)
+    for _ in range(60):
+        assert bucket.reserve(1) == 0
+    # 每秒补充1个令牌
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    assert bucket.reserve(1) == pytest.approx(2.0)
+    clock.advance(2)
+    assert bucket.reserve(1) == pytest.approx(1.0)
+
+    # 补充不超过容量
+    clock.advance(3600)
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+
+
+def test_oversized_request_is_capped_at_capacity(clock):
+    bucket = TokenBucket(10)
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(1000) == pytest.approx(60.0)
+
+
+def test_sync_requests_from_headers(clock):
+    limiter = RateLimiter()
+    limiter.update(headers("requests", limit=120, remaining=119, reset="2025-01-01T00:00:00.5Z"))
+    assert limiter.status()["requests_per_minute"] == 120
+    # 剩余量低于本地令牌时下调
+    assert limiter.requests.tokens == 119
+    # 到重置时间补满：至少 (120-119)/0.5 每秒
+    assert limiter.requests.rate == pytest.approx(2.0)
+
+    limiter.update(headers("requests", limit=120, remaining=0, reset="2025-01-01T00:00:30Z"))
+    assert limiter.requests.tokens == 0
+    assert limiter.requests.rate == pytest.approx(4.0)
+    assert limiter.reserve(0) == pytest.approx(0.25)
+
+
+def test_remaining_only_lowers_tokens(clock):
+    limiter = RateLimiter(rpm=60)
+    for _ in range(10):
+        limiter.reserve(0)
+    assert limiter.requests.tokens == 50
+    # 上游剩余量更多（本地预占了在途请求）时不上调
+    limiter.update(headers("requests", limit=60, remaining=55))
+    assert limiter.requests.tokens == 50
+    limiter.update(headers("requests", limit=60, remaining=5))
+    assert limiter.requests.tokens == 5
+
+
+def test_input_token_headers_take_precedence(clock):
+    limiter = RateLimiter()
+    limiter.update({**headers("tokens", limit=1000, remaining=900), **headers("input-tokens", limit=400, remaining=300)})
+    assert limiter.status()["tokens_per_minute"] == 400
+    assert limiter.tokens.tokens == 300
+    # 之后只有总token头时也不再用它覆盖输入token限额
+    limiter.update(headers("tokens", limit=1000, remaining=1000))
+    assert limiter.status()["tokens_per_minute"] == 400
+
+
+def test_total_tokens_used_without_input_headers(clock):
+    limiter = RateLimiter()
+    limiter.update(headers("tokens", limit=6000, remaining=6000))
+    assert limiter.status()["tokens_per_minute"] == 6000
+    assert limiter.reserve(6000) == 0
+    assert limiter.reserve(100) == pytest.approx(1.0)
+
+
+def test_429_blocks_until_retry_after(clock):
+    limiter = RateLimiter()
+    limiter.update({"retry-after": "3"}, 429)
+    assert limiter.reserve(0) == pytest.approx(3.0)
+    clock.advance(2)
+    assert limiter.reserve(0) == pytest.approx(1.0)
+    clock.advance(1)
+    assert limiter.reserve(0) == 0
+    # 没有Retry-After时暂停1秒
+    limiter.update({}, 429)
+    assert limiter.reserve(0) == pytest.approx(1.0)
+
+
+def test_wait_sleeps_for_reserved_delay(clock, monkeypatch):
+    slept = []
+
+    async def sleep(seconds):
+        slept.append(seconds)
+        clock.advance(seconds)
+
+    monkeypatch.setattr(ratelimit.asyncio, "sleep", sleep)
+    limiter = RateLimiter(rpm=60, tpm=600)
+
+    async def scenario():
+        assert await limiter.wait(600) == 0
+        # 请求令牌还有，token桶要等 100/10 秒
+        assert await limiter.wait(100) == pytest.approx(10.0)
+        assert await limiter.wait(0) == 0
+
+    asyncio.run(scenario())
+    assert slept == [pytest.approx(10.0)]
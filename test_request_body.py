@@ -0,0 +1,81 @@
+"""
+请求体解析测试 - 结构不合法的消息应作为请求体错误（422）返回，增量解析和一次性解析的行为一致
+"""
+import asyncio
+import json
+import subprocess
+import sys
+
+import pytest
+
+from request_body import BodyError, parse_chat_body
+
+
+def parse(body: dict, incremental: bool, chunk_size: int = 7):
+    raw = json.dumps(body).encode("utf-8")
+
+    async def chunks():
+        for i in range(0, len(raw), chunk_size):
+            yield raw[i:i + chunk_size]
+
+    return asyncio.run(parse_chat_body(chunks(), incremental=incremental))
+
+
+BAD_MESSAGES = [
+    ({"role": "user", "content": [1]}, "messages[0]"),
+    ({"role": "user", "content": [None]}, "messages[0]"),
+    ({"role": "user", "content": [{"type": ["text"]}]}, "type"),
+    ({"role": "user", "content": [{"type": "text", "text": 5}]}, "text"),
+    ({"role": "user", "content": [{"type": "image_url", "image_url": {"url": 7}}]}, "url"),
+    ({"role": "system", "content": [1]}, "messages[0]"),
+    ({"role": "assistant", "content": "x", "tool_calls": [1]}, "tool_calls"),
+    ({"role": "assistant", "content": "x", "tool_calls": {"id": "a"}}, "tool_calls"),
+    ({"role": "assistant", "content": None, "tool_calls": [{"id": "a", "function": "f"}]}, "function"),
+    ({"role": "assistant", "content": None,
+      "tool_calls": [{"id": "a", "function": {"name": "f", "arguments": "{not json"}}]}, "arguments"),
+    ({"role": "assistant", "content": None,
+      "tool_calls": [{"id": "a", "function": {"name": "f", "arguments": "[1, 2]"}}]}, "arguments"),
+    ("hello", "messages[0]"),
+]
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+@pytest.mark.parametrize("message,expected", BAD_MESSAGES)
+def test_malformed_message_is_body_error(message, expected, incremental):
+    with pytest.raises(BodyError) as info:
+        parse({"model": "m", "messages": [message]}, incremental)
+    assert expected in str(info.value)
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_error_points_at_bad_message(incremental):
+    good = {"role": "user", "content": "hi"}
+    with pytest.raises(BodyError, match=r"messages\[2\]"):
+        parse({"messages": [good, good, {"role": "user", "content": [1]}]}, incremental)
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_valid_parts_still_convert(incremental):
+    body = parse({
+        "model": "m",
+        "messages": [
+            {"role": "system", "content": [{"type": "text", "text": "be brief"}]},
+            {"role": "user", "content": ["a", {"type": "text", "text": "b"}]},
+        ],
+    }, incremental)
+    system, messages = body.converted(None)
+    assert system == "be brief"
+    assert body.fields == {"model": "m"}
+    assert messages[0]["role"] == "user"
+
+
+def test_ijson_not_imported_until_incremental_parse():
+    pytest.importorskip("ijson")
+    code = (
+        "import sys, asyncio, request_body; assert 'ijson' not in sys.modules; "
+        "asyncio.run(request_body.parse_chat_body(iter_chunks(), incremental=False)); "
+        "assert 'ijson' not in sys.modules; "
+        "asyncio.run(request_body.parse_chat_body(iter_chunks(), incremental=True)); assert 'ijson' in sys.modules"
+    )
+    setup = "async def iter_chunks():\n    yield b'{\"messages\": []}'\n"
+    subprocess.run([sys.executable, "-c", setup + code], check=True)
@@ -0,0 +1,271 @@
+"""
+重试与对冲测试 - 退避时长的范围、可重试错误的重试次数、流式输出开始后不再重试、对冲请求取消落后的一方
+"""
+import asyncio
+import json
+import random
+
+import pytest
+
+anthropic = pytest.importorskip("anthropic")
+
+import main
+import retry
+from admission import AdmissionController
+from retry import backoff_delay, hedge, retry_async
+from upstream import Upstream, UpstreamPool
+
+try:
+    import httpx2 as httpx
+except ImportError:
+    import httpx
+
+
+def connection_error() -> Exception:
+    return anthropic.APIConnectionError(request=httpx.Request("POST", "http://upstream/v1/messages"))
+
+
+def status_error(status: int, headers=None) -> Exception:
+    request = httpx.Request("POST", "http://upstream/v1/messages")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return anthropic.APIStatusError("error", response=response, body=None)
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """记录退避时长而不真正等待"""
+    slept = []
+
+    async def sleep(seconds):
+        slept.append(seconds)
+
+    monkeypatch.setattr(retry.asyncio, "sleep", sleep)
+    return slept
+
+
+@pytest.mark.parametrize("attempt", range(8))
+def test_backoff_within_bounds(attempt):
+    random.seed(attempt)
+    cap = min(10.0, 0.5 * 2 ** attempt)
+    delays = [backoff_delay(attempt, 0.5, 10.0) for _ in range(500)]
+    assert all(0 <= delay <= cap for delay in delays)
+    # 完全抖动：样本分布在整个区间内
+    assert max(delays) > cap * 0.9 and min(delays) < cap * 0.1
+
+
+def test_backoff_honours_retry_after_up_to_max():
+    random.seed(1)
+    assert all(backoff_delay(0, 0.5, 10.0, retry_after=3) >= 3 for _ in range(100))
+    assert all(backoff_delay(5, 0.5, 10.0, retry_after=60) == 10.0 for _ in range(100))
+
+
+def test_retry_after_of_reads_header():
+    assert retry.retry_after_of(status_error(429, {"retry-after": "2.5"})) == 2.5
+    assert retry.retry_after_of(status_error(429)) is None
+    assert retry.retry_after_of(ValueError()) is None
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (connection_error(), True),
+    (status_error(429), True),
+    (status_error(408), True),
+    (status_error(500), True),
+    (status_error(529), True),
+    (status_error(400), False),
+    (status_error(404), False),
+    (ValueError("bad"), False),
+])
+def test_is_retryable(error, retryable):
+    assert retry.is_retryable(error) is retryable
+
+
+def test_retry_async_retries_transient_errors(no_sleep):
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise status_error(529, {"retry-after": "1"})
+        return "ok"
+
+    assert asyncio.run(retry_async(flaky, 3, 0.1, 5.0)) == "ok"
+    assert len(calls) == 3
+    assert len(no_sleep) == 2 and all(1 <= delay <= 5 for delay in no_sleep)
+
+
+def test_retry_async_gives_up(no_sleep):
+    calls = []
+
+    async def down():
+        calls.append(1)
+        raise connection_error()
+
+    with pytest.raises(anthropic.APIConnectionError):
+        asyncio.run(retry_async(down, 2, 0.1, 5.0))
+    assert len(calls) == 3
+
+    calls.clear()
+
+    async def invalid():
+        calls.append(1)
+        raise status_error(400)
+
+    with pytest.raises(anthropic.APIStatusError):
+        asyncio.run(retry_async(invalid, 5, 0.1, 5.0))
+    assert len(calls) == 1
+
+
+class Attempt:
+    """可控的请求：记录是否开始和是否被取消"""
+
+    def __init__(self, delay: float, result=None, error: Exception = None):
+        self.delay = delay
+        self.result = result
+        self.error = error
+        self.started = False
+        self.cancelled = False
+
+    async def __call__(self):
+        self.started = True
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def test_hedge_not_sent_when_primary_is_fast():
+    primary, secondary = Attempt(0.01, "primary"), Attempt(0.01, "secondary")
+    assert asyncio.run(hedge(primary, secondary, 0.5)) == "primary"
+    assert not secondary.started
+
+
+def test_hedge_cancels_losing_primary():
+    primary, secondary = Attempt(5, "primary"), Attempt(0.01, "secondary")
+
+    async def scenario():
+        result = await hedge(primary, secondary, 0.02)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(scenario()) == "secondary"
+    assert primary.cancelled
+
+
+def test_hedge_cancels_losing_secondary():
+    primary, secondary = Attempt(0.05, "primary"), Attempt(5, "secondary")
+
+    async def scenario():
+        result = await hedge(primary, secondary, 0.02)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(scenario()) == "primary"
+    assert secondary.started and secondary.cancelled
+
+
+def test_hedge_waits_for_other_attempt_after_failure():
+    primary = Attempt(0.03, error=RuntimeError("primary failed"))
+    secondary = Attempt(0.05, "secondary")
+    assert asyncio.run(hedge(primary, secondary, 0.01)) == "secondary"
+
+    both = Attempt(0.03, error=RuntimeError("one")), Attempt(0.01, error=RuntimeError("two"))
+    with pytest.raises(RuntimeError):
+        asyncio.run(hedge(*both, 0.01))
+
+
+def test_cancelling_hedge_cancels_both_attempts():
+    primary, secondary = Attempt(5), Attempt(5)
+
+    async def scenario():
+        task = asyncio.create_task(hedge(primary, secondary, 0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert primary.cancelled and secondary.cancelled
+
+
+def sse(event: dict) -> bytes:
+    return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+class FakeStream:
+    """with_streaming_response.create 返回的上下文：输出几个事件后按需抛出错误"""
+
+    def __init__(self, events, error=None):
+        self.events = events
+        self.error = error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def iter_bytes(self):
+        for event in self.events:
+            yield sse(event)
+        if self.error is not None:
+            raise self.error
+
+
+class FakeClient:
+    """依次返回预设的流，create本身可以抛出连接错误（尚未收到任何字节）"""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.messages = self
+        self.with_streaming_response = self
+
+    def create(self, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+START = {"type": "message_start", "message": {"usage": {"input_tokens": 3}}}
+DELTA = {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "hi"}}
+STOP = {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": 1}}
+
+
+@pytest.fixture
+def stream_settings(monkeypatch, no_sleep):
+    monkeypatch.setattr(main, "RETRY_MAX_RETRIES", 3)
+    monkeypatch.setattr(main, "RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(main, "PROMPT_CACHE_ENABLED", False)
+
+
+def run_stream(client: FakeClient) -> bytes:
+    admission = AdmissionController(UpstreamPool([Upstream("a", client)]))
+    request = main.ChatRequest(model="claude", messages=[{"role": "user", "content": "hi"}], stream=True)
+
+    async def collect():
+        return b"".join([chunk async for chunk in main.stream_generator(admission, request)])
+
+    return asyncio.run(collect())
+
+
+def test_stream_retries_before_first_byte(stream_settings):
+    client = FakeClient([connection_error(), status_error(529), FakeStream([START, DELTA, STOP])])
+    output = run_stream(client)
+    assert client.calls == 3
+    assert b'"content": "hi"' in output
+    assert output.endswith(b"data: [DONE]\n\n")
+
+
+def test_stream_not_retried_after_first_byte(stream_settings):
+    client = FakeClient([FakeStream([START, DELTA], connection_error()), FakeStream([START, DELTA, STOP])])
+    output = run_stream(client)
+    # 已经向客户端输出了数据，重试会重复内容，只能以错误结束
+    assert client.calls == 1
+    assert output.count(b'"content": "hi"') == 1
+    assert b'"error": "APIConnectionError' in output
+    assert b"[DONE]" not in output
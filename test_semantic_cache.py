@@ -0,0 +1,140 @@
+"""
+语义缓存测试 - 近似重复命中、命名空间隔离、过期和淘汰，以及不启用时不导入numpy
+"""
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import semantic_cache
+from semantic_cache import HashedNgramVectorizer, SemanticCache, split_query
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(semantic_cache.time, "monotonic", clock)
+    return clock
+
+
+def request(text: str, **extra):
+    return {"model": "m", "max_tokens": 100, "messages": [{"role": "user", "content": text}], **extra}
+
+
+def lookup(cache: SemanticCache, kwargs):
+    namespace, text = split_query(kwargs)
+    return cache.get(namespace, cache.embed(text))
+
+
+def store(cache: SemanticCache, kwargs, body: bytes):
+    namespace, text = split_query(kwargs)
+    cache.set(namespace, cache.embed(text), body)
+
+
+def test_vectors_are_normalized():
+    vectorizer = HashedNgramVectorizer(dim=256)
+    vector = vectorizer.transform("What is the capital of France?")
+    assert vector.shape == (256,)
+    assert abs(float(vector @ vector) - 1.0) < 1e-5
+    assert not vectorizer.transform("  ").any()
+
+
+def test_near_duplicate_hits(clock):
+    cache = SemanticCache(threshold=0.85)
+    store(cache, request("What is the capital of France?"), b"paris")
+    found = lookup(cache, request("what is the capital of france"))
+    assert found is not None and found[0] == b"paris" and found[1] >= 0.85
+    assert lookup(cache, request("How do I bake sourdough bread at home?")) is None
+
+
+def test_namespace_isolation(clock):
+    cache = SemanticCache(threshold=0.8)
+    store(cache, request("What is 2+2?"), b"4")
+    assert lookup(cache, request("What is 3+3?")) is None
+    assert lookup(cache, request("What is 2+2?", model="other")) is None
+    assert lookup(cache, request("What is 2+2?", system="be brief")) is None
+    assert lookup(cache, request("What is 2+2?"))[0] == b"4"
+
+
+def test_non_text_queries_are_skipped():
+    assert split_query(request("")) is None
+    assert split_query({"messages": [{"role": "assistant", "content": "hi"}]}) is None
+    image = [{"type": "image", "source": {}}, {"type": "text", "text": "what is this"}]
+    assert split_query({"messages": [{"role": "user", "content": image}]}) is None
+
+
+def test_expired_best_match_falls_back_to_valid_row(clock):
+    """相似度最高的条目过期时，仍能命中阈值以上、未过期的其它条目"""
+    cache = SemanticCache(threshold=0.7, ttl=100)
+    store(cache, request("tell me about the history of rome please"), b"older")
+    clock.now += 60
+    store(cache, request("tell me about the history of rome"), b"newer-but-less-similar")
+    clock.now += 50
+    # 第一条已过期，第二条还有50秒
+    found = lookup(cache, request("tell me about the history of rome please"))
+    assert found is not None and found[0] == b"newer-but-less-similar"
+    assert len(cache) == 1
+
+
+def test_all_expired_misses(clock):
+    cache = SemanticCache(threshold=0.7, ttl=10)
+    store(cache, request("tell me a joke"), b"a")
+    store(cache, request("tell me a joke please"), b"b")
+    clock.now += 11
+    assert lookup(cache, request("tell me a joke")) is None
+    assert len(cache) == 0
+    assert not cache._namespaces
+
+
+def test_lru_eviction_keeps_rows_consistent(clock):
+    cache = SemanticCache(threshold=0.99, max_entries=3)
+    texts = [f"question number {word}" for word in ("alpha", "bravo", "charlie", "delta", "echo")]
+    for i, text in enumerate(texts[:3]):
+        store(cache, request(text), str(i).encode())
+    # 访问第一条后它不再是最久未使用的条目
+    assert lookup(cache, request(texts[0]))[0] == b"0"
+    store(cache, request(texts[3]), b"3")
+    store(cache, request(texts[4]), b"4")
+    assert len(cache) == 3
+    assert lookup(cache, request(texts[1])) is None
+    assert lookup(cache, request(texts[2])) is None
+    for i in (0, 3, 4):
+        assert lookup(cache, request(texts[i]))[0] == str(i).encode()
+
+
+def word(i: int) -> str:
+    """不含数字的唯一文本（数字计入命名空间）"""
+    return "".join(chr(ord("a") + int(d)) for d in f"{i:04d}")
+
+
+def test_matrix_grows_and_shrinks(clock):
+    cache = SemanticCache(threshold=0.99, max_entries=1000, ttl=10)
+    for i in range(300):
+        store(cache, request(f"unique prompt {word(i)}"), b"%d" % i)
+    assert len(cache._namespaces) == 1
+    space = next(iter(cache._namespaces.values()))
+    assert len(space.matrix) >= 300
+    assert lookup(cache, request(f"unique prompt {word(123)}"))[0] == b"123"
+    clock.now += 11
+    store(cache, request("fresh prompt"), b"fresh")
+    assert len(cache) == 1
+    assert lookup(cache, request("fresh prompt"))[0] == b"fresh"
+
+
+def test_numpy_not_imported_until_used():
+    code = (
+        "import sys, semantic_cache; assert 'numpy' not in sys.modules; "
+        "assert semantic_cache.is_available(); assert 'numpy' not in sys.modules; "
+        "semantic_cache.HashedNgramVectorizer(); assert 'numpy' in sys.modules"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
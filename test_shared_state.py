@@ -0,0 +1,200 @@
+"""
+共享状态测试 - 在临时Unix socket上运行状态服务，验证不需要回复的消息的发送队列、重连和磁盘缓存读写
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import shared_state
+from cache import ResponseCache
+from disk_cache import DiskCache
+from metrics import SHARED_STATE_DROPPED
+from shared_state import StateClient, StateServer
+
+
+async def start(path: str, cache: ResponseCache = None):
+    state = StateServer(cache if cache is not None else ResponseCache())
+    server = await asyncio.start_unix_server(state.handle, path=path)
+    return state, server
+
+
+async def eventually(check, timeout: float = 3.0):
+    deadline = time.monotonic() + timeout
+    while not await check():
+        assert time.monotonic() < deadline, "超时"
+        await asyncio.sleep(0.02)
+
+
+def dropped(op: str, reason: str) -> float:
+    return SHARED_STATE_DROPPED.labels(op, reason).value
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "state.sock")
+
+
+def test_cache_set_reaches_server(path):
+    async def run():
+        state, server = await start(path)
+        client = StateClient(path)
+        try:
+            for i in range(50):
+                client.cache_set(f"k{i}", b"v%d" % i)
+
+            async def stored():
+                return len(state.cache) == 50
+            await eventually(stored)
+            assert await client.cache_get("k7") == b"v7"
+            assert await client.cache_get("missing") is None
+        finally:
+            await client.close()
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_messages_queued_until_server_is_up(path, monkeypatch):
+    """状态服务不可用时消息留在队列中，连上之后按顺序发送，而不是直接丢弃"""
+    monkeypatch.setattr(shared_state, "RECONNECT_INTERVAL", 0.1)
+
+    async def run():
+        client = StateClient(path)
+        before = dropped("cache_set", "disconnected")
+        client.cache_set("a", b"1")
+        client.cache_set("a", b"2")
+        await asyncio.sleep(0.3)
+        state, server = await start(path)
+        try:
+            async def stored():
+                return await state.cache.get("a") == b"2"
+            await eventually(stored)
+            assert dropped("cache_set", "disconnected") == before
+        finally:
+            await client.close()
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_reconnects_after_server_restart(path, monkeypatch):
+    monkeypatch.setattr(shared_state, "RECONNECT_INTERVAL", 0.1)
+
+    async def run():
+        state, server = await start(path)
+        client = StateClient(path)
+        client.cache_set("a", b"1")
+
+        async def first():
+            return len(state.cache) == 1
+        await eventually(first)
+
+        server.close()
+        await server.wait_closed()
+        # 关闭监听不会断开已有连接，模拟状态服务重启
+        client._disconnect()
+        state, server = await start(path)
+        try:
+            client.cache_set("b", b"2")
+
+            async def second():
+                return await state.cache.get("b") == b"2"
+            await eventually(second)
+        finally:
+            await client.close()
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_full_queue_drops_and_counts(path, monkeypatch):
+    monkeypatch.setattr(shared_state, "SEND_QUEUE_MAX_MESSAGES", 3)
+    monkeypatch.setattr(shared_state, "RECONNECT_INTERVAL", 10.0)
+
+    async def run():
+        client = StateClient(path)
+        before = dropped("cache_set", "queue_full")
+        for i in range(5):
+            client.cache_set(f"k{i}", b"x")
+        assert dropped("cache_set", "queue_full") == before + 2
+        assert len(client._outbox) == 3
+        await client.close()
+
+    asyncio.run(run())
+
+
+def test_queue_byte_limit(path, monkeypatch):
+    monkeypatch.setattr(shared_state, "SEND_QUEUE_MAX_BYTES", 1000)
+    monkeypatch.setattr(shared_state, "RECONNECT_INTERVAL", 10.0)
+
+    async def run():
+        client = StateClient(path)
+        before = dropped("cache_set", "queue_full")
+        client.cache_set("small", b"x" * 100)
+        client.cache_set("large", b"x" * 2000)
+        assert dropped("cache_set", "queue_full") == before + 1
+        assert len(client._outbox) == 1
+        await client.close()
+
+    asyncio.run(run())
+
+
+def test_ratelimit_update_reaches_server(path):
+    async def run():
+        state, server = await start(path)
+        client = StateClient(path)
+        limiter = client.limiter("http://upstream", "sk-test", rpm=60)
+        try:
+            limiter.update({"retry-after": "1"}, 429)
+
+            async def updated():
+                return limiter.key in state.limiters
+            await eventually(updated)
+        finally:
+            await client.close()
+            server.close()
+
+    asyncio.run(run())
+
+
+def test_disk_tier_runs_off_the_event_loop(path, tmp_path, monkeypatch):
+    disk = DiskCache(str(tmp_path / "disk"), segment_bytes=1024 * 1024).start()
+    deadline = time.monotonic() + 10
+    while not disk.ready:
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+    threads = []
+    for name in ("get", "set"):
+        original = getattr(disk, name)
+
+        def traced(*args, _original=original):
+            threads.append(threading.current_thread())
+            return _original(*args)
+        monkeypatch.setattr(disk, name, traced)
+
+    async def run():
+        cache = ResponseCache(lower=disk)
+        state, server = await start(path, cache)
+        client = StateClient(path)
+        try:
+            client.cache_set("k", b"value")
+
+            async def stored():
+                return len(cache) == 1 and len(disk) == 1
+            await eventually(stored)
+            # 内存层清空后从磁盘层读回
+            cache.clear()
+            assert await client.cache_get("k") == b"value"
+            assert len(cache) == 1
+        finally:
+            await client.close()
+            server.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        disk.close()
+    assert threads and all(thread is not threading.main_thread() for thread in threads)
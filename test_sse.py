@@ -0,0 +1,86 @@
+"""
+SSE编码器测试 - orjson和纯Python两条字符串序列化路径输出的字节完全一致，并与逐个chunk用json.dumps编码的结果相同
+"""
+import json
+
+import pytest
+
+import sse
+from sse import SSEEncoder
+
+pytest.importorskip("orjson")
+
+TEXTS = [
+    "",
+    "hello",
+    "你好，世界",
+    "emoji 😀 and ZWJ 👩‍💻",
+    'quotes " and \\ backslash',
+    "control \x00\x01\x1f\t\n\r\b\f",
+    "\x7f del and   line separator  ",
+    "</script><!-- -->",
+    "lone surrogate \ud800 here",
+]
+
+
+def encode_all(encoder: SSEEncoder) -> bytes:
+    parts = [encoder.role()]
+    for text in TEXTS:
+        parts.append(encoder.content(text))
+        parts.append(encoder.reasoning(text))
+    parts.append(encoder.tool_call_start(0, "call_1", "查询"))
+    for text in TEXTS:
+        parts.append(encoder.tool_arguments(0, text))
+        parts.append(encoder.tool_arguments(3, text))
+    parts.append(encoder.finish("stop"))
+    parts.append(encoder.usage({"input_tokens": 3, "output_tokens": None}))
+    return b"".join(parts)
+
+
+@pytest.mark.parametrize("include_usage", [False, True])
+@pytest.mark.parametrize("model", ["claude", "模型-ü"])
+def test_orjson_and_python_paths_match(monkeypatch, include_usage, model):
+    outputs = []
+    for dumps in (sse._dumps_str_orjson, sse._dumps_str_python):
+        monkeypatch.setattr(sse, "dumps_str", dumps)
+        outputs.append(encode_all(SSEEncoder("chatcmpl-1", model, created=123, include_usage=include_usage)))
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_dumps_str_paths_match(text):
+    assert sse._dumps_str_orjson(text) == sse._dumps_str_python(text)
+
+
+def reference(delta: dict, include_usage: bool) -> bytes:
+    chunk = {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 123,
+        "model": "模型",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+    }
+    if include_usage:
+        chunk["usage"] = None
+    try:
+        body = json.dumps(chunk, ensure_ascii=False).encode("utf-8")
+    except UnicodeEncodeError:
+        body = json.dumps(chunk).encode("utf-8")
+    return b"data: " + body + b"\n\n"
+
+
+@pytest.mark.parametrize("include_usage", [False, True])
+@pytest.mark.parametrize("text", [text for text in TEXTS if "\ud800" not in text])
+def test_precomputed_chunks_match_full_encoding(include_usage, text):
+    encoder = SSEEncoder("chatcmpl-1", "模型", created=123, include_usage=include_usage)
+    assert encoder.content(text) == reference({"content": text}, include_usage)
+    assert encoder.reasoning(text) == reference({"reasoning_content": text}, include_usage)
+    assert encoder.tool_arguments(2, text) == reference(
+        {"tool_calls": [{"index": 2, "function": {"arguments": text}}]}, include_usage)
+
+
+def test_lone_surrogate_is_escaped():
+    encoder = SSEEncoder("chatcmpl-1", "m", created=123)
+    chunk = encoder.content("a\ud800b")
+    assert b"\\ud800" in chunk
+    assert json.loads(chunk[len(b"data: "):])["choices"][0]["delta"]["content"] == "a\ud800b"
@@ -0,0 +1,153 @@
+"""
+上游池测试 - 用不发请求的假客户端验证最少未完成请求选择、连续失败摘除和冷却后恢复
+"""
+import asyncio
+
+import pytest
+
+import upstream as upstream_module
+from upstream import LazyClient, Upstream, UpstreamPool, UpstreamUnavailable
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upstream_module.time, "monotonic", clock)
+    return clock
+
+
+def make_pool(*specs, **options) -> UpstreamPool:
+    """specs为 (name, weight, max_concurrency, models)，省略的项使用默认值"""
+    upstreams = [Upstream(spec[0], object(), *spec[1:]) for spec in specs]
+    return UpstreamPool(upstreams, **options)
+
+
+def names(upstreams):
+    return [upstream.name for upstream in upstreams]
+
+
+def test_selects_least_outstanding():
+    pool = make_pool(("a",), ("b",), ("c",))
+    leased = [pool.acquire() for _ in range(3)]
+    # 负载相同时轮换，三个请求分到三个上游
+    assert sorted(names(leased)) == ["a", "b", "c"]
+
+    pool.release(leased[0])
+    assert pool.acquire() is leased[0]
+
+
+def test_weight_scales_load():
+    pool = make_pool(("big", 3.0), ("small", 1.0))
+    leased = [pool.acquire() for _ in range(4)]
+    assert names(leased).count("big") == 3
+    assert names(leased).count("small") == 1
+
+
+def test_capacity_and_models():
+    pool = make_pool(("a", 1.0, 1), ("b", 1.0, 0, ["other"]))
+    assert pool.acquire("claude").name == "a"
+    with pytest.raises(UpstreamUnavailable):
+        pool.acquire("claude")
+    assert pool.acquire("other").name == "b"
+    assert pool.serves("unknown")
+    assert not make_pool(("b", 1.0, 0, ["other"])).serves("claude")
+
+
+def test_avoid_prefers_other_upstream_but_falls_back():
+    pool = make_pool(("a",), ("b",))
+    a = pool.upstreams[0]
+    for _ in range(5):
+        assert pool.select(avoid=[a]).name == "b"
+    only = make_pool(("a",))
+    assert only.select(avoid=only.upstreams).name == "a"
+
+
+def test_ejects_after_consecutive_failures(clock):
+    pool = make_pool(("a",), ("b",), eject_failures=3, eject_seconds=30)
+    a, b = pool.upstreams
+    pool.report_failure(a)
+    pool.report_failure(a)
+    # 成功会清零连续失败计数
+    pool.report_success(a)
+    pool.report_failure(a)
+    pool.report_failure(a)
+    assert not a.is_ejected(clock.now)
+    pool.report_failure(a)
+    assert a.is_ejected(clock.now)
+
+    for _ in range(5):
+        assert pool.select() is b
+    assert [item["ejected"] for item in pool.status()] == [True, False]
+
+
+def test_readmitted_after_cooldown(clock):
+    pool = make_pool(("a",), ("b",), eject_failures=1, eject_seconds=30)
+    a, b = pool.upstreams
+    pool.report_failure(a)
+    clock.now += 29.9
+    assert {pool.select().name for _ in range(4)} == {"b"}
+    clock.now += 0.1
+    assert {pool.select().name for _ in range(4)} == {"a", "b"}
+
+
+def test_all_ejected_uses_earliest_recovery(clock):
+    pool = make_pool(("a",), ("b",), eject_failures=1, eject_seconds=30)
+    a, b = pool.upstreams
+    pool.report_failure(b)
+    clock.now += 5
+    pool.report_failure(a)
+    assert pool.select() is b
+
+
+def connection_error():
+    anthropic = pytest.importorskip("anthropic")
+    try:
+        import httpx2 as httpx
+    except ImportError:
+        import httpx
+    return anthropic.APIConnectionError(request=httpx.Request("POST", "http://upstream/v1/messages"))
+
+
+def test_lease_releases_and_counts_upstream_failures(clock):
+    error = connection_error()
+    pool = make_pool(("a",), eject_failures=2, eject_seconds=30)
+    a = pool.upstreams[0]
+
+    async def fail(exception):
+        async with pool.lease() as leased:
+            assert leased.inflight == 1
+            raise exception
+
+    with pytest.raises(ValueError):
+        asyncio.run(fail(ValueError("bad request")))
+    # 非上游故障不计入失败
+    assert (a.inflight, a.failures) == (0, 0)
+
+    for _ in range(2):
+        with pytest.raises(type(error)):
+            asyncio.run(fail(error))
+    assert a.inflight == 0
+    assert a.is_ejected(clock.now)
+
+
+def test_from_config_shares_client_per_key():
+    pool = UpstreamPool.from_config([
+        {"base_url": "http://one", "api_key": "k1", "name": "first"},
+        {"base_url": "http://one", "api_key": "k1"},
+        {"base_url": "http://two", "api_key": "k1", "weight": 2},
+    ], eject_failures=3, eject_seconds=30)
+    first, second, third = pool.upstreams
+    assert names(pool.upstreams) == ["first", "upstream-1", "upstream-2"]
+    assert first._client is second._client and first.limiter is second.limiter
+    assert third._client is not first._client
+    assert third.weight == 2.0
+    # 客户端在第一次使用时才创建
+    assert isinstance(first._client, LazyClient) and not first._client.created
@@ -0,0 +1,275 @@
+"""
+上游管理 - 多个上游/密钥的连接池、最少未完成请求负载均衡和故障摘除
+"""
+import functools
+import time
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Collection, Dict, List, Optional
+
+import sdk
+from config import (
+    UPSTREAM_MAX_CONNECTIONS, UPSTREAM_MAX_KEEPALIVE, UPSTREAM_KEEPALIVE_EXPIRY, UPSTREAM_HTTP2,
+)
+from ratelimit import RateLimiter
+
+if TYPE_CHECKING:
+    from anthropic import AsyncAnthropic
+
+
+class UpstreamUnavailable(Exception):
+    """没有可用的上游（全部达到并发上限）"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def create_client(base_url: str, api_key: str, limiter: Optional[RateLimiter] = None) -> "AsyncAnthropic":
+    """创建带连接池的Anthropic客户端，limiter会从每个响应的限流响应头中更新"""
+    try:
+        # anthropic>=1.0 基于 httpx2，旧版本基于 httpx
+        import httpx2 as httpx
+    except ImportError:
+        import httpx
+    anthropic = sdk.load()
+
+    event_hooks = {}
+    if limiter is not None:
+        async def on_response(response: httpx.Response) -> None:
+            limiter.update(response.headers, response.status_code)
+        event_hooks["response"] = [on_response]
+
+    http_client = anthropic.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        http2=UPSTREAM_HTTP2,
+        event_hooks=event_hooks,
+    )
+    return anthropic.AsyncAnthropic(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=http_client,
+        # 重试由代理统一处理，以便重试时可以换到其它上游
+        max_retries=0,
+    )
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """判断异常是否计入上游故障：连接错误、429和5xx"""
+    anthropic = sdk.load()
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class LazyClient:
+    """第一次使用时才创建的客户端，创建之前不需要导入anthropic SDK"""
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._client: Any = None
+
+    @property
+    def created(self) -> bool:
+        return self._client is not None
+
+    def get(self) -> Any:
+        if self._client is None:
+            self._client = self._factory()
+        return self._client
+
+
+class Upstream:
+    """单个上游端点+密钥"""
+
+    def __init__(
+        self,
+        name: str,
+        client: Any,
+        weight: float = 1.0,
+        max_concurrency: int = 0,
+        models: Optional[List[str]] = None,
+        limiter: Optional[RateLimiter] = None,
+    ):
+        self.name = name
+        # 可以是LazyClient，第一次访问client时创建
+        self._client = client
+        # 同一个密钥的上游共享限速器
+        self.limiter = limiter or RateLimiter()
+        self.weight = weight if weight > 0 else 1.0
+        # 0 表示不限制并发
+        self.max_concurrency = max_concurrency
+        # 为空表示支持所有模型
+        self.models = set(models or ())
+        self.inflight = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @property
+    def client(self) -> Any:
+        if isinstance(self._client, LazyClient):
+            return self._client.get()
+        return self._client
+
+    def serves(self, model: Optional[str]) -> bool:
+        return not self.models or model in self.models
+
+    def has_capacity(self) -> bool:
+        return self.max_concurrency <= 0 or self.inflight < self.max_concurrency
+
+    def is_ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    def load(self) -> float:
+        """加权后的未完成请求数"""
+        return (self.inflight + 1) / self.weight
+
+
+class UpstreamPool:
+    """上游池：把请求路由到加权未完成请求数最少的上游，连续失败的上游会被暂时摘除"""
+
+    def __init__(self, upstreams: List[Upstream], eject_failures: int = 3, eject_seconds: float = 30.0):
+        if not upstreams:
+            raise ValueError("至少需要配置一个上游")
+        self.upstreams = upstreams
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self._offset = 0
+
+    @classmethod
+    def from_config(
+        cls,
+        configs: List[Dict[str, Any]],
+        eject_failures: int,
+        eject_seconds: float,
+        limiter_factory: Optional[Callable[[str, str, float, float], RateLimiter]] = None,
+    ) -> "UpstreamPool":
+        """根据配置创建上游池，相同的 base_url/api_key 共享同一个客户端和限速器
+
+        limiter_factory(base_url, api_key, rpm, tpm) 用于替换默认的进程内限速器（例如多worker共享的限速器）。
+        """
+        clients: Dict[tuple, LazyClient] = {}
+        limiters: Dict[tuple, RateLimiter] = {}
+        upstreams = []
+        for i, cfg in enumerate(configs):
+            key = (cfg["base_url"], cfg.get("api_key", ""))
+            if key not in clients:
+                # rpm/tpm为初始限额，收到上游限流响应头后以响应头为准
+                rpm, tpm = float(cfg.get("rpm", 0)), float(cfg.get("tpm", 0))
+                limiters[key] = limiter_factory(*key, rpm, tpm) if limiter_factory else RateLimiter(rpm, tpm)
+                clients[key] = LazyClient(functools.partial(create_client, *key, limiters[key]))
+            upstreams.append(Upstream(
+                name=cfg.get("name") or f"upstream-{i}",
+                client=clients[key],
+                weight=float(cfg.get("weight", 1.0)),
+                max_concurrency=int(cfg.get("max_concurrency", 0)),
+                models=cfg.get("models"),
+                limiter=limiters[key],
+            ))
+        return cls(upstreams, eject_failures, eject_seconds)
+
+    def select(self, model: Optional[str] = None, avoid: Collection[Upstream] = ()) -> Upstream:
+        """选择加权未完成请求数最少的健康上游，尽量避开avoid中的上游（如已失败或正在处理同一请求的上游）"""
+        if avoid:
+            try:
+                return self._select(model, avoid)
+            except UpstreamUnavailable:
+                pass
+        return self._select(model, ())
+
+    def _select(self, model: Optional[str], avoid: Collection[Upstream]) -> Upstream:
+        now = time.monotonic()
+        best = None
+        fallback = None
+
+        # 轮换起点，负载相同时在上游之间均匀分配
+        count = len(self.upstreams)
+        self._offset = (self._offset + 1) % count
+        for i in range(count):
+            upstream = self.upstreams[(self._offset + i) % count]
+            if not upstream.serves(model) or not upstream.has_capacity() or upstream in avoid:
+                continue
+            if upstream.is_ejected(now):
+                # 全部上游都被摘除时，选择最早恢复的一个
+                if fallback is None or upstream.ejected_until < fallback.ejected_until:
+                    fallback = upstream
+                continue
+            if best is None or upstream.load() < best.load():
+                best = upstream
+
+        if best is None:
+            best = fallback
+        if best is None:
+            raise UpstreamUnavailable(f"没有可用的上游处理模型 {model}")
+        return best
+
+    def serves(self, model: Optional[str]) -> bool:
+        """是否有上游支持该模型"""
+        return any(upstream.serves(model) for upstream in self.upstreams)
+
+    def acquire(self, model: Optional[str] = None, avoid: Collection[Upstream] = ()) -> Upstream:
+        """选择并占用一个上游"""
+        upstream = self.select(model, avoid)
+        upstream.inflight += 1
+        return upstream
+
+    def release(self, upstream: Upstream, error: Optional[BaseException] = None) -> None:
+        """释放上游，并根据结果更新其健康状态"""
+        upstream.inflight -= 1
+        if error is None:
+            self.report_success(upstream)
+        elif is_upstream_failure(error):
+            self.report_failure(upstream)
+
+    @asynccontextmanager
+    async def lease(self, model: Optional[str] = None) -> AsyncIterator[Upstream]:
+        """占用一个上游直到请求结束"""
+        upstream = self.acquire(model)
+        error = None
+        try:
+            yield upstream
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.release(upstream, error)
+
+    def report_success(self, upstream: Upstream) -> None:
+        upstream.failures = 0
+        upstream.ejected_until = 0.0
+
+    def report_failure(self, upstream: Upstream) -> None:
+        upstream.failures += 1
+        if upstream.failures >= self.eject_failures:
+            upstream.ejected_until = time.monotonic() + self.eject_seconds
+            upstream.failures = 0
+
+    async def close(self) -> None:
+        """关闭所有已创建的上游客户端"""
+        closed = set()
+        for upstream in self.upstreams:
+            client = upstream._client
+            if isinstance(client, LazyClient):
+                if not client.created:
+                    continue
+                client = client.get()
+            if id(client) not in closed:
+                closed.add(id(client))
+                await client.close()
+
+    def status(self) -> List[Dict[str, Any]]:
+        """各上游的当前状态"""
+        now = time.monotonic()
+        return [{
+            "name": upstream.name,
+            "inflight": upstream.inflight,
+            "weight": upstream.weight,
+            "max_concurrency": upstream.max_concurrency,
+            "ejected": upstream.is_ejected(now),
+            **upstream.limiter.status(),
+        } for upstream in self.upstreams]